@@ -0,0 +1,244 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Benchmark the analysis hot paths on synthetic stacks, results are saved as json.
+
+For each stack size (images, rows, cols) we time
+	lineProfile, fitGaussian: one call on one image
+	stackLineProfile, stackPolygonAnalysis: all images, in each mode ('single' loop or 'multi' processing pool)
+	stackMultiPolygonAnalysis: all cell polygons in one pass
+	stackPolygonStats: all cell polygons in one pass, with sd/n/sum/median/p95
+	analyzeAll: all lines and cell polygons in one pass, in each mode (fits in a pool for 'multi')
+	rollingDeltaFF: rolling percentile baseline of all cell traces
+	filterStack: gaussian filter of the stack (ShapeAnalysisPlugin.filterImage)
+	saveShapeFile (all and after one change), loadShapeFile: h5f file of all the analysis
+
+Each benchmark is run --repeat times, json has the time of each repeat.
+Stack analysis also records how close it is to the known answer of the synthetic stack.
+
+Usage:
+	python3 benchmarks/benchmarkAnalysis.py --output benchmark.json
+
+Compare two runs with compareBenchmarks.py
+"""
+
+import os, sys, io, time, json, argparse, platform, tempfile, shutil, contextlib, datetime
+import multiprocessing
+import numpy as np
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin import ShapeAnalysis, ShapeList, saveShapeFile, loadShapeFile
+from shapeanalysisplugin.ShapeAnalysis import filterStack
+from shapeanalysisplugin.SyntheticStack import syntheticStack
+from shapeanalysisplugin.TraceAnalysis import rollingDeltaFF
+from shapeanalysisplugin import Kernels
+
+# list of (numImages, (rows, cols))
+defaultSizes = [(200, (128, 128)), (1000, (256, 256))]
+quickSizes = [(100, (64, 64))]
+
+def environment():
+	""" return dict describing where we ran, so results from different machines are not mixed up """
+	import scipy, skimage, h5py
+	return {
+		'date': datetime.datetime.now().isoformat(timespec='seconds'),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'scipy': scipy.__version__,
+		'skimage': skimage.__version__,
+		'h5py': h5py.__version__,
+		# compiled kernels, None when using NumPy
+		'numba': Kernels.numba.__version__ if Kernels.enabled else None,
+		'platform': platform.platform(),
+		'machine': platform.machine(),
+		'processor': platform.processor(),
+		'cpuCount': multiprocessing.cpu_count(),
+	}
+
+def timeCalls(func, repeat, number=1, setup=None, verbose=False):
+	"""
+	Return list of seconds per call, one for each repeat
+
+	Parameters:
+		func: function with no arguments
+		number: calls per repeat (use more for fast functions)
+		setup: function with no arguments called before each repeat, not timed
+		verbose: if False, hide what func prints
+	"""
+	times = []
+	for repeatIdx in range(repeat):
+		if setup is not None:
+			setup()
+		output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+		with output:
+			startTime = time.perf_counter()
+			for callIdx in range(number):
+				func()
+			stopTime = time.perf_counter()
+		times.append((stopTime - startTime) / number)
+	return times
+
+def addResult(results, name, params, times, number=1, extra=None):
+	result = {
+		'name': name,
+		'params': params,
+		'times': times,
+		'median': float(np.median(times)),
+		'min': float(np.min(times)),
+		'number': number,
+	}
+	if extra is not None:
+		result['extra'] = extra
+	results.append(result)
+	print('  ', name.ljust(26), json.dumps(params).ljust(60), 'median:', round(result['median'], 5), 'sec')
+
+def setMode(analysis, mode):
+	""" force ShapeAnalysis stack functions to loop ('single') or use a multiprocessing pool ('multi') """
+	analysis.doSingleThread = mode == 'single'
+	analysis.minParallelImages = 0
+
+def benchmarkStack(numImages, imageShape, modes, repeat, results, folder, verbose=False):
+	""" run all benchmarks on one synthetic stack size, append to results """
+	print('stack numImages:', numImages, 'imageShape:', imageShape)
+	stack = syntheticStack(numImages=numImages, imageShape=imageShape)
+	params = {'numImages': numImages, 'rows': imageShape[0], 'cols': imageShape[1]}
+	analysis = ShapeAnalysis(stack['data'])
+	src, dst = stack['lines'][0]
+
+	# one image
+	times = timeCalls(lambda: analysis.lineProfile(0, src, dst, linewidth=3), repeat, number=20, verbose=verbose)
+	addResult(results, 'lineProfile', params, times, number=20)
+
+	x, lineProfile, yFit, fwhm, left, right = analysis.lineProfile(0, src, dst, linewidth=3)
+	times = timeCalls(lambda: analysis.fitGaussian(x, lineProfile), repeat, number=20, verbose=verbose)
+	addResult(results, 'fitGaussian', params, times, number=20)
+
+	# all images
+	for mode in modes:
+		setMode(analysis, mode)
+		modeParams = dict(params, mode=mode)
+
+		lineResults = {}
+		def stackLineProfile():
+			lineResults['x'], lineResults['results'] = analysis.stackLineProfile(src, dst)
+		times = timeCalls(stackLineProfile, repeat, verbose=verbose)
+		diameter = lineResults['results']['lineDiameter']
+		extra = {'diameterCorrelation': float(np.ma.corrcoef(np.ma.masked_invalid(diameter), stack['diameters'][0])[0,1])}
+		addResult(results, 'stackLineProfile', modeParams, times, extra=extra)
+
+		polygonResults = {}
+		def stackPolygonAnalysis():
+			polygonResults['min'], polygonResults['max'], polygonResults['mean'] = analysis.stackPolygonAnalysis(stack['polygons'][0])
+		times = timeCalls(stackPolygonAnalysis, repeat, verbose=verbose)
+		extra = {'meanAbsError': float(np.nanmean(np.abs(polygonResults['mean'] - stack['traces'][0])))}
+		addResult(results, 'stackPolygonAnalysis', modeParams, times, extra=extra)
+
+		times = timeCalls(lambda: analysis.analyzeAll(stack['lines'], stack['polygons']), repeat, verbose=verbose)
+		addResult(results, 'analyzeAll', dict(modeParams, numLines=len(stack['lines']), numPolygons=len(stack['polygons'])), times)
+
+	polygonResults = {}
+	def stackMultiPolygonAnalysis():
+		polygonResults['min'], polygonResults['max'], polygonResults['mean'] = analysis.stackMultiPolygonAnalysis(stack['polygons'])
+	times = timeCalls(stackMultiPolygonAnalysis, repeat, verbose=verbose)
+	extra = {'numPolygons': len(stack['polygons']),
+			'meanAbsError': float(np.nanmean(np.abs(polygonResults['mean'] - stack['traces'])))}
+	addResult(results, 'stackMultiPolygonAnalysis', params, times, extra=extra)
+
+	stats = ['sd', 'n', 'sum', 'median', 'p95']
+	times = timeCalls(lambda: analysis.stackPolygonStats(stack['polygons'], stats=stats), repeat, verbose=verbose)
+	addResult(results, 'stackPolygonStats', dict(params, stats=','.join(stats)), times)
+
+	times = timeCalls(lambda: rollingDeltaFF(polygonResults['mean'], window=101), repeat, verbose=verbose)
+	addResult(results, 'rollingDeltaFF', dict(params, window=101), times)
+
+	times = timeCalls(lambda: filterStack(stack['data'], sigma=1), repeat, verbose=verbose)
+	addResult(results, 'filterStack', params, times)
+
+	# h5f file with all analysis
+	shapeList = ShapeList()
+	shapeList.add(np.array([src, dst]), 'line')
+	shapeList.setResults(0, lineResults['results'])
+	for polygonIdx, vertices in enumerate(stack['polygons']):
+		index = shapeList.add(vertices, 'polygon')
+		shapeList.setResults(index, {
+			'polygonMin': polygonResults['min'][polygonIdx],
+			'polygonMax': polygonResults['max'][polygonIdx],
+			'polygonMean': polygonResults['mean'][polygonIdx],
+			})
+	path = os.path.join(folder, 'benchmark_' + str(numImages) + '.h5')
+	def removeFile():
+		if os.path.isfile(path):
+			os.remove(path)
+	times = timeCalls(lambda: saveShapeFile(path, shapeList), repeat, setup=removeFile, verbose=verbose)
+	addResult(results, 'saveShapeFile', dict(params, save='all'), times,
+				extra={'fileBytes': os.path.getsize(path), 'numShapes': len(shapeList)})
+
+	def changeOne():
+		shapeList.setResults(1, {'polygonMean': polygonResults['mean'][0] + 1})
+	times = timeCalls(lambda: saveShapeFile(path, shapeList), repeat, setup=changeOne, verbose=verbose)
+	addResult(results, 'saveShapeFile', dict(params, save='changed'), times)
+
+	times = timeCalls(lambda: loadShapeFile(path), repeat, verbose=verbose)
+	addResult(results, 'loadShapeFile', params, times)
+
+	def loadAndRead():
+		loaded = loadShapeFile(path)
+		for metadata in loaded.metadata:
+			for value in metadata.values():
+				np.asarray(value)
+	times = timeCalls(loadAndRead, repeat, verbose=verbose)
+	addResult(results, 'loadShapeFile', dict(params, read='all'), times)
+
+def runBenchmarks(sizes=defaultSizes, modes=('single', 'multi'), repeat=3, verbose=False):
+	"""
+	Returns:
+		dict with 'suite', 'environment' and 'results' (list of dict, one per benchmark)
+	"""
+	results = []
+	folder = tempfile.mkdtemp(prefix='shapeanalysis_benchmark_')
+	try:
+		for numImages, imageShape in sizes:
+			benchmarkStack(numImages, imageShape, modes, repeat, results, folder, verbose=verbose)
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+	return {
+		'suite': 'analysis', # compareBenchmarks.py can run this suite again
+		'environment': environment(),
+		'repeat': repeat,
+		'sizes': [[numImages, list(imageShape)] for numImages, imageShape in sizes],
+		'modes': list(modes),
+		'results': results,
+	}
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark ShapeAnalysisPlugin analysis on synthetic stacks')
+	parser.add_argument('--output', default='benchmark.json', help='json file to save results')
+	parser.add_argument('--repeat', type=int, default=3, help='times to run each benchmark')
+	parser.add_argument('--modes', nargs='+', default=['single', 'multi'], choices=['single', 'multi'],
+						help='stack analysis modes')
+	parser.add_argument('--sizes', nargs='+', default=None,
+						help='stack sizes as images,rows,cols e.g. 1000,256,256')
+	parser.add_argument('--quick', action='store_true', help='one small stack')
+	parser.add_argument('--verbose', action='store_true', help='show what analysis prints')
+	args = parser.parse_args(argv)
+
+	if args.sizes is not None:
+		sizes = []
+		for size in args.sizes:
+			numImages, rows, cols = [int(value) for value in size.split(',')]
+			sizes.append((numImages, (rows, cols)))
+	elif args.quick:
+		sizes = quickSizes
+	else:
+		sizes = defaultSizes
+
+	benchmark = runBenchmarks(sizes=sizes, modes=args.modes, repeat=args.repeat, verbose=args.verbose)
+	with open(args.output, 'w') as f:
+		json.dump(benchmark, f, indent=1)
+	print('saved', len(benchmark['results']), 'results to:', args.output)
+
+if __name__ == '__main__':
+	main()
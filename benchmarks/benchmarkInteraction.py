@@ -0,0 +1,404 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Replay user interaction against ShapeAnalysisPlugin in an offscreen Qt session and time it.
+
+What a user feels is how long the plugin takes to respond while they
+	drag a line (lineShapeChange_callback),
+	scrub the slice slider (my_update_slider),
+	select shapes (myMouseDown_Shape -> updatePlots, plotAllPolygon).
+
+A script is a json file with the image, the shapes and a list of events:
+	{'image': {'numImages': 500, 'rows': 256, 'cols': 256} or {'path': '/path/to/file.tif'},
+	 'shapes': [{'shape_type': 'line', 'data': [[r,c], [r,c]]}, ...],
+	 'events': [{'type': 'select', 'index': 3, 'time': 0.5}, ...]}
+
+Event types
+	select: {'index'} select a shape and click on it
+	drag: {'index', 'data'} move the vertices of a line shape to data, while the mouse is down
+	slice: {'slice'} move the slice slider
+	plotAll: update plots of all polygons (as after analysis)
+
+Events are replayed from a Qt timer, one every --interval ms (or with their recorded timing, --realtime),
+while a heartbeat timer ticks every --heartbeat ms. For each event type we report the latency
+(callback plus the repaint it causes) as p50/p95/p99. The heartbeat gives event loop stalls, a gap
+longer than --stall ms between two ticks is a stall (the user sees a frozen window).
+
+Results are saved in the same json as benchmarkAnalysis.py, compare runs with compareBenchmarks.py.
+
+Usage:
+	# scripted interaction on a synthetic stack
+	python3 benchmarks/benchmarkInteraction.py --output interaction.json
+
+	# save the scripted interaction, to edit it or replay it later
+	python3 benchmarks/benchmarkInteraction.py --save-script script.json
+
+	# record your own interaction (a napari window opens), then replay it
+	python3 benchmarks/benchmarkInteraction.py --record script.json --image /path/to/file.tif
+	python3 benchmarks/benchmarkInteraction.py --script script.json --realtime --output interaction.json
+"""
+
+import os, sys, io, time, json, types, argparse, tempfile, shutil, contextlib
+import numpy as np
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# import plugin modules only through the shapeanalysisplugin package (like benchmarkAnalysis),
+# one copy of Instrumentation so the timers and counters we report are the ones the plugin updates
+import benchmarkAnalysis
+
+defaultImage = {'numImages': 500, 'rows': 256, 'cols': 256}
+
+def scriptedInteraction(image=defaultImage, roiSize=16, numDrag=60, numSlice=100, numSelect=20, seed=0):
+	"""
+	Return a script (dict) of typical interaction on a synthetic stack
+
+	Shapes are the lines across the vessels and a grid of rectangles over the cells (right half).
+	"""
+	from shapeanalysisplugin.SyntheticStack import syntheticStack
+	from shapeanalysisplugin.RoiImport import gridRectangles
+
+	rng = np.random.default_rng(seed)
+	numImages, rows, cols = image['numImages'], image['rows'], image['cols']
+	# only need the shapes, a small stack has the same shapes
+	stack = syntheticStack(numImages=2, imageShape=(rows, cols))
+	shapes = []
+	for src, dst in stack['lines']:
+		shapes.append({'shape_type': 'line', 'data': [list(src), list(dst)]})
+	rectangles = gridRectangles((0, cols // 2, rows, cols), (roiSize, roiSize), spacing=roiSize // 4)
+	for data in rectangles.data:
+		shapes.append({'shape_type': 'rectangle', 'data': np.asarray(data).tolist()})
+	numRectangles = len(rectangles)
+	firstRectangle = len(stack['lines'])
+
+	events = []
+	# click through rectangles
+	for index in rng.integers(firstRectangle, firstRectangle + numRectangles, numSelect):
+		events.append({'type': 'select', 'index': int(index)})
+	# select the first line and drag its end point back and forth
+	events.append({'type': 'select', 'index': 0})
+	src, dst = np.asarray(stack['lines'][0], dtype=np.float64)
+	for dragIdx in range(numDrag):
+		offset = 10 * np.sin(2 * np.pi * dragIdx / numDrag)
+		events.append({'type': 'drag', 'index': 0, 'data': [src.tolist(), [dst[0], dst[1] + offset]]})
+	# scrub the slider forward then back
+	for sliceNum in np.linspace(0, numImages - 1, numSlice // 2).astype(int).tolist() + \
+					np.linspace(numImages - 1, 0, numSlice // 2).astype(int).tolist():
+		events.append({'type': 'slice', 'slice': sliceNum})
+	for plotIdx in range(numSelect // 4):
+		events.append({'type': 'plotAll'})
+
+	return {'image': dict(image), 'shapes': shapes, 'events': events}
+
+def loadScript(path):
+	with open(path) as f:
+		return json.load(f)
+
+def saveScript(path, script):
+	with open(path, 'w') as f:
+		json.dump(script, f, indent=1)
+	print('saved', len(script['events']), 'events to:', path)
+
+def makeImageFile(image, folder):
+	""" return path to the .tif of a script image, a synthetic stack is saved in folder """
+	if 'path' in image:
+		return image['path']
+	from skimage.io import imsave
+	from shapeanalysisplugin.SyntheticStack import syntheticStack
+	stack = syntheticStack(numImages=image['numImages'], imageShape=(image['rows'], image['cols']))
+	path = os.path.join(folder, 'interaction_' + str(image['numImages']) + '.tif')
+	# 8-bit like our recordings
+	imsave(path, (np.clip(stack['data'], 0, 1) * 255).astype(np.uint8), check_contrast=False)
+	return path
+
+def makePlugin(script, folder):
+	""" return a ShapeAnalysisPlugin with the image and analyzed shapes of a script """
+	from shapeanalysisplugin.ShapeAnalysisPlugin import ShapeAnalysisPlugin
+	from shapeanalysisplugin import ShapeList
+
+	plugin = ShapeAnalysisPlugin(imagePath=makeImageFile(script['image'], folder))
+	shapeList = ShapeList()
+	for shape in script['shapes']:
+		shapeList.add(np.asarray(shape['data'], dtype=np.float64), shape['shape_type'],
+					edge_width=shape.get('edge_width', 3), opacity=shape.get('opacity', 0.2))
+	plugin.addShapes(shapeList, analyze=True)
+	# analyze lines so selecting them shows kymograph and diameter
+	for index, shapeType in enumerate(plugin.shapeList.shape_types):
+		if shapeType == 'line':
+			selectShape(plugin, index)
+			plugin.updateStackLineProfile()
+	return plugin
+
+def selectShape(plugin, index):
+	# a list, ShapeAnalysisPlugin._getSelectedShape() takes selected_data[0]
+	plugin.shapeLayer.selected_data = [index]
+
+def setSlice(plugin, sliceNum):
+	""" move the slice slider, napari calls plugin.my_update_slider() """
+	dims = plugin.napariViewer.dims
+	if hasattr(dims, 'set_current_step'):
+		dims.set_current_step(0, sliceNum)
+	else:
+		dims.set_point(0, sliceNum)
+
+def moveShape(plugin, event):
+	"""
+	set the vertices of the shape a drag event moves, with the public layer.data setter
+
+	This is napari's work (it rebuilds the layer), replay() does it before timing the plugin callback
+	"""
+	layer = plugin.shapeLayer
+	data = list(layer.data)
+	data[event['index']] = np.asarray(event['data'], dtype=np.float64)
+	selected = layer.selected_data
+	layer.data = data
+	layer.selected_data = selected
+
+def dispatch(plugin, event):
+	""" do one script event, what napari would do for the user (see moveShape() for drag) """
+	layer = plugin.shapeLayer
+	mouseEvent = types.SimpleNamespace(type='mouse_move', pos=None)
+	if event['type'] == 'select':
+		selectShape(plugin, event['index'])
+		mouseEvent.type = 'mouse_press'
+		plugin.myMouseDown_Shape(layer, mouseEvent)
+	elif event['type'] == 'drag':
+		plugin.lineShapeChange_callback(layer, mouseEvent)
+	elif event['type'] == 'slice':
+		setSlice(plugin, event['slice'])
+	elif event['type'] == 'plotAll':
+		plugin.updatePlots(updatePolygons=True)
+	else:
+		print('dispatch() unknown event type:', event['type'])
+
+class Heartbeat:
+	""" Qt timer that records when it ticks, gaps between ticks are event loop stalls """
+	def __init__(self, interval):
+		from PyQt5 import QtCore
+		self.interval = interval # ms
+		self.ticks = []
+		self.timer = QtCore.QTimer()
+		self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+		self.timer.timeout.connect(self._tick)
+
+	def _tick(self):
+		self.ticks.append(time.perf_counter())
+
+	def start(self):
+		self.ticks = [time.perf_counter()]
+		self.timer.start(self.interval)
+
+	def stop(self):
+		self.timer.stop()
+		self._tick()
+
+	def gaps(self):
+		""" seconds between ticks """
+		return np.diff(self.ticks)
+
+def replay(plugin, events, interval=16, realtime=False, heartbeat=None):
+	"""
+	Replay events from the Qt event loop
+
+	Parameters:
+		interval: ms between the end of one event and the start of the next
+		realtime: use the recorded 'time' of each event instead of interval
+
+	Returns:
+		list of (event type, seconds), seconds is the callback and the repaint it causes
+	"""
+	from PyQt5 import QtCore, QtWidgets
+	app = QtWidgets.QApplication.instance()
+	loop = QtCore.QEventLoop()
+	latencies = []
+	state = {'next': 0}
+
+	def nextDelay(eventIdx):
+		if realtime and eventIdx > 0 and 'time' in events[eventIdx]:
+			return max(0, int(1000 * (events[eventIdx]['time'] - events[eventIdx-1]['time'])))
+		return interval
+
+	def doEvent():
+		eventIdx = state['next']
+		if eventIdx >= len(events):
+			loop.quit()
+			return
+		event = events[eventIdx]
+		if event['type'] == 'drag':
+			moveShape(plugin, event)
+		startTime = time.perf_counter()
+		dispatch(plugin, event)
+		app.processEvents() # repaint
+		latencies.append((event['type'], time.perf_counter() - startTime))
+		state['next'] += 1
+		delay = nextDelay(state['next']) if state['next'] < len(events) else 0
+		QtCore.QTimer.singleShot(delay, doEvent)
+
+	if heartbeat is not None:
+		heartbeat.start()
+	QtCore.QTimer.singleShot(0, doEvent)
+	loop.exec_()
+	if heartbeat is not None:
+		heartbeat.stop()
+	return latencies
+
+def addLatencyResult(results, name, params, times):
+	times = [float(t) for t in times]
+	percentiles = np.percentile(times, [50, 95, 99])
+	extra = {'p50': float(percentiles[0]), 'p95': float(percentiles[1]), 'p99': float(percentiles[2]),
+			'max': float(np.max(times)), 'numEvents': len(times)}
+	benchmarkAnalysis.addResult(results, name, params, times, extra=extra)
+	print('      p50:', round(extra['p50'], 5), 'p95:', round(extra['p95'], 5), 'p99:', round(extra['p99'], 5), 'max:', round(extra['max'], 5))
+
+def runInteraction(script, repeat=3, warmup=1, interval=16, realtime=False, heartbeatInterval=10, stall=50, verbose=False):
+	"""
+	Replay a script repeat times (after warmup times that are not kept)
+
+	Returns:
+		dict like benchmarkAnalysis.runBenchmarks(), one result per event type plus 'eventLoopGap'
+	"""
+	from PyQt5 import QtWidgets
+	app = QtWidgets.QApplication.instance()
+	if app is None:
+		app = QtWidgets.QApplication(sys.argv)
+
+	folder = tempfile.mkdtemp(prefix='shapeanalysis_interaction_')
+	results = []
+	try:
+		output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+		with output:
+			plugin = makePlugin(script, folder)
+			heartbeat = Heartbeat(heartbeatInterval)
+			latencies = []
+			gaps = []
+			for repeatIdx in range(warmup + repeat):
+				oneLatencies = replay(plugin, script['events'], interval=interval, realtime=realtime, heartbeat=heartbeat)
+				if repeatIdx >= warmup:
+					latencies += oneLatencies
+					gaps += heartbeat.gaps().tolist()
+			numImages = plugin.analysis.numImages
+			imageShape = plugin.analysis.imageShape
+			plugin.resultStore.close()
+
+		params = {'numImages': int(numImages), 'rows': int(imageShape[0]), 'cols': int(imageShape[1]),
+				'numShapes': len(script['shapes']), 'interval': interval}
+		for eventType in ['select', 'drag', 'slice', 'plotAll']:
+			times = [seconds for oneType, seconds in latencies if oneType == eventType]
+			if len(times) > 0:
+				addLatencyResult(results, 'interaction.' + eventType, params, times)
+
+		# event loop, stall is time beyond stall ms in each long gap
+		gaps = np.asarray(gaps)
+		stalls = gaps[gaps > stall / 1000]
+		extra = {'heartbeat': heartbeatInterval / 1000, 'stallThreshold': stall / 1000,
+				'numStalls': len(stalls), 'stallTime': float(np.sum(stalls - stall / 1000)),
+				'maxGap': float(np.max(gaps)) if len(gaps) > 0 else 0.0,
+				'p99': float(np.percentile(gaps, 99)) if len(gaps) > 0 else 0.0}
+		benchmarkAnalysis.addResult(results, 'interaction.eventLoopGap', params, gaps.tolist(), extra=extra)
+		print('      stalls:', extra['numStalls'], 'stall time:', round(extra['stallTime'], 3), 'sec, max gap:', round(extra['maxGap'], 3), 'sec')
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+
+	return {
+		'suite': 'interaction',
+		'environment': benchmarkAnalysis.environment(),
+		'repeat': repeat,
+		'results': results,
+	}
+
+def record(path, image):
+	"""
+	Open the plugin in a napari window and record what the user does into a script, saved on quit
+
+	Shapes in the script are the shapes when napari quits, do not delete shapes while recording
+	"""
+	import napari
+	from shapeanalysisplugin.ShapeAnalysisPlugin import ShapeAnalysisPlugin
+
+	folder = tempfile.mkdtemp(prefix='shapeanalysis_record_')
+	events = []
+	startTime = time.perf_counter()
+	def addEvent(event):
+		event['time'] = time.perf_counter() - startTime
+		events.append(event)
+
+	with napari.gui_qt():
+		plugin = ShapeAnalysisPlugin(imagePath=makeImageFile(image, folder))
+
+		myMouseDown_Shape = plugin.myMouseDown_Shape
+		def recordMouseDown(layer, event):
+			shapeType, index, data = plugin._getSelectedShape()
+			if index is not None:
+				addEvent({'type': 'select', 'index': int(index)})
+			myMouseDown_Shape(layer, event)
+		plugin.myMouseDown_Shape = recordMouseDown
+
+		lineShapeChange_callback = plugin.lineShapeChange_callback
+		def recordDrag(layer, event):
+			shapeType, index, data = plugin._getSelectedShape()
+			if shapeType == 'line':
+				addEvent({'type': 'drag', 'index': int(index), 'data': np.asarray(data).tolist()})
+			lineShapeChange_callback(layer, event)
+		plugin.lineShapeChange_callback = recordDrag
+
+		def recordSlider(event):
+			if event.axis == 0:
+				addEvent({'type': 'slice', 'slice': int(plugin.napariViewer.dims.indices[0])})
+		plugin.napariViewer.dims.events.axis.connect(recordSlider)
+
+	shapes = [{'shape_type': shapeType, 'data': np.asarray(data).tolist()}
+				for shapeType, data in zip(plugin.shapeList.shape_types, plugin.shapeList.data)]
+	saveScript(path, {'image': image, 'shapes': shapes, 'events': events})
+	shutil.rmtree(folder, ignore_errors=True)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Replay interaction with ShapeAnalysisPlugin and time it')
+	parser.add_argument('--script', default=None, help='json script to replay, default is scripted interaction on a synthetic stack')
+	parser.add_argument('--image', default=None, help='with --record, .tif file, default is a synthetic stack')
+	parser.add_argument('--size', default=None, help='synthetic stack as images,rows,cols e.g. 1000,256,256')
+	parser.add_argument('--record', default=None, help='record interaction in a napari window into this json script')
+	parser.add_argument('--save-script', default=None, help='save the scripted interaction to this json file and quit')
+	parser.add_argument('--output', default='interaction.json', help='json file to save results')
+	parser.add_argument('--repeat', type=int, default=3, help='times to replay the script')
+	parser.add_argument('--warmup', type=int, default=1, help='times to replay the script before timing')
+	parser.add_argument('--interval', type=int, default=16, help='ms between events')
+	parser.add_argument('--realtime', action='store_true', help='replay with the recorded time between events')
+	parser.add_argument('--heartbeat', type=int, default=10, help='ms between event loop heartbeat ticks')
+	parser.add_argument('--stall', type=int, default=50, help='ms between heartbeat ticks to count as a stall')
+	parser.add_argument('--verbose', action='store_true', help='show what the plugin prints')
+	args = parser.parse_args(argv)
+
+	image = dict(defaultImage)
+	if args.size is not None:
+		numImages, rows, cols = [int(value) for value in args.size.split(',')]
+		image = {'numImages': numImages, 'rows': rows, 'cols': cols}
+	if args.image is not None:
+		image = {'path': os.path.abspath(args.image)}
+
+	if args.record is not None:
+		record(args.record, image)
+		return
+
+	# offscreen unless asked for something else
+	os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+	if args.script is not None:
+		script = loadScript(args.script)
+	else:
+		script = scriptedInteraction(image)
+	if args.save_script is not None:
+		saveScript(args.save_script, script)
+		return
+
+	print('replaying', len(script['events']), 'events on', len(script['shapes']), 'shapes, image:', script['image'])
+	benchmark = runInteraction(script, repeat=args.repeat, warmup=args.warmup, interval=args.interval,
+								realtime=args.realtime, heartbeatInterval=args.heartbeat, stall=args.stall,
+								verbose=args.verbose)
+	with open(args.output, 'w') as f:
+		json.dump(benchmark, f, indent=1)
+	print('saved', len(benchmark['results']), 'results to:', args.output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,248 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Compare a benchmark run against a baseline, exit 1 if anything got significantly slower.
+
+A baseline is a json file saved by benchmarkAnalysis.py (or benchmarkInteraction.py), with the suite
+that saved it, the environment it ran in (cpu count, numpy/scipy versions, ...) and, for each benchmark,
+its params (stack size, mode) and the time of each repeat.
+
+A benchmark (same name and params in both runs) is a regression when
+	1) its median time is more than --threshold slower (default 20%, runs minutes apart on one machine differ by ~10%), and
+	2) the difference is not noise:
+		one sided Mann-Whitney U test of the repeat times, p < --alpha (default 0.05),
+		with too few repeats for the test to ever reach alpha, every new time has to be slower than every baseline time
+
+Usage:
+	# record a baseline, once, before an upgrade
+	python3 benchmarks/compareBenchmarks.py baseline.json --record --repeat 7
+
+	# after the upgrade, run the same benchmarks (sizes, modes, repeat) and compare
+	python3 benchmarks/compareBenchmarks.py baseline.json --output new.json
+
+	# or compare two saved runs, runs of benchmarkInteraction.py are always compared this way
+	python3 benchmarks/compareBenchmarks.py baseline.json new.json
+
+Exit code is 0 when nothing regressed, 1 on a regression, 2 when the baseline can not be read,
+its suite can not be run again, or the two runs are of different suites.
+"""
+
+import os, sys, json, argparse
+from math import comb
+
+import numpy as np
+import scipy.stats
+
+import benchmarkAnalysis
+
+# environment keys that change timings, compare with care when these differ
+hardwareKeys = ['machine', 'processor', 'cpuCount', 'platform']
+
+def loadBenchmark(path):
+	""" load a json file saved by benchmarkAnalysis.py, None on error """
+	if not os.path.isfile(path):
+		print('loadBenchmark() file not found:', path)
+		return None
+	try:
+		with open(path) as f:
+			benchmark = json.load(f)
+	except ValueError as e:
+		print('loadBenchmark() error reading json:', path, e)
+		return None
+	if 'results' not in benchmark:
+		print('loadBenchmark() error: not a benchmark file, no results:', path)
+		return None
+	return benchmark
+
+def benchmarkSuite(benchmark):
+	""" return the suite that saved a benchmark, 'analysis' or 'interaction' """
+	suite = benchmark.get('suite', None)
+	if suite is None:
+		# saved before we had suites
+		isInteraction = any(result['name'].startswith('interaction.') for result in benchmark['results'])
+		suite = 'interaction' if isInteraction else 'analysis'
+	return suite
+
+def saveBenchmark(path, benchmark):
+	with open(path, 'w') as f:
+		json.dump(benchmark, f, indent=1)
+	print('saved', len(benchmark['results']), 'results to:', path)
+
+def resultKey(result):
+	""" a benchmark is the same in two runs if it has the same name and params """
+	return result['name'] + ' ' + json.dumps(result['params'], sort_keys=True)
+
+def compareEnvironment(baseline, new):
+	"""
+	Print what is different between the environment of two runs
+
+	Returns:
+		list of hardware keys that differ
+	"""
+	baseEnvironment = baseline.get('environment', {})
+	newEnvironment = new.get('environment', {})
+	differ = []
+	for key in sorted(set(baseEnvironment.keys()) | set(newEnvironment.keys())):
+		if key == 'date':
+			continue
+		baseValue = baseEnvironment.get(key, None)
+		newValue = newEnvironment.get(key, None)
+		if baseValue != newValue:
+			print('  ', key.ljust(12), baseValue, '->', newValue)
+			if key in hardwareKeys:
+				differ.append(key)
+	if len(differ) > 0:
+		print('   warning: hardware differs (' + ', '.join(differ) + '), times may not be comparable')
+	return differ
+
+def isSlower(baseTimes, newTimes, alpha):
+	"""
+	Return (significant, pValue) where significant is True if newTimes are slower than baseTimes, not by chance
+
+	pValue is None when there are too few repeats for the test, then every new time has to be slower than every base time
+	"""
+	numBase = len(baseTimes)
+	numNew = len(newTimes)
+	# smallest p value a one sided exact test can give for these sample sizes
+	if numBase == 0 or numNew == 0 or 1 / comb(numBase + numNew, numBase) >= alpha:
+		return min(newTimes) > max(baseTimes), None
+	statistic, pValue = scipy.stats.mannwhitneyu(newTimes, baseTimes, alternative='greater')
+	return pValue < alpha, float(pValue)
+
+def compareResults(baseline, new, threshold=0.2, alpha=0.05):
+	"""
+	Compare each benchmark in new with the same benchmark in baseline
+
+	Parameters:
+		baseline, new: dict loaded from benchmarkAnalysis.py json
+		threshold: fraction slower (median) to be a regression
+		alpha: significance level
+
+	Returns:
+		list of dict, one per benchmark in both, with
+			'name', 'params', 'baseMedian', 'newMedian', 'ratio', 'pValue', 'status'
+			status is one of ('regression', 'improvement', 'same')
+	"""
+	baseResults = {resultKey(result): result for result in baseline['results']}
+	comparisons = []
+	for result in new['results']:
+		baseResult = baseResults.get(resultKey(result), None)
+		if baseResult is None:
+			continue
+		baseMedian = float(np.median(baseResult['times']))
+		newMedian = float(np.median(result['times']))
+		ratio = newMedian / baseMedian if baseMedian > 0 else np.inf
+		status = 'same'
+		pValue = None
+		if ratio > 1 + threshold:
+			slower, pValue = isSlower(baseResult['times'], result['times'], alpha)
+			if slower:
+				status = 'regression'
+		elif ratio < 1 / (1 + threshold):
+			faster, pValue = isSlower(result['times'], baseResult['times'], alpha)
+			if faster:
+				status = 'improvement'
+		comparisons.append({
+			'name': result['name'],
+			'params': result['params'],
+			'baseMedian': baseMedian,
+			'newMedian': newMedian,
+			'ratio': ratio,
+			'pValue': pValue,
+			'status': status,
+		})
+	return comparisons
+
+def printComparisons(comparisons):
+	for comparison in comparisons:
+		pValue = '' if comparison['pValue'] is None else 'p=' + str(round(comparison['pValue'], 4))
+		print('  ', comparison['name'].ljust(26), json.dumps(comparison['params']).ljust(60),
+			str(round(comparison['baseMedian'], 5)).rjust(9), '->', str(round(comparison['newMedian'], 5)).rjust(9), 'sec',
+			('x' + str(round(comparison['ratio'], 2))).rjust(6), pValue.ljust(9), comparison['status'])
+
+def missingResults(baseline, new):
+	""" return list of result keys in one run and not the other """
+	baseKeys = set(resultKey(result) for result in baseline['results'])
+	newKeys = set(resultKey(result) for result in new['results'])
+	return sorted(baseKeys ^ newKeys)
+
+def rerun(baseline, verbose=False):
+	"""
+	run the benchmarks of a baseline again, same sizes, modes and repeat
+
+	Only benchmarkAnalysis.py runs can be run again, an interaction run depends on its script and
+	replay options that are not in the json. Returns None if we can not run the suite.
+	"""
+	suite = benchmarkSuite(baseline)
+	if suite != 'analysis':
+		print('rerun() error: can not run the', repr(suite), 'suite again, run it yourself and compare the two json files')
+		return None
+	sizes = [(numImages, tuple(imageShape)) for numImages, imageShape in baseline.get('sizes', [])]
+	if len(sizes) == 0:
+		# baseline from before we saved sizes, get them from results
+		sizes = sorted(set((result['params']['numImages'], (result['params']['rows'], result['params']['cols']))
+						for result in baseline['results']))
+	modes = baseline.get('modes', ['single', 'multi'])
+	repeat = baseline.get('repeat', 3)
+	return benchmarkAnalysis.runBenchmarks(sizes=sizes, modes=modes, repeat=repeat, verbose=verbose)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Compare ShapeAnalysisPlugin benchmarks against a baseline')
+	parser.add_argument('baseline', help='baseline json file from benchmarkAnalysis.py')
+	parser.add_argument('new', nargs='?', default=None, help='json file to compare, if not given run the benchmarks of the baseline')
+	parser.add_argument('--record', action='store_true', help='run benchmarks and save them as the baseline')
+	parser.add_argument('--repeat', type=int, default=5, help='with --record, times to run each benchmark')
+	parser.add_argument('--quick', action='store_true', help='with --record, one small stack')
+	parser.add_argument('--output', default=None, help='save the new run to this json file')
+	parser.add_argument('--threshold', type=float, default=0.2, help='fraction slower to be a regression')
+	parser.add_argument('--alpha', type=float, default=0.05, help='significance level')
+	parser.add_argument('--verbose', action='store_true', help='show what analysis prints')
+	args = parser.parse_args(argv)
+
+	if args.record:
+		sizes = benchmarkAnalysis.quickSizes if args.quick else benchmarkAnalysis.defaultSizes
+		benchmark = benchmarkAnalysis.runBenchmarks(sizes=sizes, repeat=args.repeat, verbose=args.verbose)
+		saveBenchmark(args.baseline, benchmark)
+		return 0
+
+	baseline = loadBenchmark(args.baseline)
+	if baseline is None:
+		return 2
+
+	if args.new is None:
+		new = rerun(baseline, verbose=args.verbose)
+		if new is None:
+			return 2
+		if args.output is not None:
+			saveBenchmark(args.output, new)
+	else:
+		new = loadBenchmark(args.new)
+		if new is None:
+			return 2
+		if benchmarkSuite(new) != benchmarkSuite(baseline):
+			print('error: new run is from the', repr(benchmarkSuite(new)), 'suite, baseline is from the', repr(benchmarkSuite(baseline)), 'suite')
+			return 2
+
+	print('environment changes:')
+	compareEnvironment(baseline, new)
+
+	missing = missingResults(baseline, new)
+	if len(missing) > 0:
+		print('not in both runs:')
+		for key in missing:
+			print('  ', key)
+
+	comparisons = compareResults(baseline, new, threshold=args.threshold, alpha=args.alpha)
+	print('benchmarks, baseline -> new median:')
+	printComparisons(comparisons)
+
+	regressions = [comparison for comparison in comparisons if comparison['status'] == 'regression']
+	if len(regressions) > 0:
+		print('***', len(regressions), 'of', len(comparisons), 'benchmarks are slower than baseline')
+		return 1
+	print('no regressions in', len(comparisons), 'benchmarks')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,160 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Named timers and counters for the analysis hot paths, off by default.
+
+Stages are named 'stage' or 'stage.detail', stages we use are
+	read, filter, rasterize, sample, fit, reduce, plot, save, load
+
+	from Instrumentation import timer, count
+
+	with timer('fit'):
+		popt = ...
+	count('sample.slices', numImages)
+
+When disabled, timer() returns one shared do nothing context manager and count() returns
+right away, the cost is one function call.
+
+Enable in code with enable(), or without changing code with an environment variable:
+
+	SHAPEANALYSIS_INSTRUMENT=1: enable, summary is logged at exit
+	SHAPEANALYSIS_INSTRUMENT=/path/to/file.json (or .csv): enable, report is saved at exit
+
+Timers in multiprocessing workers stay in the worker, time the whole pool in the parent.
+"""
+
+import os, time, json, csv, atexit, logging, threading, functools
+
+logger = logging.getLogger('shapeanalysisplugin')
+
+enabled = False
+
+_lock = threading.Lock()
+_timers = {} # name: [count, total, min, max] in seconds
+_counters = {} # name: total
+
+class _NullTimer:
+	""" timer() when disabled """
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		return False
+
+_nullTimer = _NullTimer()
+
+class _Timer:
+	def __init__(self, name):
+		self.name = name
+	def __enter__(self):
+		self.startTime = time.perf_counter()
+		return self
+	def __exit__(self, *args):
+		addTime(self.name, time.perf_counter() - self.startTime)
+		return False
+
+def enable(on=True):
+	""" turn timers and counters on (or off), what we have so far is kept, see reset() """
+	global enabled
+	enabled = on
+
+def timer(name):
+	""" return a context manager that adds its elapsed time to timer name """
+	if not enabled:
+		return _nullTimer
+	return _Timer(name)
+
+def timed(name):
+	""" decorator, add the time of each call to timer name """
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return func(*args, **kwargs)
+			with _Timer(name):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def addTime(name, seconds):
+	""" add one elapsed time to timer name """
+	if not enabled:
+		return
+	with _lock:
+		oneTimer = _timers.get(name, None)
+		if oneTimer is None:
+			_timers[name] = [1, seconds, seconds, seconds]
+		else:
+			oneTimer[0] += 1
+			oneTimer[1] += seconds
+			oneTimer[2] = min(oneTimer[2], seconds)
+			oneTimer[3] = max(oneTimer[3], seconds)
+
+def count(name, n=1):
+	""" add n to counter name """
+	if not enabled:
+		return
+	with _lock:
+		_counters[name] = _counters.get(name, 0) + n
+
+def reset():
+	""" clear all timers and counters """
+	with _lock:
+		_timers.clear()
+		_counters.clear()
+
+def report():
+	"""
+	Returns:
+		dict with
+			'timers': dict of name: dict of (count, total, mean, min, max) in seconds
+			'counters': dict of name: total
+	"""
+	with _lock:
+		timers = {}
+		for name, (n, total, theMin, theMax) in sorted(_timers.items()):
+			timers[name] = {'count': n, 'total': total, 'mean': total / n, 'min': theMin, 'max': theMax}
+		counters = dict(sorted(_counters.items()))
+	return {'timers': timers, 'counters': counters}
+
+def saveJson(path):
+	""" save report() as json """
+	with open(path, 'w') as f:
+		json.dump(report(), f, indent=1)
+
+def saveCsv(path):
+	""" save report() as csv, one row per timer and counter """
+	theReport = report()
+	with open(path, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['type', 'name', 'count', 'total', 'mean', 'min', 'max'])
+		for name, oneTimer in theReport['timers'].items():
+			writer.writerow(['timer', name, oneTimer['count'], oneTimer['total'], oneTimer['mean'], oneTimer['min'], oneTimer['max']])
+		for name, total in theReport['counters'].items():
+			writer.writerow(['counter', name, total, total, '', '', ''])
+
+def logReport(theLogger=None, level=logging.INFO):
+	""" log one line per timer and counter, default logger is 'shapeanalysisplugin' """
+	if theLogger is None:
+		theLogger = logger
+	theReport = report()
+	for name, oneTimer in theReport['timers'].items():
+		theLogger.log(level, 'timer %s count %d total %.4f mean %.6f min %.6f max %.6f', name,
+			oneTimer['count'], oneTimer['total'], oneTimer['mean'], oneTimer['min'], oneTimer['max'])
+	for name, total in theReport['counters'].items():
+		theLogger.log(level, 'counter %s %s', name, total)
+
+def _saveAtExit(path):
+	if path.endswith('.csv'):
+		saveCsv(path)
+	elif path.endswith('.json'):
+		saveJson(path)
+	else:
+		if not logger.hasHandlers():
+			logging.basicConfig(level=logging.INFO)
+		logReport()
+
+_environment = os.environ.get('SHAPEANALYSIS_INSTRUMENT', '')
+if _environment not in ['', '0']:
+	enable()
+	atexit.register(_saveAtExit, _environment)
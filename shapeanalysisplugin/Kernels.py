@@ -0,0 +1,354 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Optional compiled (numba) kernels for the hot loops of ShapeAnalysis, with NumPy fallbacks.
+
+	gatherSegmentStats(): min/max/mean (and sum, n, sd) of many polygons in a block of images,
+		each pixel is read from the image where it is, no (images, pixels) array of gathered values
+	gatherFrameStats(): per image min/max/sum/sum of squares/count of one polygon,
+		for the per frame cache of an edited polygon (ShapeAnalysis._gatherStats)
+	profileFWHM(): FWHM() of many line profiles, 3 point median filter and threshold crossings
+		without temporary arrays
+
+All loop over images (profiles) in parallel with numba.prange.
+
+Results are the same (bit for bit) as the NumPy path. Sums are float64 in the order NumPy adds
+a float64 array: np.sum() is the pairwise sum (numpy pairwise summation, blocks of 8 with 8 accumulators),
+np.add.reduceat() is the first value plus the pairwise sum of the rest. NumPy does not say which zero
+np.fmin/np.fmax return when -0 and 0 tie, a zero min/max is +0 in both paths. See tests/test_kernels.py,
+without numba the tests run the kernels as plain python.
+
+Kernels are used when numba is installed, turn them off with enable(False) or without changing code:
+
+	SHAPEANALYSIS_NUMBA=0
+"""
+
+import os
+import numpy as np
+import scipy.ndimage
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+enabled = numba is not None and os.environ.get('SHAPEANALYSIS_NUMBA', '') != '0'
+
+def enable(on=True):
+	""" use compiled kernels (or not), only if numba is installed """
+	global enabled
+	if on and numba is None:
+		print('Kernels.enable() numba is not installed, using NumPy')
+	enabled = on and numba is not None
+
+def useKernels(dtype):
+	"""
+	True if compiled kernels are on and handle values of dtype,
+	pixels are converted to float64 so 64 bit integers are left to NumPy
+	"""
+	dtype = np.dtype(dtype)
+	return enabled and (dtype.kind == 'f' and dtype.itemsize in [4, 8] or dtype.kind in 'iub' and dtype.itemsize <= 4)
+
+if numba is not None:
+	_jit = numba.njit(cache=True, error_model='numpy')
+	_jitParallel = numba.njit(cache=True, parallel=True, error_model='numpy')
+	prange = numba.prange
+else:
+	# plain python, only used to test the kernels against NumPy (tests/test_kernels.py)
+	_jit = _jitParallel = lambda func: func
+	prange = range
+
+#
+# polygon statistics
+#
+
+@_jit
+def _pixel(image, flatIdx, i, hasNan, mean, squares):
+	""" float64 value of pixel i of flatIdx, 0 if not finite (hasNan), (value - mean)**2 if squares """
+	value = np.float64(image[flatIdx[i]])
+	if hasNan and not np.isfinite(value):
+		return 0.0
+	if squares:
+		value = value - mean
+		value = value * value
+	return value
+
+@_jit
+def _pairwiseSum(image, flatIdx, start, n, hasNan, mean, squares):
+	""" sum of n pixels from start, numpy pairwise_sum() """
+	if n < 8:
+		result = -0.0
+		for i in range(start, start + n):
+			result += _pixel(image, flatIdx, i, hasNan, mean, squares)
+		return result
+	elif n <= 128:
+		r0 = _pixel(image, flatIdx, start, hasNan, mean, squares)
+		r1 = _pixel(image, flatIdx, start + 1, hasNan, mean, squares)
+		r2 = _pixel(image, flatIdx, start + 2, hasNan, mean, squares)
+		r3 = _pixel(image, flatIdx, start + 3, hasNan, mean, squares)
+		r4 = _pixel(image, flatIdx, start + 4, hasNan, mean, squares)
+		r5 = _pixel(image, flatIdx, start + 5, hasNan, mean, squares)
+		r6 = _pixel(image, flatIdx, start + 6, hasNan, mean, squares)
+		r7 = _pixel(image, flatIdx, start + 7, hasNan, mean, squares)
+		i = 8
+		while i < n - n % 8:
+			r0 += _pixel(image, flatIdx, start + i, hasNan, mean, squares)
+			r1 += _pixel(image, flatIdx, start + i + 1, hasNan, mean, squares)
+			r2 += _pixel(image, flatIdx, start + i + 2, hasNan, mean, squares)
+			r3 += _pixel(image, flatIdx, start + i + 3, hasNan, mean, squares)
+			r4 += _pixel(image, flatIdx, start + i + 4, hasNan, mean, squares)
+			r5 += _pixel(image, flatIdx, start + i + 5, hasNan, mean, squares)
+			r6 += _pixel(image, flatIdx, start + i + 6, hasNan, mean, squares)
+			r7 += _pixel(image, flatIdx, start + i + 7, hasNan, mean, squares)
+			i += 8
+		result = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+		while i < n:
+			result += _pixel(image, flatIdx, start + i, hasNan, mean, squares)
+			i += 1
+		return result
+	else:
+		n2 = n // 2
+		n2 -= n2 % 8
+		return _pairwiseSum(image, flatIdx, start, n2, hasNan, mean, squares) + \
+			_pairwiseSum(image, flatIdx, start + n2, n - n2, hasNan, mean, squares)
+
+@_jit
+def _segmentSum(image, flatIdx, start, n, hasNan, mean, squares):
+	""" sum of n pixels from start, like np.add.reduceat() of float64 """
+	first = _pixel(image, flatIdx, start, hasNan, mean, squares)
+	if n == 1:
+		return first
+	return first + _pairwiseSum(image, flatIdx, start + 1, n - 1, hasNan, mean, squares)
+
+@_jitParallel
+def _anyNanKernel(images, flatIdx):
+	rowHasNan = np.zeros(images.shape[0], dtype=np.bool_)
+	for row in prange(images.shape[0]):
+		image = images[row]
+		for i in range(len(flatIdx)):
+			if np.isnan(image[flatIdx[i]]):
+				rowHasNan[row] = True
+				break
+	return rowHasNan.any()
+
+# squaresMode of _segmentStatsKernel()
+_noSquares = 0
+_deviationSquares = 1 # sum of (value - mean of segment)**2, for sd
+_valueSquares = 2 # sum of value**2
+
+@_jit
+def _sum(image, flatIdx, start, n, hasNan, mean, squares, pairwise):
+	""" sum of n pixels from start, like np.sum() if pairwise else like np.add.reduceat() """
+	if pairwise:
+		return _pairwiseSum(image, flatIdx, start, n, hasNan, mean, squares)
+	return _segmentSum(image, flatIdx, start, n, hasNan, mean, squares)
+
+@_jitParallel
+def _segmentStatsKernel(images, flatIdx, starts, lengths, hasNan, squaresMode, pairwise, theMin, theMax, sums, counts, squares):
+	"""
+	min/max/sum/count (and sum of squares, see squaresMode) of each (image, segment),
+	segments are not empty, hasNan: ignore values that are not finite
+	"""
+	for row in prange(images.shape[0]):
+		image = images[row]
+		for segment in range(len(starts)):
+			start = starts[segment]
+			length = lengths[segment]
+			# np.fmin/np.fmax: nan only if all nan
+			minValue = np.float64(image[flatIdx[start]])
+			maxValue = minValue
+			count = 0
+			for i in range(start, start + length):
+				value = np.float64(image[flatIdx[i]])
+				if value < minValue or minValue != minValue:
+					minValue = value
+				if value > maxValue or maxValue != maxValue:
+					maxValue = value
+				if not hasNan or np.isfinite(value):
+					count += 1
+			# a zero min/max is +0 like the NumPy path
+			theMin[row, segment] = minValue + 0.0
+			theMax[row, segment] = maxValue + 0.0
+			counts[row, segment] = count
+			theSum = _sum(image, flatIdx, start, length, hasNan, 0.0, False, pairwise)
+			sums[row, segment] = theSum
+			if squaresMode == _deviationSquares:
+				# nan for all nan, np.float64 so plain python does too
+				mean = np.float64(theSum) / count
+				squares[row, segment] = _sum(image, flatIdx, start, length, hasNan, mean, True, pairwise)
+			elif squaresMode == _valueSquares:
+				squares[row, segment] = _sum(image, flatIdx, start, length, hasNan, 0.0, True, pairwise)
+
+def _segmentStats(images, flatIdx, starts, lengths, hasNan, squaresMode, pairwise, minMaxDtype):
+	"""
+	Run _segmentStatsKernel() on (..., pixels) images
+
+	Returns:
+		theMin, theMax, sums, counts, squares: (..., segments), squares is None for _noSquares
+	"""
+	leadingShape = images.shape[:-1]
+	images = np.ascontiguousarray(images.reshape((-1, images.shape[-1])))
+	flatIdx = np.ascontiguousarray(flatIdx, dtype=np.int64)
+	starts = np.ascontiguousarray(starts, dtype=np.int64)
+	lengths = np.ascontiguousarray(lengths, dtype=np.int64)
+	shape = (images.shape[0], len(starts))
+	theMin = np.empty(shape, dtype=minMaxDtype)
+	theMax = np.empty(shape, dtype=minMaxDtype)
+	sums = np.empty(shape)
+	counts = np.empty(shape, dtype=np.int64)
+	squares = np.empty(shape) if squaresMode != _noSquares else np.empty((0, 0))
+	if hasNan is None:
+		hasNan = images.dtype.kind == 'f' and bool(_anyNanKernel(images, flatIdx))
+	_segmentStatsKernel(images, flatIdx, starts, lengths, hasNan, squaresMode, pairwise, theMin, theMax, sums, counts, squares)
+	resultShape = leadingShape + (len(starts),)
+	if squaresMode == _noSquares:
+		squares = None
+	else:
+		squares = squares.reshape(resultShape)
+	return theMin.reshape(resultShape), theMax.reshape(resultShape), sums.reshape(resultShape), counts.reshape(resultShape), squares
+
+def gatherSegmentStats(images, flatIdx, starts, lengths, stats=()):
+	"""
+	segmentStats() of pixels gathered from images, without order statistics
+
+	Same as segmentStats(np.take(images, flatIdx, axis=-1), starts, lengths, stats)
+	but each pixel is read from its image, only use when useKernels(images.dtype)
+
+	Parameters:
+		images: (..., pixels) e.g. (images, rows*cols) or (images, channels, rows*cols)
+		flatIdx: 1d int, flat pixel index of all segments, concatenated
+		starts: 1d int, start of each segment in flatIdx (not empty)
+		lengths: 1d int, number of pixels in each segment
+		stats: list of 'sd', 'n', 'sum'
+
+	Returns:
+		dict of 'min', 'max', 'mean' and each of stats, (..., segments)
+	"""
+	squaresMode = _deviationSquares if 'sd' in stats else _noSquares
+	# min/max keep the dtype of the pixels like np.fmin.reduceat()
+	theMin, theMax, sums, counts, squares = _segmentStats(images, flatIdx, starts, lengths,
+						None, squaresMode, False, images.dtype)
+	results = {}
+	results['min'] = theMin
+	results['max'] = theMax
+	with np.errstate(invalid='ignore', divide='ignore'):
+		results['mean'] = sums / counts
+		if 'sd' in stats:
+			results['sd'] = np.sqrt(squares / counts)
+	if 'sum' in stats:
+		results['sum'] = sums
+	if 'n' in stats:
+		results['n'] = counts
+	return results
+
+def gatherFrameStats(images, flatIdx):
+	"""
+	Per image stats of some pixels, like ShapeAnalysis._gatherStats() of one block, values that are not finite are ignored
+
+	Only use when useKernels(images.dtype)
+
+	Parameters:
+		images: (..., pixels) e.g. (images, rows*cols) or (images, channels, rows*cols)
+		flatIdx: 1d int, flat pixel index (not empty)
+
+	Returns:
+		dict of 'min', 'max', 'sum', 'sumSquares', 'count', each (...) float64 (count is int64)
+	"""
+	theMin, theMax, sums, counts, squares = _segmentStats(images, flatIdx, [0], [len(flatIdx)],
+						images.dtype.kind == 'f', _valueSquares, True, np.float64)
+	return {
+		'min': theMin[..., 0],
+		'max': theMax[..., 0],
+		'sum': sums[..., 0],
+		'sumSquares': squares[..., 0],
+		'count': counts[..., 0],
+	}
+
+#
+# full width at half max of line profiles
+#
+
+@_jit
+def _median3(profile, i, numPoints):
+	""" median of profile[i-1:i+2], zero padded like scipy.signal.medfilt() """
+	before = np.float64(profile[i - 1]) if i > 0 else 0.0
+	value = np.float64(profile[i])
+	after = np.float64(profile[i + 1]) if i < numPoints - 1 else 0.0
+	return max(min(before, value), min(max(before, value), after))
+
+@_jitParallel
+def _fwhmKernel(profiles, factor, roundFloat32, fwhm, left, right):
+	numPoints = profiles.shape[1]
+	for row in prange(profiles.shape[0]):
+		profile = profiles[row]
+		hasNan = False
+		maxValue = -np.inf
+		for i in range(numPoints):
+			if np.isnan(profile[i]):
+				hasNan = True
+				break
+			value = _median3(profile, i, numPoints)
+			if value > maxValue:
+				maxValue = value
+		if hasNan:
+			continue
+		threshold = maxValue * factor
+		if roundFloat32:
+			# float32 profile times 0.7 is float32
+			threshold = np.float64(np.float32(threshold))
+		first = -1
+		last = -1
+		numAbove = 0
+		for i in range(numPoints):
+			if _median3(profile, i, numPoints) > threshold:
+				if first < 0:
+					first = i
+				last = i
+				numAbove += 1
+		if numAbove > 2:
+			left[row] = first
+			right[row] = last
+			fwhm[row] = last - first
+
+def profileFWHM(profiles):
+	"""
+	FWHM() of many profiles, x of each profile is the point index 0, 1, 2, ...
+
+	Parameters:
+		profiles: (..., points)
+
+	Returns:
+		fwhm, left, right: (...) float64, nan if not found or the profile has nan
+	"""
+	leadingShape = profiles.shape[:-1]
+	numPoints = profiles.shape[-1]
+	flatProfiles = np.ascontiguousarray(profiles.reshape((-1, numPoints)))
+	numProfiles = flatProfiles.shape[0]
+	fwhm = np.full(numProfiles, np.nan)
+	left = np.full(numProfiles, np.nan)
+	right = np.full(numProfiles, np.nan)
+	if numProfiles > 0 and numPoints > 0:
+		if useKernels(profiles.dtype) and profiles.dtype.kind == 'f':
+			factor = float(profiles.dtype.type(0.7))
+			_fwhmKernel(flatProfiles, factor, bool(profiles.dtype == np.float32), fwhm, left, right)
+		else:
+			_numpyFWHM(flatProfiles, fwhm, left, right)
+	return fwhm.reshape(leadingShape), left.reshape(leadingShape), right.reshape(leadingShape)
+
+def _numpyFWHM(profiles, fwhm, left, right):
+	""" profileFWHM() of (profiles, points) with NumPy, fill in fwhm/left/right """
+	numPoints = profiles.shape[1]
+	# scipy.signal.medfilt(profile, 3) of each row
+	filtered = scipy.ndimage.rank_filter(profiles, 1, size=(1, 3), mode='constant')
+	# like max(profile) * 0.7, float32 profiles have a float32 threshold
+	threshold = filtered.max(axis=1) * 0.7
+	above = filtered > threshold[:, np.newaxis]
+	found = np.count_nonzero(above, axis=1) > 2
+	if profiles.dtype.kind == 'f':
+		found &= ~np.isnan(profiles).any(axis=1)
+	first = np.argmax(above, axis=1)
+	last = numPoints - 1 - np.argmax(above[:, ::-1], axis=1)
+	left[found] = first[found]
+	right[found] = last[found]
+	fwhm[found] = (last - first)[found]
@@ -0,0 +1,75 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Min/max decimation of long traces (diameter, polygon mean) for plotting.
+
+A 100k slice trace is much wider than the plot in pixels. We precompute the min and max of
+blocks of 4, 16, 64, ... slices once. When plotting we pick the level with about one block per
+pixel and plot the (min, max) of each block, peaks are never hidden.
+"""
+
+import numpy as np
+
+class MinMaxPyramid:
+	def __init__(self, y, factor=4, minLength=256):
+		"""
+		Parameters:
+			y: 1d ndarray, the trace (nan is ok)
+			factor: number of blocks in one level that make one block in the next level
+			minLength: stop making levels when a level has fewer blocks than this
+		"""
+		self.y = np.asarray(y)
+		self.factor = factor
+		self.levels = [] # list of (blockSize, mins, maxs), block size increases
+
+		mins = self.y
+		maxs = self.y
+		blockSize = 1
+		while len(mins) > minLength:
+			numBlocks = int(np.ceil(len(mins) / factor))
+			padding = numBlocks * factor - len(mins)
+			if padding > 0:
+				mins = np.concatenate([mins, np.full(padding, np.nan, dtype=mins.dtype)])
+				maxs = np.concatenate([maxs, np.full(padding, np.nan, dtype=maxs.dtype)])
+			# fmin/fmax ignore nan (a block of all nan is nan)
+			mins = np.fmin.reduce(mins.reshape(numBlocks, factor), axis=1)
+			maxs = np.fmax.reduce(maxs.reshape(numBlocks, factor), axis=1)
+			blockSize *= factor
+			self.levels.append((blockSize, mins, maxs))
+
+	def __len__(self):
+		return len(self.y)
+
+	def get(self, xMin, xMax, numPixels):
+		"""
+		Return (x, y) to plot slices xMin..xMax with about one (min, max) pair per pixel
+
+		Parameters:
+			xMin, xMax: visible range of slices
+			numPixels: width of the plot in pixels
+		"""
+		start = int(max(0, np.floor(xMin)))
+		stop = int(min(len(self.y), np.ceil(xMax) + 1))
+		if stop <= start:
+			return np.zeros(0), np.zeros(0, dtype=self.y.dtype)
+		numPixels = max(1, int(numPixels))
+
+		if stop - start <= 2 * numPixels or len(self.levels) == 0:
+			return np.arange(start, stop), self.y[start:stop]
+
+		# finest level with at most numPixels blocks visible
+		for blockSize, mins, maxs in self.levels:
+			if (stop - start) / blockSize <= numPixels:
+				break
+		firstBlock = start // blockSize
+		lastBlock = int(np.ceil(stop / blockSize))
+		mins = mins[firstBlock:lastBlock]
+		maxs = maxs[firstBlock:lastBlock]
+
+		# each block is a vertical line from its min to its max
+		x = np.repeat(np.arange(firstBlock, firstBlock + len(mins)) * blockSize + blockSize / 2, 2)
+		y = np.empty(2 * len(mins), dtype=mins.dtype)
+		y[0::2] = mins
+		y[1::2] = maxs
+		return x, y
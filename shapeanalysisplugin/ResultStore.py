@@ -0,0 +1,64 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Allocate analysis result arrays, large ones are disk backed np.memmap.
+
+A line across 200k slices x 300 points is a 240 MB float32 kymograph. With a ResultStore
+these live in a temporary folder on disk rather than in RAM and are paged in as they are used.
+
+On macOS/Linux the memmap file is unlinked as soon as it is created,
+the disk space is returned when the last reference to the array goes away.
+"""
+
+import os, tempfile, shutil
+import numpy as np
+
+class ResultStore:
+	def __init__(self, folder=None, memmapMinBytes=64 * 1024**2):
+		"""
+		Parameters:
+			folder: folder for memmap files, if None then a new temporary folder
+			memmapMinBytes: arrays at least this big are memmap, smaller ones are in RAM
+		"""
+		self.folder = folder
+		self.memmapMinBytes = memmapMinBytes
+		self._myFolder = None # temporary folder we made (and remove in close)
+		self._numFiles = 0
+
+	def _getFolder(self):
+		if self.folder is not None:
+			return self.folder
+		if self._myFolder is None:
+			self._myFolder = tempfile.mkdtemp(prefix='shapeanalysis_')
+		return self._myFolder
+
+	def allocate(self, shape, dtype=np.float32, fill=np.nan):
+		"""
+		Return a new array filled with fill, a np.memmap if it is big
+
+		Parameters:
+			shape: tuple, e.g. (slices, points)
+		"""
+		dtype = np.dtype(dtype)
+		numBytes = int(np.prod(shape)) * dtype.itemsize
+		if numBytes < self.memmapMinBytes:
+			return np.full(shape, fill, dtype=dtype)
+
+		path = os.path.join(self._getFolder(), 'result' + str(self._numFiles) + '.dat')
+		self._numFiles += 1
+		theArray = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+		if os.name == 'posix':
+			# the mapping stays valid, the file is gone when theArray is
+			os.unlink(path)
+		# fill in blocks of rows so we never touch all pages at once
+		blockRows = max(1, self.memmapMinBytes // max(1, numBytes // shape[0]))
+		for start in range(0, shape[0], blockRows):
+			theArray[start:start+blockRows] = fill
+		return theArray
+
+	def close(self):
+		""" remove our temporary folder, arrays from allocate() are not valid after this on Windows """
+		if self._myFolder is not None:
+			shutil.rmtree(self._myFolder, ignore_errors=True)
+			self._myFolder = None
@@ -0,0 +1,160 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Make many shapes (roi) at once, without napari/Qt.
+
+Each function returns a ShapeList of new shapes (no analysis), add them to the plugin
+with ShapeAnalysisPlugin.addShapes() (one napari shapesLayer.add() and one pass over the stack)
+or analyze them in a script with ShapeAnalysis.stackMultiPolygonAnalysis().
+
+	gridRectangles(): a grid of rectangles over a region of the image
+	shapesFromCsv(): polygons from a csv file with columns (roi, row, col)
+	shapesFromLabelImage(): one polygon per label of a label image (0 is background)
+	importShapes(): any of the above (and our own .h5 files) based on file extension
+"""
+
+import os
+import numpy as np
+
+import scipy.ndimage
+from skimage.measure import find_contours, approximate_polygon
+
+try:
+	from .ShapeList import ShapeList
+	from .ShapeFile import loadShapeFile
+except ImportError:
+	# when ShapeAnalysisPlugin.py is run as a script
+	from ShapeList import ShapeList
+	from ShapeFile import loadShapeFile
+
+# drawing parameters of new shapes, same as user keyboard 'r' in ShapeAnalysisPlugin
+defaultRectangleStyle = {'edge_width': 3, 'opacity': 0.2}
+
+def rectangleVertices(top, left, bottom, right):
+	""" return (4,2) vertices of an axis aligned rectangle, in napari order """
+	return np.array([[top, left], [top, right], [bottom, right], [bottom, left]], dtype=np.float64)
+
+def gridRectangles(region, roiSize, spacing=0, shapeList=None):
+	"""
+	Make a grid of rectangles that fill a region
+
+	Parameters:
+		region: (top, left, bottom, right) in image pixels
+		roiSize: (height, width) of each rectangle
+		spacing: pixels between rectangles
+		shapeList: append to this ShapeList, if None then a new one
+
+	Returns:
+		ShapeList
+	"""
+	if shapeList is None:
+		shapeList = ShapeList()
+	top, left, bottom, right = region
+	height, width = roiSize
+	for rowStart in np.arange(top, bottom - height + 1, height + spacing):
+		for colStart in np.arange(left, right - width + 1, width + spacing):
+			vertices = rectangleVertices(rowStart, colStart, rowStart + height, colStart + width)
+			shapeList.add(vertices, 'rectangle', **defaultRectangleStyle)
+	print('gridRectangles() made', len(shapeList), 'rectangles in region:', region)
+	return shapeList
+
+def shapesFromCsv(path, shapeList=None):
+	"""
+	Load polygons from a csv file
+
+	The csv has a header row and columns (roi, row, col), one vertex per line.
+	Vertices of one roi are consecutive lines with the same roi.
+
+	Parameters:
+		path: full path to .csv file
+		shapeList: append to this ShapeList, if None then a new one
+	"""
+	if shapeList is None:
+		shapeList = ShapeList()
+	table = np.genfromtxt(path, delimiter=',', names=True, dtype=None, encoding='utf-8')
+	names = [name.lower() for name in table.dtype.names]
+	try:
+		roi = table[table.dtype.names[names.index('roi')]]
+		row = table[table.dtype.names[names.index('row')]].astype(np.float64)
+		col = table[table.dtype.names[names.index('col')]].astype(np.float64)
+	except ValueError:
+		print('shapesFromCsv() error: expecting columns (roi, row, col), got:', table.dtype.names)
+		return shapeList
+	roi = np.atleast_1d(roi)
+	row = np.atleast_1d(row)
+	col = np.atleast_1d(col)
+	# start of each run of the same roi
+	starts = np.concatenate([[0], np.nonzero(roi[1:] != roi[:-1])[0] + 1, [len(roi)]])
+	for start, stop in zip(starts[:-1], starts[1:]):
+		if stop - start < 3:
+			print('shapesFromCsv() skipping roi', roi[start], 'with fewer than 3 vertices')
+			continue
+		vertices = np.column_stack([row[start:stop], col[start:stop]])
+		shapeList.add(vertices, 'polygon', **defaultRectangleStyle)
+	print('shapesFromCsv() loaded', len(shapeList), 'polygons from:', path)
+	return shapeList
+
+def shapesFromLabelImage(labels, tolerance=0.5, shapeList=None):
+	"""
+	Make one polygon around each label in a label image
+
+	We only look at the bounding box of each label (scipy.ndimage.find_objects)
+	so this is fast for thousands of small labels.
+
+	Parameters:
+		labels: 2d int ndarray, 0 is background
+		tolerance: max distance (pixels) when simplifying outlines, see skimage.measure.approximate_polygon
+		shapeList: append to this ShapeList, if None then a new one
+	"""
+	if shapeList is None:
+		shapeList = ShapeList()
+	labels = np.asarray(labels)
+	if labels.ndim != 2:
+		print('shapesFromLabelImage() error: expecting a 2d label image, got shape:', labels.shape)
+		return shapeList
+	for labelIdx, bounds in enumerate(scipy.ndimage.find_objects(labels.astype(np.int64))):
+		if bounds is None:
+			continue
+		# pad by one so outlines close at the edge of the bounding box
+		mask = np.pad(labels[bounds] == labelIdx + 1, 1).astype(np.float32)
+		contours = find_contours(mask, 0.5)
+		if len(contours) == 0:
+			continue
+		# outer outline, ignore holes and other pieces of the same label
+		outline = max(contours, key=len)
+		outline = approximate_polygon(outline, tolerance=tolerance)
+		if len(outline) < 4:
+			continue
+		offset = np.array([bounds[0].start - 1, bounds[1].start - 1])
+		shapeList.add(outline[:-1] + offset, 'polygon', **defaultRectangleStyle)
+	print('shapesFromLabelImage() made', len(shapeList), 'polygons')
+	return shapeList
+
+def importShapes(path):
+	"""
+	Load shapes from a file, based on extension
+
+		.csv: see shapesFromCsv()
+		.h5, .h5f: shapes (and their analysis) saved by ShapeFile
+		.npy, .tif, .tiff, .png: label image, see shapesFromLabelImage()
+
+	Returns:
+		ShapeList, empty on error
+	"""
+	extension = os.path.splitext(path)[1].lower()
+	if not os.path.isfile(path):
+		print('importShapes() file not found:', path)
+		return ShapeList()
+	if extension == '.csv':
+		return shapesFromCsv(path)
+	elif extension in ['.h5', '.h5f']:
+		return loadShapeFile(path)
+	elif extension == '.npy':
+		return shapesFromLabelImage(np.load(path))
+	elif extension in ['.tif', '.tiff', '.png']:
+		from skimage.io import imread
+		return shapesFromLabelImage(imread(path))
+	else:
+		print('importShapes() error: unknown file type:', path)
+		return ShapeList()
@@ -0,0 +1,80 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Pixels of a polygon roi in an image, as a bounding box plus a boolean mask.
+
+skimage.draw.polygon() gives (rr, cc), the row and column of each pixel. Indexing an image
+with these is a scattered gather and, for a big polygon, two large int64 arrays.
+
+When the polygon fills most of its bounding box we instead keep the bounding box (slices)
+and a boolean mask. Each image is then a contiguous slice, a rectangle does not even need the mask.
+Thin polygons (a diagonal sliver) keep (rr, cc), their bounding box is mostly empty.
+"""
+
+import numpy as np
+from skimage.draw import polygon
+
+class RoiMask:
+	def __init__(self, data, imageShape, minFillRatio=0.25):
+		"""
+		Parameters:
+			data: (n,2) vertex points of polygon
+			imageShape: (rows, cols) of each image
+			minFillRatio: use bounding box and mask if the polygon is at least this fraction of its bounding box
+		"""
+		data = np.asarray(data)
+		(rr, cc) = polygon(data[:,0], data[:,1], shape=imageShape)
+		self.numPixels = len(rr)
+		self.imageShape = tuple(imageShape)
+		self.rr = None
+		self.cc = None
+		self.bounds = None # (row slice, col slice)
+		self.mask = None # bool, shape of bounding box, None if all pixels of bounding box
+		if self.numPixels == 0:
+			return
+
+		top, left = rr.min(), cc.min()
+		bottom, right = rr.max() + 1, cc.max() + 1
+		boundsPixels = (bottom - top) * (right - left)
+		self.fillRatio = self.numPixels / boundsPixels
+		if self.fillRatio >= minFillRatio:
+			self.bounds = (slice(top, bottom), slice(left, right))
+			if self.numPixels < boundsPixels:
+				self.mask = np.zeros((bottom - top, right - left), dtype=bool)
+				self.mask[rr - top, cc - left] = True
+		else:
+			# smaller index type, images are never 2**31 pixels on a side
+			self.rr = rr.astype(np.int32)
+			self.cc = cc.astype(np.int32)
+
+	def __len__(self):
+		return self.numPixels
+
+	@property
+	def isEmpty(self):
+		return self.numPixels == 0
+
+	def values(self, image):
+		"""
+		Return the roi pixels of one image (rows, cols) as 1d,
+		or of a block of images (images, rows, cols) as (images, pixels)
+		"""
+		if self.bounds is None:
+			return image[..., self.rr, self.cc]
+		crop = image[..., self.bounds[0], self.bounds[1]]
+		if self.mask is None:
+			return crop.reshape(crop.shape[:-2] + (-1,))
+		return crop[..., self.mask]
+
+	def flatIndex(self):
+		""" return 1d int, flat index of each roi pixel in an image, in row major order """
+		if self.bounds is None:
+			return np.ravel_multi_index((self.rr, self.cc), self.imageShape)
+		if self.mask is None:
+			rr, cc = np.mgrid[self.bounds[0], self.bounds[1]]
+			rr, cc = rr.ravel(), cc.ravel()
+		else:
+			rr, cc = np.nonzero(self.mask)
+			rr, cc = rr + self.bounds[0].start, cc + self.bounds[1].start
+		return np.ravel_multi_index((rr, cc), self.imageShape)
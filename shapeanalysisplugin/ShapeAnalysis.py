@@ -1,4 +1,3 @@
-
 # Robert Cudmore
 # 20191119
 
@@ -6,23 +5,390 @@
 created to be used with raw image data from napari ShapeAnalysisPlugin
 """
 
-import sys, time, math
+import sys, time, math, collections, warnings
 import numpy as np
 
-from skimage.measure import profile
 from scipy.optimize import curve_fit
 from skimage.draw import polygon
 import scipy.signal
+import scipy.ndimage
 
 #from multiprocessing import Pool
 import multiprocessing
 
+try:
+	from .ResultStore import ResultStore
+	from .RoiMask import RoiMask
+	from .LineSampler import LineSampler
+	from .Kernels import useKernels, gatherSegmentStats, gatherFrameStats, profileFWHM
+	from .Instrumentation import timer, timed, count
+except ImportError:
+	# when ShapeAnalysisPlugin.py is run as a script
+	from ResultStore import ResultStore
+	from RoiMask import RoiMask
+	from LineSampler import LineSampler
+	from Kernels import useKernels, gatherSegmentStats, gatherFrameStats, profileFWHM
+	from Instrumentation import timer, timed, count
+
+def gaussian(x, amplitude, mean, stddev):
+	return amplitude * np.exp(-((x - mean) / 4 / stddev)**2)
+
+def FWHM(X,Y):
+	"""
+	heuristic full width at half maximal
+
+	returns:
+		fwhm, left_idx, right_idx (all nan if not found)
+
+	see: https://stackoverflow.com/questions/10582795/finding-the-full-width-half-maximum-of-a-peak
+	"""
+	Y = scipy.signal.medfilt(Y, 3)
+	half_max = max(Y) * 0.7
+
+	# for explanation of this wierd syntax
+	# see: https://docs.scipy.org/doc/numpy/reference/generated/numpy.where.html
+	whr = np.asarray(Y > half_max).nonzero()
+	if len(whr[0]) > 2:
+		left_idx = whr[0][0]
+		right_idx = whr[0][-1]
+		fwhm = X[right_idx] - X[left_idx]
+	else:
+		left_idx = np.nan
+		right_idx = np.nan
+		fwhm = np.nan
+	return fwhm, left_idx, right_idx #return the difference (full width)
+
+def gaussianFitParams(x, y):
+	""" see ShapeAnalysis.fitGaussianParams() """
+	try:
+		#print('x.shape:', x.shape)
+		with timer('fit'):
+			popt,pcov = curve_fit(gaussian,x,y)
+			myFWHM, left_idx, right_idx = FWHM(x,y)
+		return popt, myFWHM, left_idx, right_idx
+	except RuntimeError as e:
+		#print('... fitGaussian() error: ', e)
+		count('fit.failed')
+		return np.full(3, np.nan), np.nan, np.nan, np.nan
+	except:
+		print('\n... ... fitGaussian() error: exception in bAnalysis.fitGaussian() !!!')
+		raise
+
+def fitProfiles(profiles):
+	"""
+	Gaussian fit of many line profiles, worker for ShapeAnalysis.analyzeAll()
+
+	Parameters:
+		profiles: (n, points) or (n, channels, points)
+
+	Returns:
+		popt: (n, [channels,] 3) gaussian fit parameters
+		fwhm, left, right: (n, [channels]) see FWHM()
+		failed: (n) bool, a channel raised ValueError (e.g. nan in profile),
+			the whole slice (profile and fit) is nan
+	"""
+	leadingShape = profiles.shape[:-1]
+	x = np.arange(profiles.shape[-1])
+	popt = np.full(leadingShape + (3,), np.nan)
+	fwhm = np.full(leadingShape, np.nan)
+	left = np.full(leadingShape, np.nan)
+	right = np.full(leadingShape, np.nan)
+	failed = np.zeros(profiles.shape[0], dtype=bool)
+	# FWHM() of all profiles at once (compiled if we can), kept where the fit works like gaussianFitParams()
+	with timer('fit.fwhm'):
+		allFwhm, allLeft, allRight = profileFWHM(profiles)
+	for idx in np.ndindex(leadingShape):
+		if failed[idx[0]]:
+			continue
+		try:
+			with timer('fit'):
+				popt[idx] = curve_fit(gaussian, x, profiles[idx])[0]
+		except RuntimeError as e:
+			count('fit.failed')
+			continue
+		except ValueError as e:
+			failed[idx[0]] = True
+			continue
+		fwhm[idx], left[idx], right[idx] = allFwhm[idx], allLeft[idx], allRight[idx]
+	popt[failed] = np.nan
+	fwhm[failed] = np.nan
+	left[failed] = np.nan
+	right[failed] = np.nan
+	return popt, fwhm, left, right, failed
+
+@timed('reduce.kymograph')
+def kymographSummary(kymograph, overviewColumns=2048, numBins=256, blockRows=8192, percentiles=(0.5, 99.5)):
+	"""
+	Summarize a (slices, points) kymograph for display, reading it in blocks of slices (it can be np.memmap)
+
+	Parameters:
+		overviewColumns: max number of slices in the overview
+		percentiles: (lower, upper) of the histogram to use as display levels
+
+	Returns:
+		dict with
+			lineKymographOverview: (<= overviewColumns, points) float32, mean of each block of slices
+			lineKymographHistogram: (numBins) counts of all finite values
+			lineKymographEdges: (numBins+1) bin edges of histogram
+			lineKymographLevels: (2) display levels (lower, upper)
+	"""
+	numImages, numPoints = kymograph.shape
+	blockSize = max(1, int(np.ceil(numImages / overviewColumns))) # slices in each overview column
+	numColumns = int(np.ceil(numImages / blockSize))
+	blockRows = blockSize * max(1, blockRows // blockSize) # read whole overview columns
+
+	overviewSum = np.zeros((numColumns, numPoints), dtype=np.float64)
+	overviewCount = np.zeros((numColumns, numPoints), dtype=np.int64)
+	theMin = np.inf
+	theMax = -np.inf
+	# pass 1, overview and range
+	for start in range(0, numImages, blockRows):
+		block = np.asarray(kymograph[start:start+blockRows], dtype=np.float64)
+		numRows = block.shape[0]
+		padding = int(np.ceil(numRows / blockSize)) * blockSize - numRows
+		if padding > 0:
+			block = np.concatenate([block, np.full((padding, numPoints), np.nan)])
+		block = block.reshape(-1, blockSize, numPoints)
+		isFinite = np.isfinite(block)
+		firstColumn = start // blockSize
+		lastColumn = firstColumn + block.shape[0]
+		overviewSum[firstColumn:lastColumn] += np.where(isFinite, block, 0).sum(axis=1)
+		overviewCount[firstColumn:lastColumn] += isFinite.sum(axis=1)
+		if isFinite.any():
+			theMin = min(theMin, block[isFinite].min())
+			theMax = max(theMax, block[isFinite].max())
+	with np.errstate(invalid='ignore', divide='ignore'):
+		overview = (overviewSum / overviewCount).astype(np.float32)
+
+	if not np.isfinite(theMin):
+		# no analysis
+		theMin, theMax = 0.0, 1.0
+	elif theMin == theMax:
+		theMax = theMin + 1.0
+
+	# pass 2, histogram
+	counts = np.zeros(numBins, dtype=np.int64)
+	for start in range(0, numImages, blockRows):
+		block = np.asarray(kymograph[start:start+blockRows], dtype=np.float64)
+		block = block[np.isfinite(block)]
+		counts += np.histogram(block, bins=numBins, range=(theMin, theMax))[0]
+	edges = np.linspace(theMin, theMax, numBins+1)
+
+	# levels from cumulative histogram
+	cumulative = np.cumsum(counts)
+	if cumulative[-1] > 0:
+		lower = edges[np.searchsorted(cumulative, cumulative[-1] * percentiles[0] / 100)]
+		upper = edges[np.searchsorted(cumulative, cumulative[-1] * percentiles[1] / 100) + 1]
+	else:
+		lower, upper = theMin, theMax
+
+	return {
+		'lineKymographOverview': overview,
+		'lineKymographHistogram': counts,
+		'lineKymographEdges': edges.astype(np.float32),
+		'lineKymographLevels': np.array([lower, upper], dtype=np.float32),
+	}
+
+@timed('filter')
+def filterStack(data, sigma=1):
+	""" return a gaussian filtered copy of an image stack, see ShapeAnalysisPlugin.filterImage() """
+	if np.ndim(data) == 4 and np.isscalar(sigma):
+		# (color, slice, row, col), do not mix channels
+		sigma = (0, sigma, sigma, sigma)
+	return scipy.ndimage.gaussian_filter(data, sigma=sigma)
+
+def integralImage(block):
+	"""
+	Summed area table of each image in a block
+
+	Parameters:
+		block: (images, rows, cols)
+
+	Returns:
+		(images, rows+1, cols+1) float64, [:, i, j] is the sum of block[:, :i, :j]
+	"""
+	sat = np.zeros((block.shape[0], block.shape[1]+1, block.shape[2]+1), dtype=np.float64)
+	np.cumsum(block, axis=1, dtype=np.float64, out=sat[:, 1:, 1:])
+	np.cumsum(sat[:, 1:, 1:], axis=2, out=sat[:, 1:, 1:])
+	return sat
+
+def rectangleSums(sat, boxes):
+	"""
+	Sum of pixels in each rectangle, in constant time per rectangle
+
+	Parameters:
+		sat: summed area table from integralImage()
+		boxes: (n,4) int of (top, left, bottom, right), bottom and right are not included
+
+	Returns:
+		(images, n) float64
+	"""
+	top, left, bottom, right = boxes[:,0], boxes[:,1], boxes[:,2], boxes[:,3]
+	return sat[:, bottom, right] - sat[:, top, right] - sat[:, bottom, left] + sat[:, top, left]
+
+# statistics of polygons besides min/max/mean, see ShapeAnalysis.stackPolygonStats()
+# these come from the per frame cache of an edited polygon without reading the stack again,
+# order statistics (e.g. 'median', 'p95') need the pixels, add them to ShapeAnalysis.polygonStats when wanted
+defaultPolygonStats = ['sd', 'n', 'sum']
+polygonStatDtypes = {'n': np.int64, 'sum': np.float64} # others are float32
+
+def statPercentile(name):
+	"""
+	Return the percentile of an order statistic name, 'median' is 50, 'p5' is 5, 'p99.5' is 99.5
+
+	Returns None if name is not an order statistic
+	"""
+	if name == 'median':
+		return 50.0
+	if name.startswith('p'):
+		try:
+			percentile = float(name[1:])
+		except ValueError:
+			return None
+		if 0 <= percentile <= 100:
+			return percentile
+	return None
+
+def parsePolygonStats(stats):
+	"""
+	Check names of polygon statistics, see ShapeAnalysis.stackPolygonStats()
+
+	Returns:
+		stats: list of known names (without 'min', 'max', 'mean')
+		percentiles: dict of order statistic name to percentile, e.g. {'median': 50.0, 'p95': 95.0}
+	"""
+	knownStats = []
+	percentiles = {}
+	for name in stats:
+		if name in ['min', 'max', 'mean'] or name in knownStats:
+			continue
+		percentile = statPercentile(name)
+		if percentile is not None:
+			percentiles[name] = percentile
+		elif name not in ['sd', 'n', 'sum']:
+			print('parsePolygonStats() unknown statistic, ignored:', name)
+			continue
+		knownStats.append(name)
+	return knownStats, percentiles
+
+def orderStatistics(values, percentiles):
+	"""
+	Percentiles of the last axis, like np.percentile(values, percentiles, axis=-1) (linear interpolation)
+	with np.partition() rather than a full sort, nan are ignored like np.nanpercentile
+
+	Returns:
+		(len(percentiles),) + values.shape[:-1] float64
+	"""
+	percentiles = np.asarray(percentiles, dtype=np.float64)
+	numValues = values.shape[-1]
+	if values.dtype.kind == 'f' and np.isnan(values).any():
+		with warnings.catch_warnings():
+			# all nan gives nan
+			warnings.simplefilter('ignore', RuntimeWarning)
+			return np.nanpercentile(values, percentiles, axis=-1)
+	if numValues == 0:
+		return np.full(percentiles.shape + values.shape[:-1], np.nan)
+	position = percentiles / 100 * (numValues - 1)
+	lower = np.floor(position).astype(np.intp)
+	upper = np.minimum(lower + 1, numValues - 1)
+	partitioned = np.partition(values, np.unique(np.concatenate([lower, upper])), axis=-1)
+	lowerValues = np.moveaxis(partitioned[..., lower], -1, 0).astype(np.float64)
+	upperValues = np.moveaxis(partitioned[..., upper], -1, 0).astype(np.float64)
+	weight = (position - lower).reshape((-1,) + (1,) * (values.ndim - 1))
+	return lowerValues + (upperValues - lowerValues) * weight
+
+def segmentStats(values, starts, lengths, stats=(), percentiles={}):
+	"""
+	min/max/mean and more statistics of consecutive segments of the last axis,
+	e.g. the pixels of many polygons gathered into one array, nan are ignored like np.nanmean
+
+	Variance is two pass, the sum of squared deviations from the mean of each segment.
+	Every pixel of an image is in values, so there is nothing to merge (Welford) and no cancellation.
+
+	Parameters:
+		values: (..., pixels)
+		starts: 1d int, start of each segment (not empty)
+		lengths: 1d int, number of pixels in each segment
+		stats, percentiles: from parsePolygonStats()
+
+	Returns:
+		dict of 'min', 'max', 'mean' and each of stats, (..., segments)
+	"""
+	starts = np.asarray(starts)
+	lengths = np.asarray(lengths)
+	results = {}
+	# fmin/fmax ignore nan like np.nanmin/np.nanmax
+	results['min'] = np.fmin.reduceat(values, starts, axis=-1)
+	results['max'] = np.fmax.reduceat(values, starts, axis=-1)
+	if values.dtype.kind == 'f':
+		# numpy does not say which zero is the min/max when -0 and 0 tie, always +0 (like Kernels)
+		results['min'] += 0
+		results['max'] += 0
+	hasNan = values.dtype.kind == 'f' and np.isnan(values).any()
+	if hasNan:
+		finite = np.isfinite(values)
+		sums = np.add.reduceat(np.where(finite, values, 0), starts, axis=-1, dtype=np.float64)
+		counts = np.add.reduceat(finite, starts, axis=-1)
+	else:
+		sums = np.add.reduceat(values, starts, axis=-1, dtype=np.float64)
+		counts = np.broadcast_to(lengths, sums.shape)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		results['mean'] = sums / counts
+		if 'sd' in stats:
+			deviations = values - np.repeat(results['mean'], lengths, axis=-1)
+			if hasNan:
+				deviations[~finite] = 0
+			results['sd'] = np.sqrt(np.add.reduceat(deviations * deviations, starts, axis=-1) / counts)
+	if 'sum' in stats:
+		results['sum'] = sums
+	if 'n' in stats:
+		results['n'] = counts
+	if len(percentiles) > 0:
+		names = list(percentiles.keys())
+		for name in names:
+			results[name] = np.empty(sums.shape)
+		# segments of the same length are one (..., segments, length) array
+		for length in np.unique(lengths):
+			segments = np.nonzero(lengths == length)[0]
+			if len(starts) == 1:
+				segmentValues = values[..., np.newaxis, :]
+			else:
+				segmentValues = values[..., starts[segments][:, np.newaxis] + np.arange(length)]
+			orderStats = orderStatistics(segmentValues, [percentiles[name] for name in names])
+			for name, value in zip(names, orderStats):
+				results[name][..., segments] = value
+	return results
+
 class ShapeAnalysis:
-	def __init__(self, data):
+	def __init__(self, data, resultStore=None):
 		"""
-		data: 3d image data
+		data: 3d image data (slice, row, col) or 4d (color, slice, row, col)
+		resultStore: ResultStore to allocate results, big results (kymographs) are disk backed np.memmap
+
+		With 4d data every stack analysis reads all channels of each image at once and
+		returns one result per channel, (channels, slices) rather than (slices), see polygonResults()
 		"""
+		self._dataVersion = 0 # incremented when data changes, see dataChanged()
 		self.data = data
+		self.resultStore = resultStore if resultStore is not None else ResultStore()
+
+		# 4d data, channel we plot and store under the usual result names (e.g. 'polygonMean'),
+		# all channels are stored as name + 'Channels' (e.g. 'polygonMeanChannels')
+		self.displayChannel = 0
+
+		# statistics of polygons besides min/max/mean, see stackPolygonStats()
+		self.polygonStats = list(defaultPolygonStats)
+
+		# per frame stats of recently analyzed polygons, so an edit only gathers pixels that changed
+		# key: dict with 'flatIdx', 'min', 'max', 'sum', 'sumSquares', 'count', 'dataVersion', see stackPolygonAnalysis(key=)
+		self._polygonCache = collections.OrderedDict()
+		self.maxCachedPolygons = 16
+		self.maxDeltaFraction = 0.5 # recompute if more than this fraction of pixels changed
+
+		# stack analysis loops through images in this process if doSingleThread or there are few images,
+		# otherwise it uses a multiprocessing pool
+		self.doSingleThread = False
+		self.minParallelImages = 500
 
 	def fitGaussian(self, x, y):
 		"""
@@ -34,60 +400,25 @@ class ShapeAnalysis:
 			fwhm: scalar with full width at half maximal (heuristic calculation)
 			left_idx:
 			right_idx:
+		"""
+		popt, myFWHM, left_idx, right_idx = self.fitGaussianParams(x, y)
+		yFit = gaussian(x, *popt)
+		return yFit, myFWHM, left_idx, right_idx
 
-		for fitting a gaussian, see:
-		https://stackoverflow.com/questions/44480137/how-can-i-fit-a-gaussian-curve-in-python
-		for finding full width half maximal, see:
-		https://stackoverflow.com/questions/10582795/finding-the-full-width-half-maximum-of-a-peak
-		"""
-		n = len(x)                          #the number of data
-		mean = sum(x*y)/n                   #
-		sigma = sum(y*(x-mean)**2)/n        #
-		#mean = sum(y)/n                   #
-		#sigma = sum((y-mean)**2)/n        #
-		'''
-		print('fitGaussian mean:', mean)
-		print('fitGaussian sigma:', sigma)
-		'''
+	def fitGaussianParams(self, x, y):
+		"""
+		Like fitGaussian() but return the fit parameters rather than the fit
 
-		def myGaussian(x, amplitude, mean, stddev):
-		    return amplitude * np.exp(-((x - mean) / 4 / stddev)**2)
-
-		# see: https://stackoverflow.com/questions/10582795/finding-the-full-width-half-maximum-of-a-peak
-		def FWHM(X,Y):
-			Y = scipy.signal.medfilt(Y, 3)
-			half_max = max(Y) / 2.
-			half_max = max(Y) * 0.7
-
-			# for explanation of this wierd syntax
-			# see: https://docs.scipy.org/doc/numpy/reference/generated/numpy.where.html
-			#whr = np.where(Y > half_max)
-			#print('   half_max:', half_max)
-			whr = np.asarray(Y > half_max).nonzero()
-			if len(whr[0]) > 2:
-				left_idx = whr[0][0]
-				right_idx = whr[0][-1]
-				fwhm = X[right_idx] - X[left_idx]
-			else:
-				left_idx = np.nan
-				right_idx = np.nan
-				fwhm = np.nan
-			return fwhm, left_idx, right_idx #return the difference (full width)
+		returns:
+			popt: ndarray of gaussian fit parameters (amplitude, mean, stddev), nan if fit failed
+			fwhm: scalar with full width at half maximal (heuristic calculation)
+			left_idx:
+			right_idx:
 
-		try:
-			#print('x.shape:', x.shape)
-			popt,pcov = curve_fit(myGaussian,x,y)
-			yFit = myGaussian(x,*popt)
-			myFWHM, left_idx, right_idx = FWHM(x,y)
-			return yFit, myFWHM, left_idx, right_idx
-		except RuntimeError as e:
-			#print('... fitGaussian() error: ', e)
-			return np.full((x.shape[0]), np.nan), np.nan, np.nan, np.nan
-		except:
-			print('\n... ... fitGaussian() error: exception in bAnalysis.fitGaussian() !!!')
-			raise
-			return np.full((x.shape[0]), np.nan), np.nan, np.nan, np.nan
-			#return None, None, None, None
+		for fitting a gaussian, see:
+		https://stackoverflow.com/questions/44480137/how-can-i-fit-a-gaussian-curve-in-python
+		"""
+		return gaussianFitParams(x, y)
 
 	"""
 	to generate a mask of an arbitrary polygon
@@ -105,6 +436,24 @@ class ShapeAnalysis:
 	see sandbox/bPolygonMask.py
 	"""
 
+	@property
+	def data(self):
+		return self._data
+
+	@data.setter
+	def data(self, data):
+		self._data = data
+		self.dataChanged()
+
+	def dataChanged(self):
+		"""
+		Call after editing data in place, setting self.data does this for us
+
+		Per frame stats cached by stackPolygonAnalysis(key=) are from the old data,
+		they are not used again (see _getCachedPolygon).
+		"""
+		self._dataVersion += 1
+
 	@property
 	def imageShape(self):
 		""" return the shape of an individual image """
@@ -129,34 +478,97 @@ class ShapeAnalysis:
 			# assuming (color, slice, row, col)
 			return self.data.shape[1]
 
+	@property
+	def hasChannels(self):
+		""" True if data is 4d (color, slice, row, col) """
+		return len(self.data.shape)==4
+
+	@property
+	def numChannels(self):
+		""" number of color channels, 1 unless data is 4d """
+		if self.hasChannels:
+			return self.data.shape[0]
+		return 1
+
+	def _resultShape(self, numImages):
+		""" shape of a per slice result, (numImages) or (channels, numImages) for 4d data """
+		if self.hasChannels:
+			return (self.numChannels, numImages)
+		return (numImages,)
+
+	def _readImages(self, key):
+		"""
+		Read images from data, for 4d data all channels at once
+
+		Parameters:
+			key: int slice, or slice/int ndarray of slices
+
+		Returns:
+			int: (rows, cols) or (channels, rows, cols)
+			otherwise: (images, rows, cols) or (images, channels, rows, cols)
+		"""
+		if not self.hasChannels:
+			return np.asarray(self.data[key])
+		images = np.asarray(self.data[:, key])
+		if isinstance(key, slice) or np.ndim(key) > 0:
+			# channel after image, a view
+			images = np.moveaxis(images, 0, 1)
+		return images
+
+	def _splitChannels(self, results):
+		"""
+		Name per channel results for ShapeList, for 4d data
+
+		Each result (channels, ...) is stored as name + 'Channels',
+		name is self.displayChannel so plots and TraceAnalysis see one channel.
+		"""
+		if not self.hasChannels:
+			return results
+		splitResults = {}
+		for name, value in results.items():
+			splitResults[name + 'Channels'] = value
+			splitResults[name] = value[self.displayChannel]
+		return splitResults
+
+	def polygonResults(self, theMin, theMax, theMean, stats=None):
+		"""
+		return dict of ShapeList results from stackPolygonAnalysis() (or one row of stackPolygonStats())
+
+		stats: dict of more statistics, e.g. {'sd': theSd, 'p95': theP95}, stored as 'polygonSd', 'polygonP95'
+		"""
+		results = {
+			'polygonMin': theMin,
+			'polygonMax': theMax,
+			'polygonMean': theMean,
+			}
+		if stats is not None:
+			for name, value in stats.items():
+				if name in ['min', 'max', 'mean']:
+					continue
+				results['polygon' + name[0].upper() + name[1:]] = value
+		return self._splitChannels(results)
+
 	def polygonAnalysis(self, slice, data):
 		"""
 		data: list of vertex points
+
+		Returns:
+			min, max, mean, scalar or (channels) for 4d data
 		"""
 		'''
 		print('bAnalysis.polygonAnalysis() slice:', slice, 'data:', data)
 		print('   type(data):', type(data))
 		'''
-		dataList = data.tolist()
-		r = list(zip(*dataList))[0]
-		c = list(zip(*dataList))[1]
-		#channel = 0
-		#myImageShape = self.stack.stack[channel,slice,:,:].shape
-		#myImageShape = self.data[slice,:,:].shape
-		(rr, cc) = polygon(r, c, shape=self.imageShape)
-		if len(rr)==0 or len(cc)==0:
+		# bounding box and mask, or (rr, cc) for thin polygons
+		roiMask = RoiMask(data, self.imageShape)
+		if roiMask.isEmpty:
 			return np.nan, np.nan, np.nan
-		'''
-		print('rr:', rr)
-		print('cc:', cc)
-		'''
-		#roiImage = self.stack.stack[channel,slice,rr,cc] # extract the roi
 		try:
-			roiImage = self.data[slice,rr,cc] # extract the roi
+			roiImage = roiMask.values(self._readImages(slice)) # extract the roi
 			#print('roiImage:', roiImage, 'roiImage.shape', roiImage.shape, 'type(roiImage):', type(roiImage))
-			theMin = np.nanmin(roiImage)
-			theMax = np.nanmax(roiImage)
-			theMean = np.nanmean(roiImage)
+			theMin = np.nanmin(roiImage, axis=-1)
+			theMax = np.nanmax(roiImage, axis=-1)
+			theMean = np.nanmean(roiImage, axis=-1)
 			return theMin, theMax, theMean
 		except IndexError as e:
 			print('*** IndexError exception in ShapeAnalysis.polygonAnalysis() e:', e)
@@ -166,14 +578,15 @@ class ShapeAnalysis:
 		"""
 		data: list of vertex points
 		"""
-		if slice % 300 == 0:
-			print('   worker polygonAnalysis2() slice:', slice, 'of', self.numImages)
 		try:
-			roiImage = self.data[slice,self.rr, self.cc] # extract the roi
+			with timer('read'):
+				# all channels of 4d data
+				roiImage = self.roiMask.values(self._readImages(slice)) # extract the roi
 			#print('roiImage:', roiImage, 'roiImage.shape', roiImage.shape, 'type(roiImage):', type(roiImage))
-			theMin = np.nanmin(roiImage)
-			theMax = np.nanmax(roiImage)
-			theMean = np.nanmean(roiImage)
+			with timer('reduce'):
+				theMin = np.nanmin(roiImage, axis=-1)
+				theMax = np.nanmax(roiImage, axis=-1)
+				theMean = np.nanmean(roiImage, axis=-1)
 			return theMin, theMax, theMean
 			'''
 			self.theMin[slice] = theMin
@@ -184,163 +597,673 @@ class ShapeAnalysis:
 			print('*** IndexError exception in ShapeAnalysis.polygonAnalysis() e:', e)
 			raise
 
-	def stackPolygonAnalysis(self, data):
+	def stackPolygonAnalysis(self, data, key=None):
 		"""
 		data: list of vertex points
+		key: if not None, keep per frame stats of this polygon (e.g. shape id),
+			analyzing the same key again after an edit only gathers the pixels that changed
+
+		Returns:
+			theMin, theMax, theMean: (slices) or (channels, slices) for 4d data, see polygonResults()
 		"""
+		if key is not None:
+			with timer('polygon.delta'):
+				return self._stackPolygonAnalysisDelta(data, key)
+
 		#numSlices = self.stack.numImages # will only work for [color,slice,x,y]
-		minList = []
-		maxList = [] # each element is intensity profile for one slice/image
-		meanList = [] # each element is intensity profile for one slice/image
-		#if numSlices < 500:
-		doSingleThread= False
-		if doSingleThread or self.numImages < 500:
-			print('stackPolygonAnalysis performing loop through images')
-			startTime = time.time()
-			for idx, slice in enumerate(range(self.numImages)): # why do i need -1 ???
-				if idx % 300 == 0:
-					print('   idx:', idx, 'of', self.numImages)
-				theMin, theMax, theMean = self.polygonAnalysis(slice, data)
-				minList.append(theMin)
-				maxList.append(theMax)
-				meanList.append(theMean)
-			stopTime = time.time()
-			print(   '1) single-thread ', self.numImages, 'slices took', round(stopTime-startTime,3))
+		theMin = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		theMax = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		theMean = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		# bounding box and mask, or (rr, cc) for thin polygons, used by polygonAnalysis2 worker
+		with timer('rasterize'):
+			self.roiMask = RoiMask(data, self.imageShape)
+		if self.roiMask.isEmpty:
+			print('stackPolygonAnalysis() got empty analysis polygon')
+			return None, None, None
+		count('polygon.slices', self.numImages)
+		if self.doSingleThread or self.numImages < self.minParallelImages:
+			with timer('polygon.single'):
+				for idx, slice in enumerate(range(self.numImages)): # why do i need -1 ???
+					theMin[..., slice], theMax[..., slice], theMean[..., slice] = self.polygonAnalysis2(slice)
 		else:
 			numCPU = multiprocessing.cpu_count()
 			chunksize = numCPU*200 #400 took 8.1 seconds, 200 takes 8 seconds, 100 takes 17 seconds, 50 takes 23 sec
-			print('stackPolygonAnalysis using multiprocessing pool imape, num cpu:', numCPU, 'chunksize:', chunksize)
-			print('   self.imageShape:', self.imageShape)
 			#print('   ', self.data.shape, self.data.dtype)# create a list of parameters to function self.lineProfile as a tuple (slice, src, dst, linewidth)
-			dataList = data.tolist()
-			r = list(zip(*dataList))[0]
-			c = list(zip(*dataList))[1]
-			(rr, cc) = polygon(r, c, shape=self.imageShape)
-			if len(rr)==0 or len(cc)==0:
-				print('stackPolygonAnalysis() got empty analysis polygon: rr.shape:', rr.shape, 'cc.shape:', cc.shape)
-				return None, None, None
 			numImages = self.numImages
 			#numImages = 100
-			self.rr = rr # used by polygonAnalysis2 worker
-			self.cc = cc
-			startTime = time.time()
-			myIterable = [a for a in range(numImages)]
-			with multiprocessing.Pool(processes=numCPU-1) as p:
-				# previously tried starmap but it always ran out of memory?
-				minList, maxList, meanList = zip(*p.imap(self.polygonAnalysis2, myIterable, chunksize=chunksize))
-			stopTime = time.time()
-			print('2) multi-thread stackPolygonAnalysis for', self.numImages, 'slices took', round(stopTime-startTime,3))
-		return np.asarray(minList), np.asarray(maxList), np.asarray(meanList)
-
-	def lineProfile(self, slice, src, dst, linewidth=3, doFit=True):
+			myIterable = range(numImages)
+			# timers in workers are not seen here, time the whole pool
+			with timer('polygon.multi'):
+				with multiprocessing.Pool(processes=max(1, numCPU-1)) as p:
+					# previously tried starmap but it always ran out of memory?
+					for slice, oneResult in enumerate(p.imap(self.polygonAnalysis2, myIterable, chunksize=chunksize)):
+						theMin[..., slice], theMax[..., slice], theMean[..., slice] = oneResult
+		return theMin, theMax, theMean
+
+	def _gatherStats(self, flatIdx, frames=None, maxBlockBytes=64 * 1024**2):
+		"""
+		Per frame stats of some pixels, nan are ignored
+
+		Parameters:
+			flatIdx: 1d int, flat index of pixels in each image
+			frames: 1d int of images, if None then all images
+
+		Returns:
+			dict of 'min', 'max', 'sum', 'sumSquares', 'count', each (frames) or (frames, channels) for 4d data
+		"""
+		if frames is None:
+			frames = np.arange(self.numImages)
+		numFrames = len(frames)
+		statsShape = self._resultShape(numFrames)[::-1]
+		stats = {
+			'min': np.full(statsShape, np.nan),
+			'max': np.full(statsShape, np.nan),
+			'sum': np.zeros(statsShape),
+			'sumSquares': np.zeros(statsShape),
+			'count': np.zeros(statsShape, dtype=np.int64),
+		}
+		if len(flatIdx) == 0 or numFrames == 0:
+			return stats
+		imagePixels = int(np.prod(self.imageShape))
+		blockImages = max(1, maxBlockBytes // (len(flatIdx) * 8 * self.numChannels))
+		for start in range(0, numFrames, blockImages):
+			stop = min(start + blockImages, numFrames)
+			blockFrames = frames[start:stop]
+			with timer('read'):
+				if blockFrames[-1] - blockFrames[0] == stop - start - 1:
+					# consecutive frames, a slice
+					block = self._readImages(slice(blockFrames[0], blockFrames[-1]+1))
+				else:
+					block = self._readImages(blockFrames)
+				flatBlock = block.reshape(block.shape[:-2] + (imagePixels,))
+			if useKernels(block.dtype):
+				# compiled gather and reduce, no (images, pixels) array of values
+				with timer('reduce.kernel'):
+					blockStats = gatherFrameStats(flatBlock, flatIdx)
+				for name, value in blockStats.items():
+					stats[name][start:stop] = value
+				continue
+			with timer('read'):
+				# (images, pixels) or (images, channels, pixels)
+				values = np.take(flatBlock, flatIdx, axis=-1).astype(np.float64)
+			with timer('reduce'):
+				finite = np.isfinite(values)
+				# a zero min/max is +0, see segmentStats()
+				stats['min'][start:stop] = np.fmin.reduce(values, axis=-1) + 0
+				stats['max'][start:stop] = np.fmax.reduce(values, axis=-1) + 0
+				values[~finite] = 0
+				stats['sum'][start:stop] = values.sum(axis=-1)
+				stats['sumSquares'][start:stop] = (values * values).sum(axis=-1)
+				stats['count'][start:stop] = finite.sum(axis=-1)
+		return stats
+
+	def _stackPolygonAnalysisDelta(self, data, key):
+		"""
+		Like stackPolygonAnalysis() but keep per frame stats of the polygon in self._polygonCache
+
+		After an edit we only gather pixels added to or removed from the polygon mask:
+			sum, sum of squares and count are updated for all frames,
+			min/max are updated with added pixels, frames where a removed pixel was the min (or max)
+			are recomputed from the new mask.
+		If more than self.maxDeltaFraction of pixels changed we recompute everything.
+		Cached stats are only used with the data they came from, see dataChanged().
+		"""
+		data = np.asarray(data)
+		with timer('rasterize'):
+			(rr, cc) = polygon(data[:,0], data[:,1], shape=self.imageShape)
+		if len(rr)==0 or len(cc)==0:
+			print('stackPolygonAnalysis() got empty analysis polygon: rr.shape:', rr.shape, 'cc.shape:', cc.shape)
+			self.discardPolygon(key)
+			return None, None, None
+		flatIdx = np.unique(np.ravel_multi_index((rr, cc), self.imageShape))
+		count('polygon.slices', self.numImages)
+
+		cached = self._getCachedPolygon(key, pop=True)
+		if cached is not None:
+			added = np.setdiff1d(flatIdx, cached['flatIdx'], assume_unique=True)
+			removed = np.setdiff1d(cached['flatIdx'], flatIdx, assume_unique=True)
+			if len(added) + len(removed) > self.maxDeltaFraction * len(flatIdx):
+				cached = None
+
+		if cached is None:
+			stats = self._gatherStats(flatIdx)
+			count('polygon.deltaFull')
+		else:
+			addedStats = self._gatherStats(added)
+			removedStats = self._gatherStats(removed)
+			stats = {}
+			for name in ['sum', 'sumSquares', 'count']:
+				stats[name] = cached[name] + addedStats[name] - removedStats[name]
+			stats['min'] = np.fmin(cached['min'], addedStats['min'])
+			stats['max'] = np.fmax(cached['max'], addedStats['max'])
+			# the old min/max may be a pixel we removed
+			with np.errstate(invalid='ignore'):
+				redo = (removedStats['min'] <= cached['min']) | (removedStats['max'] >= cached['max'])
+			if redo.ndim > 1:
+				# any channel
+				redo = redo.any(axis=1)
+			redo = np.nonzero(redo)[0]
+			if len(redo) > 0:
+				redoStats = self._gatherStats(flatIdx, frames=redo)
+				stats['min'][redo] = redoStats['min']
+				stats['max'][redo] = redoStats['max']
+			count('polygon.deltaPixels', len(added) + len(removed))
+			count('polygon.deltaRedoSlices', len(redo))
+
+		stats['flatIdx'] = flatIdx
+		stats['dataVersion'] = self._dataVersion
+		self._polygonCache[key] = stats
+		while len(self._polygonCache) > self.maxCachedPolygons:
+			self._polygonCache.popitem(last=False)
+
+		# stats are (frames, channels), results are (channels, frames)
+		theMin = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		theMax = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		theMean = self.resultStore.allocate(self._resultShape(self.numImages), np.float32)
+		theMin[:] = stats['min'].T
+		theMax[:] = stats['max'].T
+		with np.errstate(invalid='ignore', divide='ignore'):
+			theMean[:] = (stats['sum'] / stats['count']).T
+		return theMin, theMax, theMean
+
+	def _getCachedPolygon(self, key, pop=False):
+		""" return per frame stats of a polygon, None if not cached or cached from data that has since changed """
+		cached = self._polygonCache.pop(key, None) if pop else self._polygonCache.get(key, None)
+		if cached is not None and cached['dataVersion'] != self._dataVersion:
+			count('polygon.cacheStale')
+			self._polygonCache.pop(key, None)
+			return None
+		return cached
+
+	def polygonVariance(self, key):
+		""" return per frame variance of a polygon analyzed with stackPolygonAnalysis(key=), None if not cached """
+		cached = self._getCachedPolygon(key)
+		if cached is None:
+			return None
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = cached['sum'] / cached['count']
+			return np.maximum(cached['sumSquares'] / cached['count'] - mean * mean, 0).T
+
+	def stackPolygonExtraStats(self, data, key, stats=None):
+		"""
+		Statistics besides min/max/mean of a polygon analyzed with stackPolygonAnalysis(data, key=)
+
+		sd/n/sum come from the cached per frame stats,
+		order statistics (median, percentiles) need the pixels, one more pass with stackPolygonStats()
+
+		Returns:
+			dict of name to (slices) or (channels, slices) for 4d data, see polygonResults()
+		"""
+		if stats is None:
+			stats = self.polygonStats
+		stats, percentiles = parsePolygonStats(stats)
+		results = {}
+		cached = self._getCachedPolygon(key)
+		if cached is None:
+			# not cached, everything in one pass
+			passStats = stats
+		else:
+			if 'sd' in stats:
+				results['sd'] = np.sqrt(self.polygonVariance(key)).astype(np.float32)
+			if 'n' in stats:
+				results['n'] = cached['count'].T
+			if 'sum' in stats:
+				results['sum'] = cached['sum'].T
+			passStats = list(percentiles.keys())
+		if len(passStats) > 0:
+			passResults = self.stackPolygonStats([data], stats=passStats)
+			for name in passStats:
+				results[name] = passResults[name][0]
+		return results
+
+	def discardPolygon(self, key):
+		""" forget per frame stats of a polygon, e.g. when it is deleted """
+		self._polygonCache.pop(key, None)
+
+	def stackMultiPolygonAnalysis(self, dataList, maxBlockBytes=64 * 1024**2, maxRectangleSizes=8, minOverlap=4, minMaskPixels=4096):
+		"""
+		min/max/mean of many polygons in one pass over the stack, see stackPolygonStats()
+
+		Returns:
+			theMin, theMax, theMean: (polygons, images) float32, row is nan for an empty polygon,
+				(polygons, channels, images) for 4d data
+		"""
+		stats = self.stackPolygonStats(dataList, stats=[], maxBlockBytes=maxBlockBytes,
+						maxRectangleSizes=maxRectangleSizes, minOverlap=minOverlap, minMaskPixels=minMaskPixels)
+		return stats['min'], stats['max'], stats['mean']
+
+	@timed('polygon.multiPolygon')
+	def stackPolygonStats(self, dataList, stats=None, maxBlockBytes=64 * 1024**2, maxRectangleSizes=8, minOverlap=4, minMaskPixels=4096):
+		"""
+		Analyze many polygons in one pass over the stack
+
+		Each image is read once, no matter how many polygons or statistics.
+
+		The pixels of all polygons are gathered from each block of images at once,
+		then min/max/mean (and stats) of each polygon are reduced with np.ufunc.reduceat(), see segmentStats().
+		This costs about the total number of pixels in all polygons, a tiling of thousands
+		of rectangles costs about the same as one rectangle over the whole image.
+
+		Big polygons that fill most of their bounding box are a slice of each block of images
+		and a boolean mask (see RoiMask), rather than a scattered gather.
+
+		Overlapping axis aligned rectangles (e.g. sliding windows) cover many more pixels than the image.
+		Groups of these with the same size use a summed area table (see integralImage) for the mean/sum/sd
+		and one min/max filter for min/max, this costs a few images per group, no matter how many rectangles.
+		Order statistics (median, percentiles) need the pixels, with these all rectangles are gathered.
+
+		Parameters:
+			dataList: list of (n,2) vertex points, one per polygon
+			stats: list of statistics besides min/max/mean, if None then self.polygonStats
+				'sd': standard deviation of pixels in each image (ddof=0)
+				'n': number of pixels (that are not nan)
+				'sum': sum of pixels
+				'median', 'p5', 'p95', 'p99.5', ...: percentile of pixels, interpolated like np.percentile
+			maxBlockBytes: max size of the (images x pixels) block we gather at once
+			maxRectangleSizes: max number of different rectangle sizes to filter,
+				rectangles of other sizes are gathered like polygons
+			minOverlap: filter a group of same size rectangles if their pixels are at least
+				this many times the pixels of their bounding box
+			minMaskPixels: polygons with at least this many pixels use their bounding box and mask
+
+		Returns:
+			dict of 'min', 'max', 'mean' and each of stats, (polygons, images) or (polygons, channels, images) for 4d data,
+				float32 except 'n' is int64 and 'sum' is float64, row is nan (n is 0) for an empty polygon
+		"""
+		if stats is None:
+			stats = self.polygonStats
+		plan = self._planPolygons(dataList, stats, maxRectangleSizes=maxRectangleSizes, minOverlap=minOverlap, minMaskPixels=minMaskPixels)
+		results = self._newPolygonResults(len(dataList), plan['stats'])
+		count('polygon.slices', self.numImages * len(dataList))
+		blockImages = max(1, maxBlockBytes // max(plan['blockBytes'], 1))
+		for start in range(0, self.numImages, blockImages):
+			stop = min(start + blockImages, self.numImages)
+			with timer('read'):
+				block = self._readImages(slice(start, stop))
+			self._reducePolygonBlock(plan, block, start, results)
+		count('polygon.rectanglesFiltered', sum(len(group) for size, group, bounds in plan['filterGroups']))
+		return results
+
+	def _newPolygonResults(self, numPolygons, stats):
+		""" preallocate results of stackPolygonStats(), all nan ('n' is 0) """
+		resultShape = (numPolygons,) + self._resultShape(self.numImages)
+		results = {}
+		for name in ['min', 'max', 'mean'] + stats:
+			if name == 'n':
+				results[name] = self.resultStore.allocate(resultShape, np.int64, fill=0)
+			else:
+				results[name] = self.resultStore.allocate(resultShape, polygonStatDtypes.get(name, np.float32))
+		return results
+
+	def _planPolygons(self, dataList, stats, maxRectangleSizes=8, minOverlap=4, minMaskPixels=4096):
+		"""
+		Decide how each polygon is reduced from a block of images, see stackPolygonStats()
+
+		Returns:
+			dict with
+				stats, percentiles: from parsePolygonStats()
+				filterGroups: list of ((height, width), (n,3) int of (row, top, left), (top, left, bottom, right))
+				maskList: list of (row, RoiMask)
+				rows, polygonPixels, starts, flatIdx: gathered polygons, flatIdx is all their pixels concatenated
+				blockBytes: bytes we use per image of a block
+		"""
+		stats, percentiles = parsePolygonStats(stats)
+
+		# split into axis aligned rectangles, big polygons (bounding box and mask) and everything else (gather)
+		roiMasks = {} # row: RoiMask
+		rectangleGroups = {} # (height, width): list of (row, top, left)
+		maskList = [] # list of (row, RoiMask)
+		gatherList = [] # list of (row, flat pixel index)
+		def gatherOrMask(idx):
+			roiMask = roiMasks[idx]
+			if roiMask.bounds is not None and len(roiMask) >= minMaskPixels:
+				maskList.append((idx, roiMask))
+			else:
+				gatherList.append((idx, roiMask.flatIndex()))
+		with timer('rasterize'):
+			for idx, data in enumerate(dataList):
+				roiMask = RoiMask(data, self.imageShape)
+				if roiMask.isEmpty:
+					print('stackPolygonStats() got empty analysis polygon:', idx)
+					continue
+				roiMasks[idx] = roiMask
+				if roiMask.bounds is not None and roiMask.mask is None:
+					# every pixel of the bounding box
+					rowSlice, colSlice = roiMask.bounds
+					height, width = rowSlice.stop - rowSlice.start, colSlice.stop - colSlice.start
+					rectangleGroups.setdefault((height, width), []).append((idx, rowSlice.start, colSlice.start))
+				else:
+					gatherOrMask(idx)
+
+		# summed area table and min/max filter cost a few images (cropped to the rectangles of one size),
+		# only use them when gathering the pixels would cost more, and never for order statistics
+		filterGroups = []
+		for (height, width), group in sorted(rectangleGroups.items(), key=lambda item: -len(item[1])):
+			group = np.asarray(group, dtype=np.int64)
+			bounds = (group[:,1].min(), group[:,2].min(), group[:,1].max() + height, group[:,2].max() + width)
+			boundsPixels = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+			if len(percentiles) == 0 and len(filterGroups) < maxRectangleSizes and len(group) * height * width >= minOverlap * boundsPixels:
+				filterGroups.append(((height, width), group, bounds))
+			else:
+				for idx, top, left in group:
+					gatherOrMask(idx)
+
+		plan = {
+			'stats': stats,
+			'percentiles': percentiles,
+			'filterGroups': filterGroups,
+			'maskList': maskList,
+			'numPixels': 0,
+		}
+		# flat pixel index of all gathered polygons, concatenated
+		if len(gatherList) > 0:
+			polygonPixels = np.asarray([len(flatIdx) for idx, flatIdx in gatherList]) # number of pixels in each polygon
+			plan['rows'] = np.asarray([idx for idx, flatIdx in gatherList])
+			plan['polygonPixels'] = polygonPixels
+			plan['starts'] = np.concatenate([[0], np.cumsum(polygonPixels)[:-1]]) # start of each polygon in flatIdx
+			plan['flatIdx'] = np.concatenate([flatIdx for idx, flatIdx in gatherList])
+			plan['numPixels'] = len(plan['flatIdx'])
+
+		numPixels = plan['numPixels']
+		blockBytes = numPixels * 8
+		if 'sd' in stats or len(percentiles) > 0:
+			# deviations from the mean, gathered pixels of each size for order statistics
+			blockBytes += numPixels * 8
+		if len(filterGroups) > 0:
+			blockBytes += int(np.prod(self.imageShape)) * 8 * (6 if 'sd' in stats else 4) # summed area tables and filtered images
+		plan['blockBytes'] = blockBytes * self.numChannels
+		return plan
+
+	def _reducePolygonBlock(self, plan, block, start, results):
+		"""
+		Reduce all polygons of a plan from a block of images, see stackPolygonStats()
+
+		Parameters:
+			plan: from _planPolygons()
+			block: (images, rows, cols) or (images, channels, rows, cols), images start at start
+			results: from _newPolygonResults(), we fill in [..., start:start+images]
+		"""
+		stop = start + block.shape[0]
+		stats, percentiles = plan['stats'], plan['percentiles']
+		# reductions are over the last (pixel) axis, with 4d data there is a channel axis before it
+		# (images, channels, polygons).T is (polygons, channels, images)
+		if len(plan['filterGroups']) > 0:
+			with timer('reduce.rectangles'):
+				self._rectangleAnalysis(block, plan['filterGroups'], start, results)
+		with timer('reduce.masks'):
+			for idx, roiMask in plan['maskList']:
+				values = roiMask.values(block) # (images, pixels)
+				maskStats = segmentStats(values, [0], [values.shape[-1]], stats, percentiles)
+				for name, value in maskStats.items():
+					results[name][idx, ..., start:stop] = value[..., 0].T
+		if plan['numPixels'] == 0:
+			return
+		imagePixels = int(np.prod(self.imageShape))
+		flatBlock = block.reshape(block.shape[:-2] + (imagePixels,))
+		if len(percentiles) == 0 and useKernels(block.dtype):
+			# compiled gather and reduce, no (images, pixels) array of values
+			with timer('reduce.kernel'):
+				gatherStats = gatherSegmentStats(flatBlock, plan['flatIdx'], plan['starts'], plan['polygonPixels'], stats)
+		else:
+			with timer('read'):
+				# (images, pixels of all polygons)
+				values = np.take(flatBlock, plan['flatIdx'], axis=-1)
+			with timer('reduce'):
+				gatherStats = segmentStats(values, plan['starts'], plan['polygonPixels'], stats, percentiles)
+		with timer('reduce'):
+			for name, value in gatherStats.items():
+				results[name][plan['rows'], ..., start:stop] = value.T
+
+	def _rectangleAnalysis(self, block, filterGroups, start, results):
+		"""
+		min/max/mean (and sum/n/sd) of groups of same size rectangles in a block of images, see stackPolygonStats()
+
+		nan are ignored like np.nanmin/np.nanmax/np.nanmean
+
+		block is (images, rows, cols) or (images, channels, rows, cols), channels are filtered as more images
+		results: dict of name to (polygons, [channels,] images), we fill in the rows of our rectangles
+		"""
+		stop = start + block.shape[0]
+		leadingShape = block.shape[:-2]
+		block = block.reshape((-1,) + block.shape[-2:])
+		def toResult(values):
+			# (images * channels, rectangles) to (rectangles, channels, images)
+			return values.reshape(leadingShape + values.shape[-1:]).T
+		hasNan = block.dtype.kind == 'f' and np.isnan(block).any()
+		if hasNan:
+			isNan = np.isnan(block)
+			sat = integralImage(np.where(isNan, 0, block))
+			countSat = integralImage(~isNan)
+		else:
+			sat = integralImage(block)
+		if 'sd' in results:
+			# sum of squares of pixels minus the mean of each image, so big values do not cancel
+			with np.errstate(invalid='ignore', divide='ignore'):
+				shift = np.nan_to_num(sat[:, -1, -1] / (countSat[:, -1, -1] if hasNan else block[0].size))
+			shifted = block - shift[:, np.newaxis, np.newaxis]
+			squaresSat = integralImage(np.where(isNan, 0, shifted * shifted) if hasNan else shifted * shifted)
+		for (height, width), group, (top, left, bottom, right) in filterGroups:
+			rows, r0, c0 = group[:,0], group[:,1], group[:,2]
+			boxes = np.column_stack([r0, c0, r0 + height, c0 + width])
+			sums = rectangleSums(sat, boxes)
+			counts = rectangleSums(countSat, boxes) if hasNan else np.full(sums.shape, height * width)
+			with np.errstate(invalid='ignore', divide='ignore'):
+				mean = sums / counts
+				results['mean'][rows, ..., start:stop] = toResult(mean)
+				if 'sd' in results:
+					shiftedMean = mean - shift[:, np.newaxis]
+					variance = rectangleSums(squaresSat, boxes) / counts - shiftedMean * shiftedMean
+					results['sd'][rows, ..., start:stop] = toResult(np.sqrt(np.maximum(variance, 0)))
+			if 'sum' in results:
+				results['sum'][rows, ..., start:stop] = toResult(sums)
+			if 'n' in results:
+				results['n'][rows, ..., start:stop] = toResult(counts)
+
+			# min/max filter of (height, width) centered on pixel (i, j) covers i - height//2 ... i + (height-1)//2
+			crop = block[:, top:bottom, left:right]
+			centerRows = r0 - top + height // 2
+			centerCols = c0 - left + width // 2
+			minCrop = np.where(isNan[:, top:bottom, left:right], np.inf, crop) if hasNan else crop
+			maxCrop = np.where(isNan[:, top:bottom, left:right], -np.inf, crop) if hasNan else crop
+			mins = scipy.ndimage.minimum_filter(minCrop, size=(1, height, width))[:, centerRows, centerCols]
+			maxs = scipy.ndimage.maximum_filter(maxCrop, size=(1, height, width))[:, centerRows, centerCols]
+			if hasNan:
+				# all nan
+				mins[counts == 0] = np.nan
+				maxs[counts == 0] = np.nan
+			results['min'][rows, ..., start:stop] = toResult(mins)
+			results['max'][rows, ..., start:stop] = toResult(maxs)
+
+	def lineProfile(self, slice, src, dst, linewidth=3, doFit=True, channel=None):
 		""" one slice
 
+		linewidth: width of the line in pixels, e.g. napari edge_width of the line shape
+		channel: for 4d data, default is self.displayChannel
+
 		Returns:
 
 		x: ndarray, one point for each point in the profile (NOT images/slice in stack)
 		"""
-		'''
-		print('!!!! lineProfile() slice:', slice, 'src:', src, 'dst:', dst)
-		print('   slice:', slice)
-		print('   src:', src, type(src))
-		print('   dst:', dst, type(dst))
-		print('   self.data.shape:', self.data.shape)
-		print('   linewidth:', linewidth, type(linewidth))
-		'''
-		#channel = 0
-		#intensityProfile = profile.profile_line(self.stack.stack[channel,slice,:,:], src, dst, linewidth=linewidth)
+		if channel is None:
+			channel = self.displayChannel
 		try:
 			#print('self.data[slice,:,:].shape', self.data[slice,:,:].shape)
-			intensityProfile = profile.profile_line(self.data[slice,:,:], src, dst, linewidth=linewidth)
-			x = np.asarray([a for a in range(len(intensityProfile))]) # make alist of x points (todo: should be um, not points!!!)
+			with timer('sample'):
+				image = self.data[channel,slice,:,:] if self.hasChannels else self.data[slice,:,:]
+				# the same sampling as stack analysis, see stackLineProfiles()
+				intensityProfile = LineSampler([(src, dst)], self.imageShape, linewidth).sample(image)[0]
+			x = np.arange(len(intensityProfile)) # x points (todo: should be um, not points!!!)
 			yFit, FWHM, left_idx, right_idx = self.fitGaussian(x,intensityProfile)
 		except ValueError as e:
 			print('!!!!!!!!!! *********** !!!!!!!!!!!!! my exception in lineProfile() ... too many values to unpack (expected 2)')
 			print('e:', e)
 			return (None, None, None, None, None, None)
-		'''
-		print('lineProfile() slice:', slice)
-		print('   x.shape:', x.shape)
-		print('   intensityProfile.shape:', intensityProfile.shape)
-		print('   yFit.shape:', yFit.shape)
-		print('   FWHM:', FWHM, 'left_idx:', left_idx, 'right_idx:', right_idx)
-		'''
 		return (x, intensityProfile, yFit, FWHM, left_idx, right_idx)
 
-	def lineProfile2(self, slice):
-		""" one slice
+	def _newLineResults(self, numPoints):
+		"""
+		Preallocate results of stackLineProfile(), all nan, big ones are disk backed (see ResultStore)
 
-		Returns:
+		For 4d data each has a leading channel axis
 
-		x: ndarray, one point for each point in the profile (NOT images/slice in stack)
+		Returns:
+			dict of result name to ndarray, keys are ShapeList result names
 		"""
-		if slice % 300 == 0:
-			print('   worker lineProfile2() slice:', slice, 'of', self.numImages)
-		try:
-			intensityProfile = profile.profile_line(self.data[slice,:,:], self.src, self.dst, linewidth=self.linewidth)
-			x = np.asarray([a for a in range(len(intensityProfile))]) # make alist of x points (todo: should be um, not points!!!)
-			yFit, FWHM, left_idx, right_idx = self.fitGaussian(x,intensityProfile)
-		except ValueError as e:
-			print('!!!!!!!!!! *********** !!!!!!!!!!!!! my exception in lineProfile2() ... too many values to unpack (expected 2)')
-			print('e:', e)
-			return (None, None, None, None, None, None)
-		return (x, intensityProfile, yFit, FWHM, left_idx, right_idx)
+		channelShape = (self.numChannels,) if self.hasChannels else ()
+		numImages = self.numImages
+		allocate = self.resultStore.allocate
+		return {
+			'lineKymograph': allocate(channelShape + (numImages, numPoints), np.float32),
+			'lineDiameter': allocate(channelShape + (numImages,), np.float32),
+			'lineLeft': allocate(channelShape + (numImages,), np.float32),
+			'lineRight': allocate(channelShape + (numImages,), np.float32),
+			'lineFitParams': allocate(channelShape + (numImages, 3), np.float32),
+		}
 
 	def stackLineProfile(self, src, dst, linewidth=3):
 		"""
 		calculate line profile for each slice in a stack
-		todo: fix the logic here, my self.lineProfile is returning too much
-		"""
-		print('stackLineProfile() src:', src, 'dst:', dst)
-		print('   line length:', self.euclideanDistance(src, dst))
-
-		xList = []
-		intensityProfileList = [] # each element is intensity profile for one slice/image
-		fwhmList = [] # each element is intensity profile for one slice/image
-		# not sure what is going on here
-		# a 3d stack of cd31 staining takes 3x longer when using multiprocessing?
-		doSingleThread= False
-		if doSingleThread or self.numImages < 500:
-			print('   stackLineProfile performing loop through images')
-			startTime = time.time()
-			for idx, slice in enumerate(range(self.numImages)): # why do i need -1 ???
-				if idx % 300 == 0:
-					print('   idx:', idx, 'of', self.numImages)
-				x, intensityProfile, yFit, fwhm, left_idx, right_idx = self.lineProfile(slice, src, dst, linewidth=linewidth, doFit=True)
-				xList.append(x)
-				intensityProfileList.append(intensityProfile)
-				fwhmList.append(fwhm)
-				#print(idx, fwhm)
-			stopTime = time.time()
-			print('1) single-thread line profile for', self.numImages, 'slices took', round(stopTime-startTime,3))
+
+		linewidth: width of the line in pixels, e.g. napari edge_width of the line shape
+
+		Returns:
+			x: ndarray of points along the line, the same for all slices
+			results: dict of float32 ndarray (or np.memmap), one row per slice, nan where analysis failed
+				lineKymograph: (slices, points) intensity profile
+				lineDiameter: (slices) full width at half maximal
+				lineLeft, lineRight: (slices) index into x of the fwhm edges
+				lineFitParams: (slices, 3) gaussian fit (amplitude, mean, stddev)
+				lineKymographOverview, lineKymographHistogram, lineKymographEdges, lineKymographLevels:
+					for display, see kymographSummary()
+				for 4d data, all channels of each image are sampled at once,
+					lineKymographChannels, lineDiameterChannels, ... have a leading channel axis
+					and lineKymograph, lineDiameter, ... are self.displayChannel
+		"""
+		return self.stackLineProfiles([(src, dst)], linewidth=linewidth)[0]
+
+	def stackLineProfiles(self, lineList, linewidth=3):
+		"""
+		Line profile of many lines for each slice in a stack, in one pass over the stack
+
+		The sample points of all lines are computed once (see LineSampler) and
+		every line is sampled from each block of images, then profiles are fit in a
+		multiprocessing pool (see analyzeAll).
+
+		Parameters:
+			lineList: list of (src, dst)
+			linewidth: int, or list with the width of each line, e.g. napari edge_width of each line shape
+
+		Returns:
+			list with (x, results) of each line, see stackLineProfile()
+		"""
+		lineResults, polygonResults = self.analyzeAll(lineList, [], linewidth=linewidth)
+		return lineResults
+
+	@timed('analyzeAll')
+	def analyzeAll(self, lineList, polygonList, linewidth=3, stats=None, maxBlockBytes=64 * 1024**2):
+		"""
+		Analyze many lines and polygons in one pass over the stack
+
+		Each block of images is read once, no matter how many shapes. While a block is in memory we reduce
+		every polygon (see stackPolygonStats) and sample the profile of every line (see LineSampler).
+		Gaussian fits of all line profiles are then done in a multiprocessing pool,
+		workers are sent profiles, not the stack.
+
+		Parameters:
+			lineList: list of (src, dst)
+			polygonList: list of (n,2) vertex points
+			linewidth: int, or list of int with one width per line
+			stats: polygon statistics besides min/max/mean, if None then self.polygonStats
+
+		Returns:
+			lineResults: list with (x, results) of each line, like stackLineProfile()
+			polygonResults: dict like stackPolygonStats()
+		"""
+		if stats is None:
+			stats = self.polygonStats
+		plan = self._planPolygons(polygonList, stats)
+		polygonResults = self._newPolygonResults(len(polygonList), plan['stats'])
+		sampler = LineSampler(lineList, self.imageShape, linewidth)
+		lineResults = [self._newLineResults(numPoints) for numPoints in sampler.numPoints]
+		# profiles as sampled, to fit, profiles of integer images are float64 and lineKymograph is float32
+		lineProfiles = [None] * len(sampler)
+
+		count('polygon.slices', self.numImages * len(polygonList))
+		count('line.slices', self.numImages * len(lineList))
+		# sampled pixels of all lines and their mean across the line
+		blockBytes = plan['blockBytes'] + sampler.numSamples * 8 * 2 * self.numChannels
+		blockImages = max(1, maxBlockBytes // max(blockBytes, 1))
+		for start in range(0, self.numImages, blockImages):
+			stop = min(start + blockImages, self.numImages)
+			with timer('read'):
+				block = self._readImages(slice(start, stop))
+			self._reducePolygonBlock(plan, block, start, polygonResults)
+			if len(sampler) == 0:
+				continue
+			with timer('sample'):
+				profiles = sampler.sample(block)
+			for idx, oneProfile in enumerate(profiles):
+				# (images, [channels,] points) to ([channels,] images, points)
+				oneProfile = np.moveaxis(oneProfile, 0, -2)
+				kymograph = lineResults[idx]['lineKymograph']
+				kymograph[..., start:stop, :] = oneProfile
+				if oneProfile.dtype != kymograph.dtype:
+					if lineProfiles[idx] is None:
+						lineProfiles[idx] = self.resultStore.allocate(kymograph.shape, oneProfile.dtype)
+					lineProfiles[idx][..., start:stop, :] = oneProfile
+		count('polygon.rectanglesFiltered', sum(len(group) for size, group, bounds in plan['filterGroups']))
+
+		for idx, results in enumerate(lineResults):
+			if lineProfiles[idx] is None:
+				lineProfiles[idx] = results['lineKymograph']
+		self._fitLineResults(lineResults, lineProfiles)
+
+		for idx, results in enumerate(lineResults):
+			results = self._splitChannels(results)
+			results.update(kymographSummary(results['lineKymograph']))
+			lineResults[idx] = (np.arange(sampler.numPoints[idx]), results)
+		return lineResults, polygonResults
+
+	def _fitLineResults(self, lineResults, lineProfiles, chunkImages=200):
+		"""
+		Gaussian fit of the profile of each slice of each line, see analyzeAll()
+
+		Parameters:
+			lineResults: list of dict from _newLineResults() with lineKymograph filled in,
+				we fill in lineDiameter, lineLeft, lineRight, lineFitParams
+			lineProfiles: list of ([channels,] images, points) profiles of each line to fit
+			chunkImages: slices of one line sent to a worker at once
+		"""
+		chunks = [(lineIdx, start, min(start + chunkImages, self.numImages))
+					for lineIdx in range(len(lineResults)) for start in range(0, self.numImages, chunkImages)]
+		def profileChunks():
+			for lineIdx, start, stop in chunks:
+				# ([channels,] images, points) to (images, [channels,] points)
+				yield np.moveaxis(np.asarray(lineProfiles[lineIdx][..., start:stop, :]), -2, 0)
+
+		numProfiles = len(lineResults) * self.numImages
+		if self.doSingleThread or numProfiles < self.minParallelImages:
+			with timer('fit.single'):
+				fits = map(fitProfiles, profileChunks())
+				self._setFitResults(lineResults, chunks, fits)
 		else:
-			# threaded
-			print('   running line profile for all slices in PARALLEL, numImages:', self.numImages)
 			numCPU = multiprocessing.cpu_count()
-			# the time this takes will depend on (line length, complexity of fit, chunk size)
-			# longer line and more complex fit can go from 15 seconds to 30 seconds
-			# this seems variable, from run to run it can go from 15 sec to 30 sec???
-			# if fit is reasonable, it is 15 sec, if fit is absurd, it is 30 sec !!!
-			chunksize = numCPU * 100 #50 takes 20 sec, 100 takes 15 sec, 200 takes 18.5 sec, 400 takes 41 sec
-			print('   num cpu:', numCPU, 'chunksize:', chunksize)
-
-			self.src = src
-			self.dst = dst
-			self.linewidth = linewidth
-			myIterable = [a for a in range(self.numImages)] # list of all slice numbers
-			startTime = time.time()
-			with multiprocessing.Pool(processes=numCPU-1) as p:
-				# was this
-				#xList, intensityProfileList, yFit, fwhmList, left_idx, right_idx = zip(*p.starmap(self.lineProfile, poolParams, chunksize=chunksize))
-				xList, intensityProfileList, yFit, fwhmList, left_idx, right_idx = zip(*p.imap(self.lineProfile2, myIterable, chunksize=chunksize))
-			#print('   type(fwhmList):', type(fwhmList))
-			stopTime = time.time()
-			print('2) multi-thread line-profile for', self.numImages, 'slices took', round(stopTime-startTime,3))
-
-		#xArray = np.array(xList)
-		#intensityProfileList = np.array(intensityProfileList)
-		#fwhm = np.array(fwhm)
-		return np.asarray(xList), np.asarray(intensityProfileList), np.asarray(fwhmList)
+			# timers in workers are not seen here, time the whole pool
+			with timer('fit.multi'):
+				with multiprocessing.Pool(processes=max(1, numCPU-1)) as p:
+					self._setFitResults(lineResults, chunks, p.imap(fitProfiles, profileChunks()))
+
+	def _setFitResults(self, lineResults, chunks, fits):
+		""" store the return of fitProfiles() for each (line, start, stop) chunk """
+		for (lineIdx, start, stop), (popt, fwhm, left, right, failed) in zip(chunks, fits):
+			results = lineResults[lineIdx]
+			# (images, [channels,] ...) to ([channels,] images, ...)
+			results['lineFitParams'][..., start:stop, :] = np.moveaxis(popt, 0, -2)
+			results['lineDiameter'][..., start:stop] = np.moveaxis(fwhm, 0, -1)
+			results['lineLeft'][..., start:stop] = np.moveaxis(left, 0, -1)
+			results['lineRight'][..., start:stop] = np.moveaxis(right, 0, -1)
+			for slice in start + np.nonzero(failed)[0]:
+				results['lineKymograph'][..., slice, :] = np.nan
 
 	def euclideanDistance(self, pnt1, pnt2):
 		"""
@@ -6,19 +6,20 @@
 
 	For each image in a stack or time-series,
 		For 'line' shape, calculates the width from the intensity profile.
-		For 'rectangle' shape, calculates mean/min/max/sd/n
+		For 'rectangle' shape, calculates mean/min/max/sd/n/sum (and median/percentiles with ShapeAnalysis.polygonStats, see ShapeAnalysis.stackPolygonStats)
 
 	Saves/loads shape analysis dictionaries and image files (kymographs) in h5f file.
 
 	Requires:
 	 - ShapeAnalysis.py
+	 - ShapeList.py and ShapeFile.py
 
 	Important:
-	 - We are managing self.shapeLayer.metadata, append on new, pop on delete
+	 - Shapes and their analysis are kept in a headless ShapeList (self.shapeList).
+	   This plugin is a thin adapter between the napari shapes layer and ShapeList.
+	 - self.shapeLayer.metadata is self.shapeList.metadata, we add on new and pop on delete
 
 	Todo:
-	 - Line analysis needs to use napari line 'edge_width' it is currently defaulting to 1 pixel
-	 	See calls to self.analysis.lineProfile()
 	 - rewrite code to use native napari plotting with VisPy, we are currently using PyQtGraph
 	 - Work with napari developers to create API to manage shapes (add, delete, move, drag vertex, etc. etc.)
 	 - Detatch from pImpy and make a simple 2 file standalone github repo (bShapeAnalysisWidget.py, bShapeAnalysis.py)
@@ -32,19 +33,36 @@
 	   https://github.com/napari/napari/issues/719
 """
 
-import os, time, json
+import os
 import numpy as np
-import h5py
-
-import scipy.ndimage
 
 import napari
+from PyQt5 import QtWidgets
 
 #import vispy.app
 #import vispy.plot as vp
 
-from ShapeAnalysis import ShapeAnalysis # backend analysis
-from myPyQtGraphWidget import myPyQtGraphWidget
+try:
+	from .ShapeAnalysis import ShapeAnalysis, filterStack # backend analysis
+	from .ShapeList import ShapeList # backend list of shapes and their analysis
+	from .ShapeFile import saveShapeFileInBackground, loadShapeFile # backend h5f file
+	from .ResultStore import ResultStore # backend disk backed results
+	from .Instrumentation import timer, count # named timers, see SHAPEANALYSIS_INSTRUMENT
+	from .RoiImport import gridRectangles, importShapes # backend bulk shapes
+	from .TraceAnalysis import defaultBaselineWindow, polygonTraceResults, updateNormalizedTraces # backend normalized traces
+	from .TraceAnalysis import defaultRollingWindow, defaultRollingPercentile, defaultRatioPair, updateRollingTraces
+	from .myPyQtGraphWidget import myPyQtGraphWidget
+except ImportError:
+	# when ShapeAnalysisPlugin.py is run as a script
+	from ShapeAnalysis import ShapeAnalysis, filterStack # backend analysis
+	from ShapeList import ShapeList # backend list of shapes and their analysis
+	from ShapeFile import saveShapeFileInBackground, loadShapeFile # backend h5f file
+	from ResultStore import ResultStore # backend disk backed results
+	from Instrumentation import timer, count # named timers, see SHAPEANALYSIS_INSTRUMENT
+	from RoiImport import gridRectangles, importShapes # backend bulk shapes
+	from TraceAnalysis import defaultBaselineWindow, polygonTraceResults, updateNormalizedTraces # backend normalized traces
+	from TraceAnalysis import defaultRollingWindow, defaultRollingPercentile, defaultRatioPair, updateRollingTraces
+	from myPyQtGraphWidget import myPyQtGraphWidget
 
 class ShapeAnalysisPlugin:
 	"""
@@ -78,7 +96,7 @@ class ShapeAnalysisPlugin:
 		scale = (1,1,1) #(1,0.2,0.2)
 		self.myImageLayer = self.napariViewer.add_image(
 			#self.myStack.stack[0,:,:,:],
-			path = path,
+			path = imagePath,
 			colormap=colormap,
 			scale=scale)
 
@@ -88,7 +106,15 @@ class ShapeAnalysisPlugin:
 
 		# analysis back-end to calculate diameter of lines and mean intensity of rectangles
 		# this uses multiprocessing
-		self.analysis = ShapeAnalysis(self.imageData) # self.imageData is a property
+		# big results (kymographs of long recordings) are np.memmap in a temporary folder
+		self.resultStore = ResultStore()
+		self.analysis = ShapeAnalysis(self.imageData, resultStore=self.resultStore) # self.imageData is a property
+		# (start, stop) slices used as F0 for new polygon analysis, see setBaselineWindow()
+		self.baselineWindow = defaultBaselineWindow
+		# rolling percentile F0 and channel ratio (4d data) of polygon traces, see setRollingBaseline()
+		self.rollingWindow = defaultRollingWindow
+		self.rollingPercentile = defaultRollingPercentile
+		self.ratioPair = defaultRatioPair
 
 		#
 		# make an empty shape layer
@@ -96,10 +122,13 @@ class ShapeAnalysisPlugin:
 			name=self.myImageLayer.name + '_shapes',
 		)
 		self.shapeLayer.mode = 'select' #'select'
-		self.shapeLayer.metadata = [] # we need to append/pop from this as we create/delete shapes
+
+		# backend list of shapes and analysis, we need to add/pop from this as we create/delete shapes
+		self.shapeList = ShapeList()
+		self.shapeLayer.metadata = self.shapeList.metadata
 
 		# instantiate the main window to hold all shape analysis plots
-		self.myPyQtGraphWidget =  myPyQtGraphWidget(self.shapeLayer)
+		self.myPyQtGraphWidget =  myPyQtGraphWidget(self.shapeList)
 
 		"""
 		# not sure what these were doing ?
@@ -112,6 +141,9 @@ class ShapeAnalysisPlugin:
 		#self.shapeLayer.events.removed.connect(self.layerChangeEvent)
 		"""
 
+		# line analysis uses the edge width of the line shape
+		self.shapeLayer.events.edge_width.connect(self.edgeWidthChange_callback)
+
 		# callback for user changing slices
 		self.napariViewer.dims.events.axis.connect(self.my_update_slider)
 
@@ -155,9 +187,11 @@ class ShapeAnalysisPlugin:
 			print('=== ShapeAnalysisWidget Help')
 			print('l:               Create new line shape')
 			print('r:               Create new rectangle shape')
+			print('g:               Create a grid of rectangle shapes over the image and analyze them')
 			print('Delete:          Delete selected shape')
 			print('u:               Update analysis on selected shape')
-			print('Command+Shift+L: Load h5f file (prompt user for file)')
+			print('Shift+u:         Update analysis of all shapes, in one pass over the stack')
+			print('Command+Shift+L: Import shapes from .h5/.csv/label image file (prompt user for file)')
 			print('Command+l:       Load default h5f file (each .tif has corresponding h5f file)')
 			print('Command+s:       Save default h5f file (each .tif has corresponding h5f file)')
 
@@ -173,6 +207,12 @@ class ShapeAnalysisPlugin:
 			print('=== shape_user_keyboard_r() layer:', layer)
 			self.addNewDefaultRectangle()
 
+		@self.shapeLayer.bind_key('g', overwrite=True)
+		def shape_user_keyboard_g(layer):
+			""" create/add a grid of rectangle shapes and analyze them """
+			print('=== shape_user_keyboard_g() layer:', layer)
+			self.addRectangleGrid()
+
 		@self.shapeLayer.bind_key('Backspace', overwrite=True)
 		def shape_user_keyboard_Backspace(layer):
 			""" delete selected shape """
@@ -185,10 +225,19 @@ class ShapeAnalysisPlugin:
 			print('=== user_keyboard_u')
 			self.updateAnalysis()
 
+		@self.napariViewer.bind_key('Shift-u')
+		def user_keyboard_shift_u(viewer):
+			""" analyze all shapes """
+			print('=== user_keyboard_shift_u')
+			self.analyzeAll()
+
 		@self.napariViewer.bind_key('Control-Shift-l')
 		def loadOtherFile(viewer):
 			print('=== loadOtherFile')
-			#self.load()
+			path, filter = QtWidgets.QFileDialog.getOpenFileName(None, 'Import shapes', os.path.dirname(self.path),
+							'Shapes (*.h5 *.h5f *.csv *.npy *.tif *.tiff *.png)')
+			if path:
+				self.importShapesFile(path)
 
 		@self.napariViewer.bind_key('Control-l', overwrite=True)
 		def user_keyboar_l(viewer):
@@ -203,10 +252,7 @@ class ShapeAnalysisPlugin:
 	def filterImage(self):
 		""" not working, just playing around """
 		print('filterImage() is creating gaussian filtered image:', self.myImageLayer.data.shape)
-		startTime = time.time()
-		self.filtered = scipy.ndimage.gaussian_filter(self.myImageLayer.data, sigma=1)
-		stopTime = time.time()
-		print('   took', round(stopTime-startTime,2), 'seconds')
+		self.filtered = filterStack(self.myImageLayer.data, sigma=1)
 
 	def _deleteShape(self):
 		""" Delete selected shape, from napari and from myPyQtGraphWidget """
@@ -229,8 +275,9 @@ class ShapeAnalysisPlugin:
 			# delete from napari
 			# order matters, this has to be after (1) above
 			self.shapeLayer.remove_selected() # remove from napari
-			# we are managing metadata list (append on new shape, pop on delete)
-			self.shapeLayer.metadata.pop(index)
+			# we are managing shape list (add on new shape, pop on delete)
+			self.analysis.discardPolygon(self.shapeList.ids[index])
+			self.shapeList.pop(index)
 		except (IndexError) as e:
 			print('Exception in _deleteShape() e:', str(e))
 
@@ -248,15 +295,11 @@ class ShapeAnalysisPlugin:
 			face_color = 'royalblue',
 			opacity = shapeDict['opacity'])
 
-		metaDataDict = {
-			'lineDiameter': np.zeros((0)),
-			'lineKymograph': np.zeros((1,1)),
-			'polygonMin': np.zeros((0)),
-			'polygonMax': np.zeros((0)),
-			'polygonMean': np.zeros((0)),
-		}
-
-		self.shapeLayer.metadata.append(metaDataDict)
+		self.shapeList.add(shapeDict['data'], shapeDict['shape_type'],
+			edge_width = shapeDict['edge_width'],
+			edge_color = 'coral',
+			face_color = 'royalblue',
+			opacity = shapeDict['opacity'])
 
 	def addNewDefaultLine(self):
 		"""
@@ -272,9 +315,9 @@ class ShapeAnalysisPlugin:
 		}
 		self._addNewShape(shapeDict)
 
-		# analyze one line
+		# analyze one line, as wide as the shape
 		sliceNum = self.sliceNum
-		x, oneProfile, fit, fwhm, leftIdx, rightIdx = self.analysis.lineProfile(sliceNum, src, dst, linewidth=1, doFit=True)
+		x, oneProfile, fit, fwhm, leftIdx, rightIdx = self.analysis.lineProfile(sliceNum, src, dst, linewidth=shapeDict['edge_width'], doFit=True)
 
 		# update plot
 		self.myPyQtGraphWidget.updateLinePlot(x, oneProfile, fit=fit, leftIdx=leftIdx, rightIdx=rightIdx)
@@ -291,154 +334,178 @@ class ShapeAnalysisPlugin:
 		}
 		self._addNewShape(shapeDict)
 
+	def addShapes(self, newShapes, analyze=True):
+		"""
+		Add many shapes at once, in one napari shapesLayer.add()
+
+		Parameters:
+			newShapes: ShapeList, e.g. from RoiImport
+			analyze: if True, analyze new rectangle/polygon shapes that do not have analysis, in one pass over the stack
+		"""
+		if len(newShapes) == 0:
+			return
+		with timer('addShapes'):
+			firstIndex = len(self.shapeList)
+
+			# we are not passing (edge_color, face_color), see load()
+			self.shapeLayer.add(
+				newShapes.data,
+				shape_type = newShapes.shape_types,
+				edge_width = newShapes.edge_widths,
+				)
+			self.shapeList.extend(newShapes)
+
+			if analyze:
+				indexList = [idx for idx in range(firstIndex, len(self.shapeList))
+								if self.shapeList.shape_types[idx] in ['rectangle', 'polygon']
+								and len(self.shapeList.metadata[idx]['polygonMean']) == 0]
+				self.analyzePolygons(indexList)
+		count('addShapes.shapes', len(newShapes))
+
+		self.updatePlots(updatePolygons=True)
+
+	def addRectangleGrid(self, roiSize=(20,20), spacing=5, region=None):
+		"""
+		Add a grid of rectangle shapes and analyze them, in response to user keyboard 'g'
+
+		Parameters:
+			roiSize: (height, width) of each rectangle
+			spacing: pixels between rectangles
+			region: (top, left, bottom, right), if None then the whole image
+		"""
+		if region is None:
+			height, width = self.analysis.imageShape
+			region = (0, 0, height, width)
+		self.addShapes(gridRectangles(region, roiSize, spacing=spacing))
+
+	def importShapesFile(self, path):
+		""" add shapes from a .h5/.csv/label image file, see RoiImport.importShapes() """
+		self.addShapes(importShapes(path))
+
+	def analyzePolygons(self, indexList):
+		"""
+		Analyze many rectangle/polygon shapes in one pass over the stack
+
+		Parameters:
+			indexList: list of shape index
+		"""
+		if len(indexList) == 0:
+			return
+		# shapes the user moved since the last save
+		self._syncShapeList()
+		# min/max/mean and analysis.polygonStats (sd, n, ...)
+		stats = self.analysis.stackPolygonStats([self.shapeList.data[idx] for idx in indexList])
+		self._setPolygonStats(indexList, stats)
+
+	def _setPolygonStats(self, indexList, stats):
+		""" store one row of stackPolygonStats() in each polygon shape, with normalized traces """
+		for row, idx in enumerate(indexList):
+			# 4d data has all channels, see ShapeAnalysis.polygonResults()
+			rowStats = {name: value[row] for name, value in stats.items()}
+			results = self.analysis.polygonResults(rowStats['min'], rowStats['max'], rowStats['mean'], rowStats)
+			results.update(polygonTraceResults(results['polygonMean'], self.baselineWindow))
+			self.shapeList.setResults(idx, results)
+		# all new polygons at once
+		self._updateRollingTraces(indexList)
+
+	def analyzeAll(self):
+		"""
+		Analyze all line and rectangle/polygon shapes in one pass over the stack, in response to user keyboard 'Shift-u'
+
+		Each image is read once, no matter how many shapes, see ShapeAnalysis.analyzeAll()
+		"""
+		# geometry (and line widths) as they are in napari now, not at the last save
+		self._syncShapeList()
+		lineIndices = self.shapeList.shapeIndices('line')
+		polygonIndices = self.shapeList.shapeIndices('rectangle') + self.shapeList.shapeIndices('polygon')
+		if len(lineIndices) + len(polygonIndices) == 0:
+			return
+		lineList = [(self.shapeList.data[idx][0], self.shapeList.data[idx][1]) for idx in lineIndices]
+		polygonList = [self.shapeList.data[idx] for idx in polygonIndices]
+		# each line is as wide as its shape
+		lineWidths = [self._lineWidth(idx) for idx in lineIndices]
+		lineResults, polygonStats = self.analysis.analyzeAll(lineList, polygonList, linewidth=lineWidths)
+		for idx, (x, results) in zip(lineIndices, lineResults):
+			self.shapeList.setResults(idx, results)
+		if len(polygonIndices) > 0:
+			self._setPolygonStats(polygonIndices, polygonStats)
+		self.updatePlots(updatePolygons=True)
+
 	def _getSavePath(self):
 		path, filename = os.path.split(self.path)
 		savePath = os.path.join(path, os.path.splitext(filename)[0] + '.h5')
 		return savePath
 
+	def _syncShapeList(self):
+		"""
+		Copy geometry and drawing parameters from napari shapes layer into self.shapeList
+
+		napari owns geometry while the user is editing (drag, move, etc.)
+
+		Only shapes that changed are marked dirty (and saved)
+		"""
+		for idx in range(len(self.shapeList)):
+			self.shapeList.setData(idx, self.shapeLayer.data[idx])
+			self.shapeList.setStyle(idx,
+				edge_width = self.shapeLayer.edge_widths[idx],
+				edge_color = self.shapeLayer.edge_colors[idx],
+				face_color = self.shapeLayer.face_colors[idx],
+				opacity = self.shapeLayer.opacities[idx])
+
 	def save(self):
 		"""
-		Save all shapes and analysis to a h5f file
+		Save shapes and analysis to a h5f file
+
+		Only shapes that were added, changed or deleted since the last save are written.
+		The file is written in a worker thread so we do not freeze the viewer.
 
-		todo: save each of (shape_types, edge_colors, etc) as a group attrs rather than a dict
-		todo: migrate this to ShapeAnalysis class to be used from Jupyter notebook (without napari interface)
+		See ShapeFile.saveShapeFileInBackground()
 		"""
 		print('=== bShapeAnalysisWidget.save()')
-		#print(type(self.shapeLayer.data[0]))
-
-		# create a dict for each shape/roi
-		shapeList = []
-		for idx, shapeType in enumerate(self.shapeLayer.shape_types):
-			#print('   idx:', idx, shapeType)
-			shapeDict = {
-				#'data:', self.shapeLayer.data[idx],
-				'shape_types': self.shapeLayer.shape_types[idx],
-				'edge_colors': self.shapeLayer.edge_colors[idx],
-				'face_colors': self.shapeLayer.face_colors[idx],
-				'edge_widths': self.shapeLayer.edge_widths[idx],
-				'opacities': self.shapeLayer.opacities[idx],
-				#z_indices for polygon is int64 and can not be with json.dumps ???
-				#'z_indices': int(self.shapeLayer.z_indices[idx]),
-			}
-			#print('   shapeDict:', shapeDict)
-			shapeList.append(shapeDict)
-
-			# check the types
-			# z_indices is int64 and is not serializable ???
-			'''
-			for k, v in shapeDict.items():
-				print('***', k, v, type(v))
-			'''
-
-		# write each shape dict to an h5f file
+		self._syncShapeList()
 		h5File = self._getSavePath()
-		print('writing', len(shapeList), 'shapes to file:', h5File)
-		#h5File = self.myImageLayer.name + '_shapeAnalysis.h5'
-		with h5py.File(h5File, "w") as f:
-			for idx, shape in enumerate(shapeList):
-				print('   idx:', idx, 'shape:', shape)
-				# each shape will have a group
-				shapeGroup = f.create_group('shape' + str(idx))
-				# each shape group will have a shape dict with all parameters to draw ()
-				shapeDict_json = json.dumps(shape)
-				shapeGroup.attrs['shapeDict'] = shapeDict_json
-				# each shape group will have 'data' with coordinates of polygon
-				shapeData = self.shapeLayer.data[idx]
-				shapeGroup.create_dataset("data", data=shapeData)
-
-				#print('self.shapeLayer.metadata[idx]:', self.shapeLayer.metadata[idx])
-				for k,v in self.shapeLayer.metadata[idx].items():
-					newGroup = 'metadata/' + k
-					print('      ', newGroup)
-					shapeGroup.create_dataset(newGroup, data=v)
+		if self.shapeList.path == h5File and os.path.isfile(h5File) and not self.shapeList.isDirty:
+			print('   nothing changed since last save')
+			return
+		future = saveShapeFileInBackground(h5File, self.shapeList)
+		future.add_done_callback(self._saveDone)
+
+	def _saveDone(self, future):
+		""" called from save worker thread when the file is written """
+		e = future.exception()
+		if e is not None:
+			print('*** save() error: ', e)
+		else:
+			print('   save() done')
 
 	def load(self):
 		"""
-		Load shapes and analysis from h5f file
+		Load shapes and analysis from h5f file and append them to our shapes layer
 
-		todo: migrate this to ShapeAnalysis class to be used from Jupyter notebook (without napari interface)
+		See ShapeFile.loadShapeFile()
 		"""
 		h5File = self._getSavePath()
 		print('=== bShapeAnalysisWidget.load() file:', h5File)
 
-		if not os.path.isfile(h5File):
-			print('   file not found:', h5File)
+		loadedShapeList = loadShapeFile(h5File)
+		if len(loadedShapeList) == 0:
 			return
 
-		shape_type = []
-		edge_width = []
-		edge_color = []
-		face_color = []
-		with h5py.File(h5File, "r") as f:
-			# iterate through h5py groups (shapes)
-			shapeList = []
-			linesList = []
-			#metadataList = [] # metadata is a special case
-			for name in f:
-				print('   loading name:', name)
-				json_str = f[name].attrs['shapeDict']
-				json_dict = json.loads(json_str) # convert from string to dict
-				'''
-				print('   json_dict:', json_dict)
-				print('   type(json_dict):', type(json_dict))
-				print('   json_dict["edge_colors"]', json_dict['edge_colors'])
-				'''
-				# load the coordinates of polygon
-				data = f[name + '/data'][()] # the wierd [()] converts it to numpy ndarray
-
-				#metadata = f[name + '/metadata'][()] # the wierd [()] converts it to numpy ndarray
-				metadataDict = {}
-				for name2 in f[name + '/metadata']:
-					#print('name2:', name2)
-					metadataDict[name2] = f[name + '/metadata' + '/' + name2][()]
-
-				linesList.append(data)
-				#metadataList.append(metadataDict) # metadata is a special case
-				self.shapeLayer.metadata.append(metadataDict)
-
-				shapeDict = json_dict
-				shapeDict['data'] = data
-
-				shape_type.append(shapeDict['shape_types'])
-				edge_width.append(shapeDict['edge_widths'])
-				edge_color.append(shapeDict['edge_colors'])
-				face_color.append(shapeDict['face_colors'])
-
-				#print("type(shapeDict['edge_colors'])", type(shapeDict['edge_colors']))
-
-				shapeList.append(shapeDict)
-
 		# create a shape from what we loaded
-		print('   Appending', len(linesList), 'loaded shapes to shapes layer')
-
-		# metadata is a special case
-		#self.shapeLayer.metadata = metadataList
+		print('   Appending', len(loadedShapeList), 'loaded shapes to shapes layer')
 
-		#add shapes to existing shape layer
-		'''
-		# 1)
-		# this does not work because vispy is interpreting (edge_color, face_color) as a list
-		# and thus expecting rgb (or rgba?) and not string like 'black'
-		self.shapeLayer.add(
-			linesList,
-			shape_type = shape_type,
-			edge_width = edge_width,
-			edge_color = edge_color,
-			face_color = face_color
-			)
-		'''
-		# 2)
+		# we are not passing (edge_color, face_color)
+		# vispy is interpreting a list of them as rgb (or rgba?) and not string like 'black'
 		self.shapeLayer.add(
-			linesList,
-			shape_type = shape_type,
-			edge_width = edge_width,
+			loadedShapeList.data,
+			shape_type = loadedShapeList.shape_types,
+			edge_width = loadedShapeList.edge_widths,
 			)
-
-		#self.updatePlots()
+		# if we are empty, shapes we loaded are the shapes in the file (not dirty)
+		self.shapeList.extend(loadedShapeList, keepIds=len(self.shapeList)==0)
 
 		# plot all polygon analysis
 		self.updatePlots(updatePolygons=True)
-		#self.myPyQtGraphWidget.plotAllPolygon(None)
 
 	@property
 	def imageData(self):
@@ -484,7 +551,7 @@ class ShapeAnalysisPlugin:
 
 		shapeType, index, data = self._getSelectedShape()
 		if shapeType == 'line':
-			self.updateLines(self.sliceNum, data)
+			self.updateLines(self.sliceNum, data, self._lineWidth(index))
 
 	def _getSelectedShape(self):
 		"""
@@ -517,7 +584,7 @@ class ShapeAnalysisPlugin:
 			# todo: this does not feel right ... fix this !!!
 			shapeType, index, data = self._getSelectedShape()
 			if shapeType == 'line':
-				self.updateLines(self.sliceNum, data)
+				self.updateLines(self.sliceNum, data, self._lineWidth(index))
 
 	def updatePlots(self, updatePolygons=False):
 		"""
@@ -528,13 +595,10 @@ class ShapeAnalysisPlugin:
 		This needs to update (1) a line based on selection and (2) all rectangle shapes/roi, regardless of selection
 		"""
 
-		print('bShapeAnalysisPlugin.updatePlots()')
-
-		shapeType, index, data = self._getSelectedShape()
+		count('plot.updates')
 
 		# on delete, these will all be None
-		print('   shapeType:', shapeType)
-		print('   index:', index)
+		shapeType, index, data = self._getSelectedShape()
 
 		# in the end just use this
 		self.myPyQtGraphWidget.updateShapeSelection(index)
@@ -570,10 +634,10 @@ class ShapeAnalysisPlugin:
 		src = data[0]
 		dst = data[1]
 		print('updateStackLineProfile() src:', src, 'dst:', dst)
-		x, lineKymograph, lineDiameter = self.analysis.stackLineProfile(src, dst)
+		x, results = self.analysis.stackLineProfile(src, dst, linewidth=self._lineWidth(index))
 
-		self.shapeLayer.metadata[index]['lineDiameter'] = lineDiameter
-		self.shapeLayer.metadata[index]['lineKymograph'] = lineKymograph
+		# (lineKymograph, lineDiameter, lineLeft, lineRight, lineFitParams)
+		self.shapeList.setResults(index, results)
 
 		self.updatePlots()
 
@@ -586,18 +650,61 @@ class ShapeAnalysisPlugin:
 
 		shapeType, index, data = self._getSelectedShape()
 
-		# back-end analysis
-		theMin, theMax, theMean = self.analysis.stackPolygonAnalysis(data)
+		# back-end analysis, keyed by shape id so re-analysis after an edit only looks at pixels that changed
+		theMin, theMax, theMean = self.analysis.stackPolygonAnalysis(data, key=self.shapeList.ids[index])
 
 		if theMin is None:
 			return
 
-		# store in shape metadata
-		self.shapeLayer.metadata[index]['polygonMean'] = theMean
+		# store in shape list, with normalized traces so we do not normalize on each redraw
+		stats = self.analysis.stackPolygonExtraStats(data, key=self.shapeList.ids[index])
+		results = self.analysis.polygonResults(theMin, theMax, theMean, stats)
+		results.update(polygonTraceResults(results['polygonMean'], self.baselineWindow))
+		self.shapeList.setResults(index, results)
+		self._updateRollingTraces([index])
 
 		# plot
 		self.updatePlots(updatePolygons=True)
 
+	def setBaselineWindow(self, baselineWindow, index=None):
+		"""
+		Set the (start, stop) slices used as F0 to normalize polygon traces
+
+		Parameters:
+			baselineWindow: (start, stop)
+			index: polygon shape to re-normalize, if None then all polygon shapes (and new analysis)
+		"""
+		if index is None:
+			self.baselineWindow = tuple(baselineWindow)
+			indexList = self.shapeList.shapeIndices('rectangle') + self.shapeList.shapeIndices('polygon')
+		else:
+			indexList = [index]
+		for idx in indexList:
+			updateNormalizedTraces(self.shapeList, idx, baselineWindow)
+		self.updatePlots(updatePolygons=True)
+
+	def _updateRollingTraces(self, indexList=None):
+		updateRollingTraces(self.shapeList, indexList, window=self.rollingWindow,
+							percentile=self.rollingPercentile, ratioPair=self.ratioPair)
+
+	def setRollingBaseline(self, window=None, percentile=None, ratioPair=None):
+		"""
+		Set the rolling baseline (and channel ratio) of polygon traces and recompute them for all polygon shapes
+
+		Parameters:
+			window: slices in sliding window
+			percentile: F0 is this percentile of the window
+			ratioPair: (numerator, denominator) channels for polygonRatio, 4d data only
+		"""
+		if window is not None:
+			self.rollingWindow = window
+		if percentile is not None:
+			self.rollingPercentile = percentile
+		if ratioPair is not None:
+			self.ratioPair = tuple(ratioPair)
+		self._updateRollingTraces()
+		self.updatePlots(updatePolygons=True)
+
 	def updateVerticalSliceLines(self, sliceNum):
 		"""
 		Set vertical line indicating current slice
@@ -605,15 +712,26 @@ class ShapeAnalysisPlugin:
 		for line in self.sliceLinesList:
 			line.setValue(sliceNum)
 
-	def updateLines(self, sliceNum, data):
+	def _lineWidth(self, index):
+		""" width of a line shape in pixels, its napari edge_width, all line analysis uses this """
+		return self.shapeLayer.edge_widths[index]
+
+	def edgeWidthChange_callback(self, event):
+		""" user changed edge_width, a line shape is analyzed with its edge width, update its profile """
+		shapeType, index, data = self._getSelectedShape()
+		if shapeType == 'line':
+			self.updateLines(self.sliceNum, data, self._lineWidth(index))
+
+	def updateLines(self, sliceNum, data, linewidth=1):
 		"""
 		data: two points that make the line
+		linewidth: width of the line in pixels, see _lineWidth()
 		"""
 		src = data[0]
 		dst = data[1]
-		print('bShapeAnalysisWidget.updateLines() sliceNum:', sliceNum, 'src:', src, 'dst:', dst)
+		print('bShapeAnalysisWidget.updateLines() sliceNum:', sliceNum, 'src:', src, 'dst:', dst, 'linewidth:', linewidth)
 		# this can fail ???
-		x, lineProfile, yFit, fwhm, leftIdx, rightIdx = self.analysis.lineProfile(sliceNum, src, dst, linewidth=1, doFit=True)
+		x, lineProfile, yFit, fwhm, leftIdx, rightIdx = self.analysis.lineProfile(sliceNum, src, dst, linewidth=linewidth, doFit=True)
 
 		self.updateLineIntensityPlot(x, lineProfile, yFit, leftIdx, rightIdx)
 
@@ -0,0 +1,569 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Save and load a ShapeList (shapes and their analysis) to/from an h5f file.
+
+No napari/Qt imports, this can be used from a Jupyter notebook or batch script.
+
+Saving only writes what changed since the last save (see ShapeList dirty tracking),
+the file is opened in 'a' mode and shapes that did not change are not touched.
+A full save (new file, different file, old version) writes a temporary file and then
+replaces the original.
+
+Loading reads geometry and small results. Large results (kymographs and long traces)
+are loaded as LazyArray, they are read from the file when first used and kept in a
+bounded cache (resultCache).
+
+File layout (version 2):
+	attrs['version']: 2
+	/shapes/<name>: one row per shape, rows of deleted shapes are reused
+		ids: int, unique shape id in each row, -1 for an unused row
+		order: int, shape ids in the order of the shapes layer
+		shape_types, edge_colors, face_colors: str (colors are json)
+		edge_widths, opacities: float
+		vertices: variable length float, the (n,2) vertex points flattened
+	/results/<name>: (row x frame) 2d table, one for each 1d analysis result (lineDiameter, polygonMean, ...)
+		chunked one row at a time and compressed, rows are padded with nan
+		attrs['dtype']: dtype of the analysis result
+	/resultLengths/<name>: (row) int, number of valid values in each row of /results/<name>
+	/arrays/<name>/<id>: one dataset per shape for each 2d (or more) analysis result (lineKymograph, ...)
+		chunked in blocks of frames so reading one shape, or part of one shape, is fast
+
+File layout (version 1), we still load these:
+	/shape<n>
+		attrs['shapeDict']: json str of drawing parameters (shape_types, edge_colors, ...)
+		data: (n,2) vertex points
+		metadata/<name>: one dataset per analysis result (lineDiameter, lineKymograph, ...)
+"""
+
+import os, json, threading
+import collections
+import concurrent.futures
+import numpy as np
+import h5py
+
+try:
+	from .ShapeList import ShapeList
+	from .Instrumentation import timer, timed, count
+except ImportError:
+	# when ShapeAnalysisPlugin.py is run as a script
+	from ShapeList import ShapeList
+	from Instrumentation import timer, timed, count
+
+fileVersion = 2
+
+# compression for /results and /arrays, gzip is readable by all hdf5 tools
+compression = 'gzip'
+compression_opts = 4
+
+resultChunkFrames = 16384 # frames in each chunk of a /results row
+arrayChunkBytes = 256 * 1024 # target size of each chunk in /arrays
+shapeChunkRows = 256 # rows in each chunk of /shapes
+
+lazyMinBytes = 64 * 1024 # on load, results bigger than this (per shape) are LazyArray
+
+shapeNames = ['shape_types', 'edge_colors', 'face_colors', 'edge_widths', 'opacities']
+
+# one reader/writer at a time, saving runs in a worker thread (see saveShapeFileInBackground)
+fileLock = threading.RLock()
+
+# one thread so saves are written in the order they were asked for
+_saveExecutor = None
+
+class ResultCache:
+	"""
+	Least recently used cache of results read by LazyArray, bounded by total bytes
+	"""
+	def __init__(self, maxBytes=512 * 1024**2):
+		self.maxBytes = maxBytes
+		self._cache = collections.OrderedDict() # key: ndarray
+		self._numBytes = 0
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			value = self._cache.get(key, None)
+			if value is not None:
+				self._cache.move_to_end(key)
+			return value
+
+	def put(self, key, value):
+		if value.nbytes > self.maxBytes:
+			return
+		with self._lock:
+			self._discard(key)
+			self._cache[key] = value
+			self._numBytes += value.nbytes
+			while self._numBytes > self.maxBytes:
+				oldKey, oldValue = self._cache.popitem(last=False)
+				self._numBytes -= oldValue.nbytes
+
+	def _discard(self, key):
+		value = self._cache.pop(key, None)
+		if value is not None:
+			self._numBytes -= value.nbytes
+
+	def discard(self, key):
+		with self._lock:
+			self._discard(key)
+
+	def discardFile(self, path):
+		""" forget everything read from one file """
+		with self._lock:
+			for key in [key for key in self._cache.keys() if key[0] == path]:
+				self._discard(key)
+
+resultCache = ResultCache()
+
+class LazyArray:
+	"""
+	One analysis result of one shape that is still in the h5f file
+
+	The file is read on first use, np.asarray(lazyArray) reads all of it and lazyArray[a:b] reads
+	just frames a:b (when it is not already in resultCache).
+
+	We find data by shape id, not by row, so this stays valid when the file is saved again.
+	"""
+	def __init__(self, path, name, id, shape, dtype, isTable):
+		"""
+		Parameters:
+			name: result name, e.g. 'lineKymograph'
+			id: shape id
+			shape, dtype: of the result
+			isTable: True if result is a row in /results/<name>, False if it is /arrays/<name>/<id>
+		"""
+		self.path = path
+		self.name = name
+		self.id = id
+		self.shape = tuple(int(s) for s in shape)
+		self.dtype = np.dtype(dtype)
+		self.isTable = isTable
+
+	@property
+	def ndim(self):
+		return len(self.shape)
+
+	@property
+	def size(self):
+		return int(np.prod(self.shape))
+
+	@property
+	def nbytes(self):
+		return self.size * self.dtype.itemsize
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __repr__(self):
+		return 'LazyArray(' + self.name + ', id=' + str(self.id) + ', shape=' + str(self.shape) + ')'
+
+	@timed('read.file')
+	def _read(self, key):
+		""" read from file, key is a slice into axis 0 """
+		with fileLock:
+			with h5py.File(self.path, "r") as f:
+				if self.isTable:
+					ids = f['shapes/ids'][()]
+					row = int(np.nonzero(ids == self.id)[0][0])
+					start, stop, step = key.indices(self.shape[0])
+					value = f['results/' + self.name][row, start:stop:step]
+				else:
+					value = f['arrays/' + self.name + '/' + str(self.id)][key]
+		return value.astype(self.dtype, copy=False)
+
+	def read(self):
+		""" return the full result as ndarray """
+		cacheKey = (self.path, self.name, self.id)
+		value = resultCache.get(cacheKey)
+		if value is None:
+			count('read.cacheMiss')
+			value = self._read(slice(None))
+			resultCache.put(cacheKey, value)
+		return value
+
+	def __array__(self, dtype=None, copy=None):
+		value = self.read()
+		if dtype is not None:
+			value = value.astype(dtype, copy=False)
+		return value
+
+	def __getitem__(self, key):
+		value = resultCache.get((self.path, self.name, self.id))
+		if value is not None:
+			return value[key]
+		if isinstance(key, slice):
+			return self._read(key)
+		elif isinstance(key, tuple) and len(key) > 0 and isinstance(key[0], slice):
+			return self._read(key[0])[(slice(None),) + key[1:]]
+		return self.read()[key]
+
+def _jsonValue(value):
+	""" convert numpy types (e.g. int64 or rgba ndarray) so json.dumps will take them """
+	if isinstance(value, np.ndarray):
+		return value.tolist()
+	elif isinstance(value, np.generic):
+		return value.item()
+	return value
+
+def getFileVersion(path):
+	""" return the layout version of an existing h5f file, files without a version are 1 """
+	with fileLock:
+		with h5py.File(path, "r") as f:
+			return int(f.attrs.get('version', 1))
+
+def _tableDtype(dtype):
+	""" rows in /results are padded with nan so they need to be float """
+	if dtype == np.float32:
+		return np.float32
+	return np.float64
+
+def _arrayChunks(shape, dtype):
+	""" chunk a 2d (or more) result in blocks of frames (axis 0), full size in other axes """
+	rowBytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+	rowsPerChunk = max(1, arrayChunkBytes // max(rowBytes, 1))
+	rowsPerChunk = min(rowsPerChunk, shape[0])
+	return (max(rowsPerChunk, 1),) + tuple(max(s, 1) for s in shape[1:])
+
+def _resizeRows(dataset, numRows):
+	if dataset.shape[0] < numRows:
+		dataset.resize((numRows,) + dataset.shape[1:])
+
+def _createShapeTables(f):
+	""" create empty (resizable) /shapes tables in a new file """
+	f.attrs['version'] = fileVersion
+	g = f.create_group('shapes')
+	strType = h5py.string_dtype()
+	dtypes = {
+		'ids': np.int64,
+		'order': np.int64,
+		'shape_types': strType,
+		'edge_colors': strType,
+		'face_colors': strType,
+		'edge_widths': np.float64,
+		'opacities': np.float64,
+		'vertices': h5py.vlen_dtype(np.float64),
+	}
+	for name, dtype in dtypes.items():
+		g.create_dataset(name, (0,), dtype=dtype, maxshape=(None,), chunks=(shapeChunkRows,))
+
+def _writeShapeRow(g, row, shapeDict):
+	""" write geometry and drawing parameters of one shape into row of /shapes tables """
+	for name in shapeNames + ['vertices']:
+		_resizeRows(g[name], row+1)
+	g['shape_types'][row] = shapeDict['shape_types']
+	g['edge_colors'][row] = json.dumps(_jsonValue(shapeDict['edge_colors']))
+	g['face_colors'][row] = json.dumps(_jsonValue(shapeDict['face_colors']))
+	g['edge_widths'][row] = shapeDict['edge_widths']
+	g['opacities'][row] = shapeDict['opacities']
+	g['vertices'][row] = np.asarray(shapeDict['data'], dtype=np.float64).ravel()
+
+def _clearRow(f, row, id):
+	""" a shape was deleted, forget its results """
+	if 'resultLengths' in f:
+		for name, lengths in f['resultLengths'].items():
+			if row < lengths.shape[0]:
+				lengths[row] = 0
+	if 'arrays' in f:
+		for name, group in f['arrays'].items():
+			if str(id) in group:
+				del group[str(id)]
+
+def _writeArray(dataset, value):
+	"""
+	write value into dataset in blocks of chunks, value can be ndarray, memmap or LazyArray
+
+	we never need all of a memmap or LazyArray in RAM at once
+	"""
+	if dataset.chunks is None:
+		dataset[...] = np.asarray(value)
+		return
+	blockRows = dataset.chunks[0] * 16
+	for start in range(0, value.shape[0], blockRows):
+		stop = min(start + blockRows, value.shape[0])
+		dataset[start:stop] = np.asarray(value[start:stop])
+
+def _writeResult(f, row, id, name, value):
+	""" write one analysis result of one shape """
+	resultCache.discard((os.path.abspath(f.filename), name, id))
+	if np.ndim(value) <= 1:
+		value = np.asarray(value)
+	arrayName = 'arrays/' + name + '/' + str(id)
+	if value.ndim == 1:
+		if arrayName in f:
+			del f[arrayName]
+		tableName = 'results/' + name
+		if tableName not in f:
+			tableDtype = _tableDtype(value.dtype)
+			table = f.create_dataset(tableName, (row+1, len(value)), dtype=tableDtype,
+						chunks=(1, max(1, min(len(value), resultChunkFrames))),
+						maxshape=(None, None), fillvalue=np.nan,
+						compression=compression, compression_opts=compression_opts, shuffle=True)
+			table.attrs['dtype'] = value.dtype.str
+			f.create_dataset('resultLengths/' + name, (row+1,), dtype=np.int64,
+						maxshape=(None,), chunks=(shapeChunkRows,))
+		table = f[tableName]
+		lengths = f['resultLengths/' + name]
+		_resizeRows(table, row+1)
+		_resizeRows(lengths, row+1)
+		if table.shape[1] < len(value):
+			table.resize((table.shape[0], len(value)))
+		rowValues = np.full(table.shape[1], np.nan, dtype=table.dtype)
+		rowValues[0:len(value)] = value
+		table[row, :] = rowValues
+		lengths[row] = len(value)
+	else:
+		tableName = 'resultLengths/' + name
+		if tableName in f and row < f[tableName].shape[0]:
+			f[tableName][row] = 0
+		if arrayName in f:
+			dataset = f[arrayName]
+			if dataset.shape == value.shape and dataset.dtype == value.dtype and dataset.chunks is not None:
+				# same size, write in place so the file does not grow
+				_writeArray(dataset, value)
+				return
+			del f[arrayName]
+		if value.size == 0:
+			f.create_dataset(arrayName, data=np.asarray(value))
+		else:
+			dataset = f.create_dataset(arrayName, value.shape, dtype=value.dtype,
+				chunks=_arrayChunks(value.shape, value.dtype),
+				compression=compression, compression_opts=compression_opts, shuffle=True)
+			_writeArray(dataset, value)
+
+def _writeChanges(f, changes):
+	""" write a snapshot from ShapeList.takeChanges() into an open file """
+	g = f['shapes']
+	ids = list(g['ids'][()])
+	rowOfId = {int(id): row for row, id in enumerate(ids) if id >= 0}
+	freeRows = [row for row, id in enumerate(ids) if id < 0]
+
+	# deleted shapes, free their row
+	for id in changes['deleted']:
+		row = rowOfId.pop(id, None)
+		if row is None:
+			continue
+		ids[row] = -1
+		freeRows.append(row)
+		_clearRow(f, row, id)
+
+	# new and changed shapes
+	for id, shapeDict in changes['shapes'].items():
+		row = rowOfId.get(id, None)
+		if row is None:
+			if freeRows:
+				row = freeRows.pop(0)
+				_clearRow(f, row, ids[row])
+			else:
+				row = len(ids)
+				ids.append(-1)
+			ids[row] = id
+			rowOfId[id] = row
+		_writeShapeRow(g, row, shapeDict)
+
+	for id, results in changes['results'].items():
+		row = rowOfId.get(id, None)
+		if row is None:
+			print('ShapeFile._writeChanges() error: results for shape id', id, 'which is not in file')
+			continue
+		for name, value in results.items():
+			_writeResult(f, row, id, name, value)
+
+	g['ids'].resize((len(ids),))
+	g['ids'][:] = np.asarray(ids, dtype=np.int64)
+	order = np.asarray(changes['order'], dtype=np.int64)
+	g['order'].resize((len(order),))
+	g['order'][:] = order
+
+def prepareSave(path, shapeList):
+	"""
+	Take a snapshot of what needs to be saved (on the gui thread), write it with writeSave()
+
+	Everything is saved if path is not the file shapeList was loaded from (or last saved to)
+	"""
+	full = shapeList.path != path or not os.path.isfile(path)
+	changes = shapeList.takeChanges(full=full)
+	shapeList.path = path
+	return changes
+
+@timed('save')
+def writeSave(path, changes):
+	""" write a snapshot from prepareSave(), this can run in a worker thread """
+	numShapes = len(changes['shapes'])
+	numResults = sum([len(results) for results in changes['results'].values()])
+	count('save.shapes', numShapes)
+	count('save.results', numResults)
+	with fileLock:
+		if changes['full']:
+			print('ShapeFile.writeSave() writing all', numShapes, 'shapes to file:', path)
+			tmpPath = path + '.tmp'
+			# persist free space tracking so later 'a' saves can reuse space of deleted datasets
+			with h5py.File(tmpPath, "w", fs_strategy='fsm', fs_persist=True) as f:
+				_createShapeTables(f)
+				_writeChanges(f, changes)
+			os.replace(tmpPath, path)
+			resultCache.discardFile(os.path.abspath(path))
+		else:
+			print('ShapeFile.writeSave() writing', numShapes, 'changed shapes,', numResults, 'changed results,',
+				len(changes['deleted']), 'deleted shapes to file:', path)
+			with h5py.File(path, "a") as f:
+				_writeChanges(f, changes)
+
+def saveShapeFile(path, shapeList):
+	"""
+	Save shapes and analysis to a h5f file (version 2 layout), only writes what changed
+
+	Parameters:
+		path: full path to .h5 file
+		shapeList: ShapeList
+	"""
+	changes = prepareSave(path, shapeList)
+	try:
+		writeSave(path, changes)
+	except:
+		shapeList.restoreChanges(changes)
+		raise
+
+def saveShapeFileInBackground(path, shapeList):
+	"""
+	Like saveShapeFile() but write the file in a worker thread
+
+	Call this from the gui thread, we do not block while writing.
+
+	Returns:
+		concurrent.futures.Future, its result() is None or raises the save exception
+	"""
+	global _saveExecutor
+	if _saveExecutor is None:
+		_saveExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+	changes = prepareSave(path, shapeList)
+
+	def _save():
+		try:
+			writeSave(path, changes)
+		except:
+			print('ShapeFile.saveShapeFileInBackground() error saving file:', path)
+			# ShapeList locks its dirty state, the gui thread may be editing
+			shapeList.restoreChanges(changes)
+			raise
+
+	return _saveExecutor.submit(_save)
+
+def _loadVersion1(f, shapeList):
+	""" load the original layout with one group per shape """
+	# iterate through h5py groups (shapes), sort so 'shape10' comes after 'shape9'
+	names = sorted(f.keys(), key=lambda name: int(name.replace('shape', '')))
+	for name in names:
+		shapeDict = json.loads(f[name].attrs['shapeDict']) # convert from string to dict
+		# load the coordinates of polygon
+		data = f[name + '/data'][()] # the wierd [()] converts it to numpy ndarray
+		metadata = {}
+		for name2 in f[name + '/metadata']:
+			metadata[name2] = f[name + '/metadata/' + name2][()]
+		shapeList.add(data, shapeDict['shape_types'],
+			edge_width=shapeDict['edge_widths'],
+			edge_color=shapeDict['edge_colors'],
+			face_color=shapeDict['face_colors'],
+			opacity=shapeDict['opacities'],
+			metadata=metadata)
+
+def _loadVersion2(f, shapeList):
+	""" load the consolidated layout, see module docstring, large results are LazyArray """
+	path = os.path.abspath(f.filename)
+	g = f['shapes']
+	shape_types = g['shape_types'].asstr()[()]
+	edgeColors = g['edge_colors'].asstr()[()]
+	faceColors = g['face_colors'].asstr()[()]
+	edgeWidths = g['edge_widths'][()]
+	opacities = g['opacities'][()]
+	vertices = g['vertices'][()]
+	numRows = len(shape_types)
+	if 'ids' in g:
+		ids = g['ids'][()]
+		order = g['order'][()]
+	else:
+		ids = np.arange(numRows)
+		order = ids
+
+	metadataList = [{} for row in range(numRows)]
+	if 'results' in f:
+		for name, table in f['results'].items():
+			dtype = np.dtype(table.attrs['dtype'])
+			lengths = f['resultLengths/' + name][()]
+			isLazy = table.shape[1] * table.dtype.itemsize > lazyMinBytes
+			if not isLazy:
+				values = table[()] # one read for all shapes
+			for row in range(min(numRows, len(lengths))):
+				if lengths[row] == 0 or ids[row] < 0:
+					continue
+				if isLazy:
+					metadataList[row][name] = LazyArray(path, name, int(ids[row]), (lengths[row],), dtype, True)
+				else:
+					metadataList[row][name] = values[row, 0:lengths[row]].astype(dtype, copy=False)
+	rowOfId = {int(id): row for row, id in enumerate(ids) if id >= 0}
+	if 'arrays' in f:
+		for name, group in f['arrays'].items():
+			for id, dataset in group.items():
+				row = rowOfId.get(int(id), None)
+				if row is None:
+					continue
+				if dataset.nbytes > lazyMinBytes:
+					metadataList[row][name] = LazyArray(path, name, int(id), dataset.shape, dataset.dtype, False)
+				else:
+					metadataList[row][name] = dataset[()]
+
+	for id in order:
+		row = rowOfId[int(id)]
+		shapeList.add(vertices[row].reshape(-1, 2), shape_types[row],
+			edge_width=edgeWidths[row].item(),
+			edge_color=json.loads(edgeColors[row]),
+			face_color=json.loads(faceColors[row]),
+			opacity=opacities[row].item(),
+			metadata=metadataList[row],
+			id=int(id))
+
+@timed('load')
+def loadShapeFile(path):
+	"""
+	Load shapes and analysis from h5f file, either version 1 or version 2 layout
+
+	Returns:
+		ShapeList, empty if path does not exist
+	"""
+	shapeList = ShapeList()
+
+	if not os.path.isfile(path):
+		print('loadShapeFile() file not found:', path)
+		return shapeList
+
+	with fileLock:
+		with h5py.File(path, "r") as f:
+			version = int(f.attrs.get('version', 1))
+			if version == 1:
+				_loadVersion1(f, shapeList)
+			elif version == 2:
+				_loadVersion2(f, shapeList)
+			else:
+				print('loadShapeFile() error: unknown file version', version, 'in file:', path)
+				return shapeList
+
+	# everything we have is in the file
+	shapeList.clearDirty()
+	if version == fileVersion:
+		shapeList.path = path
+
+	print('loadShapeFile() loaded', len(shapeList), 'shapes from file:', path, 'version:', version)
+	return shapeList
+
+def migrateShapeFile(path, newPath=None):
+	"""
+	Re-write a version 1 file with the version 2 layout
+
+	Parameters:
+		newPath: if None then path is overwritten
+	"""
+	shapeList = loadShapeFile(path)
+	shapeList.path = None # save everything
+	saveShapeFile(newPath or path, shapeList)
+	return shapeList
@@ -0,0 +1,357 @@
+# Robert Cudmore
+# 20261019
+
+"""
+A list of shapes (roi) and their analysis results, without any napari/Qt.
+
+This mirrors the parallel lists of a napari shapes layer (shape_types, data, edge_widths, ...)
+and adds one metadata dict of analysis results per shape.
+
+Use this from a Jupyter notebook, a batch script or a worker process. ShapeAnalysisPlugin
+keeps one of these in sync with its napari shapes layer.
+
+Each shape has a unique id that never changes (shape index does change on delete).
+We keep maps of id to index and of shape type to ids, so looking up a shape by id,
+or all shapes of one type, does not scan the whole list.
+We keep track of what changed since the last save (dirty) so saving only writes changes,
+see ShapeFile.saveShapeFile().
+"""
+
+import threading
+import numpy as np
+
+# analysis results we keep for each shape, name: (shape when there is no analysis, dtype)
+# results are one row per slice/image, nan where analysis failed, see ShapeAnalysis
+resultDefs = {
+	'lineDiameter': ((0,), np.float32),
+	'lineKymograph': ((1,1), np.float32), # (slices, points along line)
+	'lineLeft': ((0,), np.float32), # index of left edge of diameter
+	'lineRight': ((0,), np.float32),
+	'lineFitParams': ((0,3), np.float32), # gaussian fit (amplitude, mean, stddev)
+	# to display lineKymograph, see ShapeAnalysis.kymographSummary()
+	'lineKymographOverview': ((0,0), np.float32), # (<= 2048, points along line)
+	'lineKymographHistogram': ((0,), np.int64),
+	'lineKymographEdges': ((0,), np.float32),
+	'lineKymographLevels': ((0,), np.float32), # (lower, upper)
+	'polygonMin': ((0,), np.float32),
+	'polygonMax': ((0,), np.float32),
+	'polygonMean': ((0,), np.float32),
+	# more statistics of pixels in each slice, see ShapeAnalysis.stackPolygonStats(),
+	# percentiles other than the median (e.g. 'polygonP95') are stored with the dtype they have
+	'polygonSd': ((0,), np.float32),
+	'polygonN': ((0,), np.int64),
+	'polygonSum': ((0,), np.float64),
+	'polygonMedian': ((0,), np.float32),
+	# normalized polygonMean, see TraceAnalysis
+	'polygonMeanNorm': ((0,), np.float32), # percent of baseline
+	'polygonMeanDeltaFF': ((0,), np.float32),
+	'polygonBaselineWindow': ((0,), np.int64), # (start, stop) slices of baseline
+	# rolling percentile baseline, see TraceAnalysis.updateRollingTraces()
+	'polygonRollingBaseline': ((0,), np.float32), # F0 of each slice
+	'polygonRollingDeltaFF': ((0,), np.float32),
+	'polygonRollingWindow': ((0,), np.float64), # (window slices, percentile)
+}
+
+# results of 4d (color, slice, row, col) data, per channel results (the results above are one channel of these,
+# see ShapeAnalysis.displayChannel) and channel ratios. Only shapes analyzed on 4d data have them, they are not in newMetadata()
+channelResultDefs = {
+	'lineKymographChannels': ((0,0,0), np.float32), # (channels, slices, points along line)
+	'lineDiameterChannels': ((0,0), np.float32), # (channels, slices)
+	'lineLeftChannels': ((0,0), np.float32),
+	'lineRightChannels': ((0,0), np.float32),
+	'lineFitParamsChannels': ((0,0,3), np.float32),
+	'polygonMinChannels': ((0,0), np.float32),
+	'polygonMaxChannels': ((0,0), np.float32),
+	'polygonMeanChannels': ((0,0), np.float32),
+	'polygonSdChannels': ((0,0), np.float32),
+	'polygonNChannels': ((0,0), np.int64),
+	'polygonSumChannels': ((0,0), np.float64),
+	'polygonMedianChannels': ((0,0), np.float32),
+	# ratio of two channels of polygonMeanChannels, see TraceAnalysis.channelRatio()
+	'polygonRatio': ((0,), np.float32),
+	'polygonRatioPair': ((0,), np.int64), # (numerator, denominator) channel
+}
+
+# name we use in dirty sets for geometry and drawing parameters (not results)
+shapeDirtyName = '_shape'
+
+styleNames = ['edge_widths', 'edge_colors', 'face_colors', 'opacities']
+
+def newMetadata():
+	""" return a dict of empty analysis results for one shape """
+	metadata = {}
+	for name, (shape, dtype) in resultDefs.items():
+		metadata[name] = np.zeros(shape, dtype=dtype)
+	return metadata
+
+class ShapeList:
+	"""
+	list of shapes, each shape has geometry (data), drawing style and analysis results (metadata)
+
+	Attribute names follow napari shapes layer so we can copy back and forth.
+
+	Do not assign into these lists directly, use (add, pop, setData, setStyle, setResults)
+	so we know what to save.
+
+	Dirty state is guarded by a lock, a save in a worker thread (see ShapeFile.saveShapeFileInBackground)
+	can restoreChanges() while the gui thread keeps editing.
+	"""
+	def __init__(self):
+		self.ids = [] # list of int, unique id of each shape
+		self.shape_types = [] # list of str in ('line', 'rectangle', 'polygon', ...)
+		self.data = [] # list of (n,2) float ndarray, the vertices of each shape
+		self.edge_widths = []
+		self.edge_colors = []
+		self.face_colors = []
+		self.opacities = []
+		self.metadata = [] # list of dict, analysis results for each shape
+
+		self.path = None # h5f file our dirty state is relative to, see ShapeFile
+		self._nextId = 0
+		self._dirty = {} # shape id: set of dirty names (shapeDirtyName and/or result names)
+		self._deleted = set() # shape id deleted since last save
+		self._versions = {} # shape id: int, incremented each time results change (see myPyQtGraphWidget)
+		self._indexOfId = {} # shape id: shape index, None after pop() until next indexOf()
+		self._typeIds = {} # shape type: dict of shape id: None, ordered by index
+		self._lock = threading.RLock() # guards ids/dirty/deleted/versions between gui and save threads
+
+	def __len__(self):
+		return len(self.shape_types)
+
+	def add(self, data, shape_type, edge_width=1, edge_color='coral',
+				face_color='royalblue', opacity=0.7, metadata=None, id=None):
+		"""
+		Append a new shape
+
+		Parameters:
+			data: (n,2) list/ndarray of vertex points
+			metadata: dict of analysis results, if None then empty results
+			id: unique id, if None then make a new one (only ShapeFile should pass this)
+
+		Returns:
+			index of the new shape
+		"""
+		shapeMetadata = newMetadata()
+		if metadata is not None:
+			shapeMetadata.update(metadata)
+
+		with self._lock:
+			if id is None:
+				id = self._nextId
+			self._nextId = max(self._nextId, id + 1)
+
+			self.ids.append(id)
+			self.shape_types.append(shape_type)
+			self.data.append(np.asarray(data, dtype=np.float64))
+			self.edge_widths.append(edge_width)
+			self.edge_colors.append(edge_color)
+			self.face_colors.append(face_color)
+			self.opacities.append(opacity)
+			self.metadata.append(shapeMetadata)
+
+			self._dirty[id] = set([shapeDirtyName]) | set(shapeMetadata.keys())
+			self._versions[id] = 0
+
+			index = len(self) - 1
+			if self._indexOfId is not None:
+				self._indexOfId[id] = index
+			self._typeIds.setdefault(shape_type, {})[id] = None
+
+		return index
+
+	def extend(self, other, keepIds=False):
+		"""
+		append all shapes in another ShapeList
+
+		Parameters:
+			keepIds: keep ids (and dirty state) of other, only use this when we are empty
+		"""
+		if keepIds and len(self) > 0:
+			print('ShapeList.extend() error: keepIds requires an empty list, making new ids')
+			keepIds = False
+		for idx in range(len(other)):
+			self.add(other.data[idx], other.shape_types[idx],
+				edge_width=other.edge_widths[idx],
+				edge_color=other.edge_colors[idx],
+				face_color=other.face_colors[idx],
+				opacity=other.opacities[idx],
+				metadata=other.metadata[idx],
+				id=other.ids[idx] if keepIds else None)
+		if keepIds:
+			with self._lock:
+				self.path = other.path
+				self._nextId = max(self._nextId, other._nextId)
+				self._dirty = {id: set(names) for id, names in other._dirty.items()}
+				self._deleted = set(other._deleted)
+
+	def pop(self, index):
+		""" remove one shape """
+		with self._lock:
+			id = self.ids.pop(index)
+			shape_type = self.shape_types.pop(index)
+			self.data.pop(index)
+			self.edge_widths.pop(index)
+			self.edge_colors.pop(index)
+			self.face_colors.pop(index)
+			self.opacities.pop(index)
+			self.metadata.pop(index)
+
+			self._dirty.pop(id, None)
+			self._deleted.add(id)
+			self._versions.pop(id, None)
+
+			# index of all shapes after this one changed, rebuild on next indexOf()
+			self._indexOfId = None
+			self._typeIds[shape_type].pop(id, None)
+
+	def setData(self, index, data):
+		""" set the vertices of one shape, does nothing if they did not change """
+		data = np.asarray(data, dtype=np.float64)
+		with self._lock:
+			if np.array_equal(data, self.data[index]):
+				return
+			self.data[index] = data
+			self._setDirty(index, shapeDirtyName)
+
+	def setStyle(self, index, edge_width=None, edge_color=None, face_color=None, opacity=None):
+		""" set drawing parameters of one shape, None leaves a parameter as is """
+		newValues = [edge_width, edge_color, face_color, opacity]
+		for name, value in zip(styleNames, newValues):
+			if value is None:
+				continue
+			theList = getattr(self, name)
+			if np.array_equal(np.asarray(value, dtype=object), np.asarray(theList[index], dtype=object)):
+				continue
+			with self._lock:
+				theList[index] = value
+				self._setDirty(index, shapeDirtyName)
+
+	def setResults(self, index, results):
+		"""
+		set analysis results of one shape
+
+		Parameters:
+			results: dict of result name to ndarray, e.g. {'polygonMean': theMean}
+		"""
+		values = {}
+		for name, value in results.items():
+			resultDef = resultDefs.get(name, channelResultDefs.get(name, None))
+			if resultDef is not None:
+				shape, dtype = resultDef
+				value = np.asarray(value, dtype=dtype)
+			values[name] = value
+		with self._lock:
+			for name, value in values.items():
+				self.metadata[index][name] = value
+				self._setDirty(index, name)
+			self._versions[self.ids[index]] += 1
+
+	def getVersion(self, index):
+		""" return version of results of one shape, it changes each time we setResults() """
+		return self._versions[self.ids[index]]
+
+	def getShapeDict(self, index):
+		""" return a dict with the drawing parameters of one shape (not the data) """
+		return {
+			'shape_types': self.shape_types[index],
+			'edge_colors': self.edge_colors[index],
+			'face_colors': self.face_colors[index],
+			'edge_widths': self.edge_widths[index],
+			'opacities': self.opacities[index],
+		}
+
+	def indexOf(self, id):
+		""" return shape index of a shape id, None if there is no shape with this id """
+		with self._lock:
+			if self._indexOfId is None:
+				self._indexOfId = {id: index for index, id in enumerate(self.ids)}
+			return self._indexOfId.get(id, None)
+
+	def shapeIds(self, shape_type):
+		""" return list of shape id with a given shape type, in shape index order """
+		return list(self._typeIds.get(shape_type, {}).keys())
+
+	def shapeIndices(self, shape_type):
+		""" return list of shape index with a given shape type """
+		return [self.indexOf(id) for id in self._typeIds.get(shape_type, {})]
+
+	#
+	# dirty tracking
+	#
+	def _setDirty(self, index, name):
+		with self._lock:
+			id = self.ids[index]
+			self._dirty.setdefault(id, set()).add(name)
+
+	@property
+	def isDirty(self):
+		""" True if anything changed since last save """
+		return len(self._dirty) > 0 or len(self._deleted) > 0
+
+	def clearDirty(self):
+		""" mark everything as saved """
+		with self._lock:
+			self._dirty = {}
+			self._deleted = set()
+
+	def takeChanges(self, full=False):
+		"""
+		Return a snapshot of what needs to be saved and clear our dirty state
+
+		The snapshot holds its own references to data and result arrays,
+		it can be written from another thread while the user keeps editing.
+		If the write fails, give it back with restoreChanges()
+
+		Parameters:
+			full: if True return all shapes, not just dirty ones
+
+		Returns:
+			dict with
+				'full': bool
+				'order': list of all shape ids, in order
+				'deleted': set of deleted shape ids
+				'shapes': dict of shape id: dict of (shape_types, data, edge_widths, ...)
+				'results': dict of shape id: dict of result name: ndarray
+		"""
+		with self._lock:
+			changes = {
+				'full': full,
+				'order': list(self.ids),
+				'deleted': set() if full else set(self._deleted),
+				'shapes': {},
+				'results': {},
+			}
+			for index, id in enumerate(self.ids):
+				if full:
+					dirty = set([shapeDirtyName]) | set(self.metadata[index].keys())
+				else:
+					dirty = self._dirty.get(id, None)
+				if not dirty:
+					continue
+				if shapeDirtyName in dirty:
+					shapeDict = self.getShapeDict(index)
+					shapeDict['data'] = self.data[index]
+					changes['shapes'][id] = shapeDict
+				results = {name: self.metadata[index][name] for name in dirty
+							if name != shapeDirtyName and name in self.metadata[index]}
+				if results:
+					changes['results'][id] = results
+
+			self.clearDirty()
+		return changes
+
+	def restoreChanges(self, changes):
+		""" put back dirty state from takeChanges(), after a failed save """
+		with self._lock:
+			for id in changes['deleted']:
+				if self.indexOf(id) is None:
+					self._deleted.add(id)
+			for id in changes['shapes'].keys():
+				if self.indexOf(id) is not None:
+					self._dirty.setdefault(id, set()).add(shapeDirtyName)
+			for id, results in changes['results'].items():
+				if self.indexOf(id) is not None:
+					self._dirty.setdefault(id, set()).update(results.keys())
+			if changes['full']:
+				# we do not know what is in the file
+				self.path = None
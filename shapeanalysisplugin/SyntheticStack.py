@@ -0,0 +1,103 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Deterministic synthetic image stacks with known answers, for benchmarks and checking analysis.
+
+	vessels: vertical tubes with a gaussian cross section, the diameter (full width at half maximum)
+		of each vessel changes from image to image
+	cells: disks whose intensity follows a calcium like transient (rise, exponential decay)
+
+The same parameters (and seed) always give the same stack.
+"""
+
+import numpy as np
+
+def syntheticStack(numImages=100, imageShape=(128,128), numVessels=1, numCells=8,
+					noise=0.05, seed=0, dtype=np.float32):
+	"""
+	Parameters:
+		numImages: number of images (frames/slices)
+		imageShape: (rows, cols) of each image
+		numVessels: vessels are in the left half of the image
+		numCells: cells are in the right half of the image, they do not overlap (ValueError if they do not fit)
+		noise: standard deviation of gaussian noise added to each pixel
+		seed: random seed
+
+	Returns:
+		dict with
+			data: (numImages, rows, cols) stack
+			lines: list of (src, dst), one line across each vessel (for ShapeAnalysis.stackLineProfile)
+			diameters: (numVessels, numImages) true full width at half maximum of each vessel, in pixels
+			polygons: list of (16,2) vertex points, one around each cell (for ShapeAnalysis.stackPolygonAnalysis)
+			traces: (numCells, numImages) true mean intensity in each cell polygon, without noise
+	"""
+	rng = np.random.default_rng(seed)
+	rows, cols = imageShape
+	background = 0.1
+	data = np.full((numImages, rows, cols), background, dtype=np.float32)
+	frames = np.arange(numImages)
+
+	# vessels, evenly spaced in the left half
+	lines = []
+	diameters = np.zeros((numVessels, numImages))
+	x = np.arange(cols)
+	for vesselIdx in range(numVessels):
+		center = (vesselIdx + 1) * (cols / 2) / (numVessels + 1)
+		baseDiameter = max(3.0, cols / (8 * max(numVessels, 1)))
+		period = rng.uniform(20, 60)
+		diameter = baseDiameter * (1 + 0.2 * np.sin(2 * np.pi * frames / period + rng.uniform(0, 2*np.pi)))
+		diameters[vesselIdx] = diameter
+		# gaussian with full width at half maximum of diameter, the same in every row
+		crossSection = np.exp(-4 * np.log(2) * (x[None,:] - center)**2 / diameter[:,None]**2)
+		data += crossSection[:, None, :].astype(np.float32)
+		row = rows // 2
+		halfLength = min(2 * baseDiameter, center)
+		lines.append((np.array([row, center - halfLength]), np.array([row, center + halfLength])))
+
+	# cells, random positions in the right half, a position that overlaps a cell we have is drawn again
+	# so the pixels of each cell are its trace
+	polygons = []
+	traces = np.zeros((numCells, numImages))
+	radius = max(3, min(rows, cols) // 32)
+	angles = np.linspace(0, 2*np.pi, 16, endpoint=False)
+	yy, xx = np.mgrid[-radius:radius+1, -radius:radius+1]
+	disk = (yy**2 + xx**2) <= radius**2
+	centers = np.zeros((0, 2))
+	maxTries = 1000
+	for cellIdx in range(numCells):
+		for tries in range(maxTries):
+			centerRow = rng.integers(radius, rows - radius)
+			centerCol = rng.integers(cols // 2 + radius, cols - radius)
+			# disks of radius share no pixel when centers are more than 2 radius apart, keep one pixel between
+			if np.all(np.hypot(centers[:,0] - centerRow, centers[:,1] - centerCol) > 2 * radius + 1):
+				break
+		else:
+			raise ValueError('syntheticStack() can not fit ' + str(numCells) + ' cells of radius ' + str(radius) +
+							' without overlap in the right half of ' + str(imageShape))
+		centers = np.vstack([centers, [centerRow, centerCol]])
+		# transients, each is an instant rise and an exponential decay
+		trace = np.zeros(numImages)
+		for onset in rng.integers(0, numImages, size=max(1, numImages // 50)):
+			trace[onset:] += rng.uniform(0.5, 1.5) * np.exp(-(frames[onset:] - onset) / rng.uniform(3, 15))
+		traces[cellIdx] = background + 0.2 + trace
+		top, left = centerRow - radius, centerCol - radius
+		cellImage = data[:, top:top+2*radius+1, left:left+2*radius+1]
+		cellImage[:, disk] = (background + 0.2 + trace[:, None]).astype(np.float32)
+		# polygon just inside the disk so every pixel it covers is in the cell
+		vertexRadius = radius * 0.8
+		polygons.append(np.column_stack([centerRow + vertexRadius * np.sin(angles),
+											centerCol + vertexRadius * np.cos(angles)]))
+
+	if noise > 0:
+		for start in range(0, numImages, 256):
+			block = data[start:start+256]
+			block += noise * rng.standard_normal(block.shape, dtype=np.float32)
+
+	return {
+		'data': data.astype(dtype, copy=False),
+		'lines': lines,
+		'diameters': diameters,
+		'polygons': polygons,
+		'traces': traces,
+	}
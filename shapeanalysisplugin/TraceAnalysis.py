@@ -0,0 +1,247 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Normalized traces of polygon analysis, computed once when the analysis changes.
+
+polygonMeanNorm is polygonMean as percent of its baseline (baseline is 100),
+polygonMeanDeltaFF is (F - F0) / F0. F0 is the mean of polygonMean over a baseline window of slices.
+
+These are stored with the raw trace in the shape metadata (and saved), plotting and export
+use them as is.
+
+For long recordings F0 drifts (bleaching, focus), a rolling baseline follows it.
+F0 of each slice is a low percentile of polygonMean in a sliding window of slices,
+polygonRollingDeltaFF is (F - F0) / F0. With 4d (color, slice, row, col) data,
+polygonRatio is the ratio of two channels of polygonMeanChannels (e.g. GCaMP / tdTomato).
+These are computed for many polygons at once from the (roi, slice) matrix, see updateRollingTraces().
+"""
+
+import numpy as np
+import scipy.ndimage
+
+# default baseline window (start slice, stop slice), python slice so stop is not included
+defaultBaselineWindow = (0, 10)
+
+# default rolling baseline, F0 is this percentile in a window of this many slices
+defaultRollingWindow = 301
+defaultRollingPercentile = 8
+
+# default channels of polygonRatio (numerator, denominator)
+defaultRatioPair = (0, 1)
+
+def traceBaseline(trace, baselineWindow=defaultBaselineWindow):
+	"""
+	Return F0, the mean of trace over the baseline window (nan is ignored)
+
+	Returns nan if there is no finite value in the window
+	"""
+	start, stop = int(baselineWindow[0]), int(baselineWindow[1])
+	window = np.asarray(trace[start:stop], dtype=np.float64)
+	window = window[np.isfinite(window)]
+	if len(window) == 0:
+		return np.nan
+	return window.mean()
+
+def normalizeTrace(trace, baselineWindow=defaultBaselineWindow):
+	"""
+	Parameters:
+		trace: 1d ndarray, e.g. polygonMean
+		baselineWindow: (start, stop) slice of trace to use as F0
+
+	Returns:
+		norm: trace / F0 * 100
+		deltaFF: (trace - F0) / F0
+		both all nan if F0 is nan or 0
+	"""
+	trace = np.asarray(trace, dtype=np.float32)
+	f0 = traceBaseline(trace, baselineWindow)
+	if not np.isfinite(f0) or f0 == 0:
+		print('TraceAnalysis.normalizeTrace() warning: no baseline in window', baselineWindow)
+		nanTrace = np.full(trace.shape, np.nan, dtype=np.float32)
+		return nanTrace, nanTrace.copy()
+	f0 = np.float32(f0)
+	deltaFF = (trace - f0) / f0
+	norm = (deltaFF + 1) * 100
+	return norm, deltaFF
+
+def polygonTraceResults(polygonMean, baselineWindow=defaultBaselineWindow):
+	"""
+	Return dict of normalized polygon results to pass to ShapeList.setResults()
+	"""
+	norm, deltaFF = normalizeTrace(polygonMean, baselineWindow)
+	return {
+		'polygonMeanNorm': norm,
+		'polygonMeanDeltaFF': deltaFF,
+		'polygonBaselineWindow': np.asarray(baselineWindow),
+	}
+
+def updateNormalizedTraces(shapeList, index, baselineWindow=None):
+	"""
+	(re)compute normalized traces of one polygon shape from its polygonMean
+
+	Parameters:
+		shapeList: ShapeList
+		index: shape index
+		baselineWindow: (start, stop), if None then use the window the shape already has (or the default)
+	"""
+	metadata = shapeList.metadata[index]
+	polygonMean = metadata['polygonMean']
+	if len(polygonMean) < 1:
+		return
+	if baselineWindow is None:
+		baselineWindow = metadata.get('polygonBaselineWindow', None)
+		if baselineWindow is None or len(baselineWindow) != 2:
+			baselineWindow = defaultBaselineWindow
+	shapeList.setResults(index, polygonTraceResults(polygonMean, baselineWindow))
+
+def _finitePercentile(windows, percentile):
+	"""
+	Percentile of the finite values in each window, like percentile_filter() the value of rank
+	int(n * percentile / 100) of the n sorted values (not interpolated)
+
+	Parameters:
+		windows: (windows, window) float, nan for values to leave out
+
+	Returns:
+		(windows) nan where a window has no finite value
+	"""
+	windows = np.sort(windows, axis=-1) # nan sort last
+	n = np.count_nonzero(~np.isnan(windows), axis=-1)
+	if percentile == 100:
+		rank = n - 1
+	else:
+		rank = (n * float(percentile) / 100.0).astype(np.int64)
+	rank = np.clip(rank, 0, windows.shape[-1] - 1)
+	return np.take_along_axis(windows, rank[:, np.newaxis], axis=-1)[:, 0]
+
+def rollingPercentile(traces, window=defaultRollingWindow, percentile=defaultRollingPercentile, maxBlockBytes=64 * 1024**2):
+	"""
+	Sliding window percentile along each row of a (roi, slice) matrix
+
+	scipy.ndimage.percentile_filter() of a 1d array uses a sorted window, O(n log w), but of a 2d
+	array with size (1, window) it sorts each window, O(n w). So we pad each row (like mode='nearest'),
+	put rows end to end, and filter blocks of rows as one 1d array.
+
+	Non-finite values (nan, inf) are left out of each window, the percentile is of the finite values in it.
+	The sorted window can not leave values out, windows with a non-finite value are sorted one by one
+	(see _finitePercentile), a few gaps in a long trace are cheap.
+
+	Parameters:
+		traces: (roi, slice) or (slice)
+		window: slices in window, centered, made odd
+		percentile: 0..100
+
+	Returns:
+		float32 same shape as traces, nan where traces is not finite or a window has no finite value
+	"""
+	traces = np.asarray(traces, dtype=np.float32)
+	is1d = traces.ndim == 1
+	traces = np.atleast_2d(traces)
+	numRows, numSlices = traces.shape
+	baseline = np.full(traces.shape, np.nan, dtype=np.float32)
+	if numRows == 0 or numSlices == 0:
+		return baseline[0] if is1d else baseline
+	half = min(int(window), 2 * numSlices - 1) // 2
+	window = 2 * half + 1
+
+	paddedSlices = numSlices + 2 * half
+	blockRows = max(1, maxBlockBytes // (paddedSlices * 4 * 3))
+	for start in range(0, numRows, blockRows):
+		block = traces[start:start+blockRows]
+		isFinite = np.isfinite(block)
+		# filter with 0 in place of non-finite values, then redo the windows they are in
+		padded = np.pad(np.where(isFinite, block, 0), ((0, 0), (half, half)), mode='edge')
+		filtered = scipy.ndimage.percentile_filter(padded.ravel(), percentile, size=window)
+		filtered = filtered.reshape(padded.shape)[:, half:half+numSlices]
+		if not isFinite.all():
+			paddedFinite = np.pad(isFinite, ((0, 0), (half, half)), mode='edge')
+			hasGap = scipy.ndimage.maximum_filter1d((~paddedFinite).view(np.uint8), window, axis=1)
+			gapRows, gapSlices = np.nonzero(hasGap[:, half:half+numSlices])
+			paddedNan = np.where(paddedFinite, padded, np.nan).astype(np.float32)
+			windows = np.lib.stride_tricks.sliding_window_view(paddedNan, window, axis=1)
+			gapBlock = max(1, maxBlockBytes // (window * 4 * 2))
+			for gapStart in range(0, len(gapRows), gapBlock):
+				rows = gapRows[gapStart:gapStart+gapBlock]
+				slices = gapSlices[gapStart:gapStart+gapBlock]
+				filtered[rows, slices] = _finitePercentile(windows[rows, slices], percentile)
+		filtered[~isFinite] = np.nan
+		baseline[start:start+blockRows] = filtered
+	return baseline[0] if is1d else baseline
+
+def rollingDeltaFF(traces, window=defaultRollingWindow, percentile=defaultRollingPercentile):
+	"""
+	Returns:
+		deltaFF: (F - F0) / F0, nan where F0 is 0
+		baseline: F0, see rollingPercentile()
+	"""
+	traces = np.asarray(traces, dtype=np.float32)
+	baseline = rollingPercentile(traces, window, percentile)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		deltaFF = (traces - baseline) / baseline
+	deltaFF[baseline == 0] = np.nan
+	return deltaFF, baseline
+
+def channelRatio(channelTraces, ratioPair=defaultRatioPair):
+	"""
+	Ratio of two channels
+
+	Parameters:
+		channelTraces: (channels, slice) or (roi, channels, slice), e.g. polygonMeanChannels
+		ratioPair: (numerator, denominator) channel
+
+	Returns:
+		float32 (slice) or (roi, slice), nan where denominator is 0
+	"""
+	channelTraces = np.asarray(channelTraces, dtype=np.float32)
+	numerator = channelTraces[..., ratioPair[0], :]
+	denominator = channelTraces[..., ratioPair[1], :]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		ratio = numerator / denominator
+	ratio[denominator == 0] = np.nan
+	return ratio
+
+def updateRollingTraces(shapeList, indexList=None, window=defaultRollingWindow, percentile=defaultRollingPercentile,
+						ratioPair=defaultRatioPair, maxBlockBytes=64 * 1024**2):
+	"""
+	(re)compute rolling baseline results of many polygon shapes at once
+
+	Polygons with the same number of slices are stacked into a (roi, slice) matrix,
+	in blocks of rows so we never need all traces at once.
+
+	Results:
+		polygonRollingBaseline: F0 of each slice
+		polygonRollingDeltaFF: (F - F0) / F0
+		polygonRollingWindow: (window, percentile)
+		polygonRatio, polygonRatioPair: 4d data only, ratio of two channels of polygonMeanChannels
+
+	Parameters:
+		shapeList: ShapeList
+		indexList: shape index of polygons, if None then all rectangle/polygon shapes
+	"""
+	if indexList is None:
+		indexList = shapeList.shapeIndices('rectangle') + shapeList.shapeIndices('polygon')
+	# shape index by number of slices
+	groups = {}
+	for index in indexList:
+		numSlices = len(shapeList.metadata[index]['polygonMean'])
+		if numSlices > 0:
+			groups.setdefault(numSlices, []).append(index)
+
+	for numSlices, group in groups.items():
+		blockRows = max(1, maxBlockBytes // (numSlices * 4 * 4))
+		for start in range(0, len(group), blockRows):
+			blockIndex = group[start:start+blockRows]
+			traces = np.stack([np.asarray(shapeList.metadata[index]['polygonMean'], dtype=np.float32) for index in blockIndex])
+			deltaFF, baseline = rollingDeltaFF(traces, window, percentile)
+			for row, index in enumerate(blockIndex):
+				results = {
+					'polygonRollingBaseline': baseline[row],
+					'polygonRollingDeltaFF': deltaFF[row],
+					'polygonRollingWindow': np.array([window, percentile], dtype=np.float64),
+				}
+				channelTraces = shapeList.metadata[index].get('polygonMeanChannels', None)
+				if channelTraces is not None and np.ndim(channelTraces) == 2 and max(ratioPair) < channelTraces.shape[0]:
+					results['polygonRatio'] = channelRatio(channelTraces, ratioPair)
+					results['polygonRatioPair'] = np.asarray(ratioPair)
+				shapeList.setResults(index, results)
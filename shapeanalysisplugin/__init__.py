@@ -1,2 +1,19 @@
 from .ShapeAnalysis import ShapeAnalysis
-from .myPyQtGraphWidget import myPyQtGraphWidget
+from .ShapeList import ShapeList
+from .ShapeFile import saveShapeFile, saveShapeFileInBackground, loadShapeFile, migrateShapeFile
+from .ResultStore import ResultStore
+from .MinMaxPyramid import MinMaxPyramid
+from .TraceAnalysis import normalizeTrace, updateNormalizedTraces, rollingPercentile, rollingDeltaFF, channelRatio, updateRollingTraces
+from .RoiImport import gridRectangles, shapesFromCsv, shapesFromLabelImage, importShapes
+
+def __getattr__(name):
+	"""
+	Import the Qt widget only when it is asked for,
+	headless code (notebooks, batch, workers) does not pay for PyQt5/pyqtgraph imports
+	"""
+	if name == 'myPyQtGraphWidget':
+		from .myPyQtGraphWidget import myPyQtGraphWidget
+		# importing the submodule set our attribute to the module, we want the class
+		globals()['myPyQtGraphWidget'] = myPyQtGraphWidget
+		return myPyQtGraphWidget
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
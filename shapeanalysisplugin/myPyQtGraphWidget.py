@@ -1,22 +1,36 @@
 # Robert Cudmore
 # 20191220
 
+import collections
 import numpy as np
 
 from PyQt5 import QtGui, QtSql, QtCore, QtWidgets
 
 import pyqtgraph as pg
 
+try:
+	from .MinMaxPyramid import MinMaxPyramid
+	from .TraceAnalysis import normalizeTrace
+	from .Instrumentation import timed
+except ImportError:
+	# when ShapeAnalysisPlugin.py is run as a script
+	from MinMaxPyramid import MinMaxPyramid
+	from TraceAnalysis import normalizeTrace
+	from Instrumentation import timed
+
 class myPyQtGraphWidget(QtWidgets.QWidget):
 	"""
-	Display shape anaysis plugin window with 4 plots. 1-3 are for line shapes, 4 is for polygon (rectangle) shapes
+	Display shape anaysis plugin window with 4 plots. 1-3 are for line shapes, 4 is for polygon (rectangle and polygon) shapes
 		1) Line intensity profile + gaussian fit + heuristic fit.
 			This is updated in real time while user drags a line shape
 		2) Plot of calculated diameter (y) for each slice/frame in the image
 		3) 'Kymograph' image plot of line intensity profile (y) versus each slice/frame in the image
 		4) The mean intensity in each polygon/ractangle shape (y) versus each  slice/frame in the image
 	"""
-	def __init__(self, shapeLayer):
+	def __init__(self, shapeList):
+		"""
+		shapeList: ShapeList with shapes and their analysis results
+		"""
 		super(myPyQtGraphWidget, self).__init__()
 
 		xPos = 100
@@ -25,11 +39,30 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		height = 900
 		self.setGeometry(xPos, yPos, width, height)
 
-		self.shapeLayer = shapeLayer
-		#self.selectedShapeIndex = None
-		self.polygonMeanListPlot = []
+		self.shapeList = shapeList
 		self.sliceLinesList = []
 
+		# what we last plotted for each polygon, shape id: (version, index, MinMaxPyramid)
+		# we only recompute a polygon when its results (version) or index changes
+		# traces are plotted with one (min, max) per pixel at the current zoom, see MinMaxPyramid
+		self.polygonPlotModel = {}
+		self.selectedPolygon = None # (id, version, index) plotted in self.selectedPolygonMeanPlot
+		self.selectedPolygonPyramid = None
+		self.selectedPolygonOffset = 0
+		self.selectedLine = None # (id, version) plotted in self.diameterPlot and kymograph
+		self.diameterPyramid = None
+
+		# kymograph of selected line, can be ndarray, np.memmap or ShapeFile.LazyArray
+		# we show a precomputed overview and, when zoomed in, full resolution tiles of what is visible
+		# see _updateKymographWindow()
+		self.kymograph = None
+		self.kymographLevels = None # (lower, upper) precomputed with the analysis, see ShapeAnalysis.kymographSummary()
+		self.kymographTiles = collections.OrderedDict() # tile number: ndarray, least recently used first
+		self.kymographTileSlices = 1024 # slices in each tile
+		self.maxKymographTiles = 32 # number of tiles we keep
+		self.maxKymographColumns = 2000 # when fewer slices than this are visible we show full resolution tiles
+		self._inKymographUpdate = False
+
 		self.initUI()
 
 	def initUI(self):
@@ -76,6 +109,7 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		self.diameterWindow.addItem(sliceLine)
 		#
 		self.diameterPlot = self.diameterWindow.plot(name='lineintensitydiameter')
+		self.diameterWindow.sigXRangeChanged.connect(self._updateDiameterPlot)
 
 		rightVBoxLayout.addWidget(self.diameterWindow)
 
@@ -84,8 +118,13 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		self.kymographWindow = pg.PlotWidget()
 		self.kymographWindow.setLabel('left', 'Line Intensity Profile', units='')
 
+		# overview of all slices
 		self.img = pg.ImageItem()
 		self.kymographWindow.addItem(self.img)
+		# full resolution tiles of visible slices, on top of overview
+		self.kymographDetail = pg.ImageItem()
+		self.kymographWindow.addItem(self.kymographDetail)
+		self.kymographWindow.sigXRangeChanged.connect(self._updateKymographWindow)
 
 		sliceLine = pg.InfiniteLine(pos=0, angle=90)
 		self.sliceLinesList.append(sliceLine) # keep a list of vertical slice lines so we can update all at once
@@ -105,8 +144,10 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		# the selected shapes mean (through all slices)
 		self.selectedPolygonMeanPlot = self.polygonPlotWidget.plot(symbolSize=3, name='analysisPolygonMean')
 
-		# all polygon mean across all shapes/rois
-		self.polygonMeanListPlot = []
+		# all polygon mean across all shapes/rois, one plot item with a nan between each shape
+		self.polygonMeanListPlot = self.polygonPlotWidget.plot(pen=(255,0,0), name='polygonMeanListPlot')
+
+		self.polygonPlotWidget.sigXRangeChanged.connect(self._onPolygonRangeChanged)
 
 		rightVBoxLayout.addWidget(self.polygonPlotWidget)
 
@@ -114,69 +155,142 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		self.show()
 
 	def shape_delete(self, index):
-		""" Remove a polygon from the list """
-		type = self.shapeLayer.shape_types[index]
-		if type == 'rectangle':
-			# we can't use index as it includes all shapes, we need index into rectangle to remove?
-			rectangleIndex = self._getRectangleIndex(index)
-			print('*** shape_delete() deleting rectangle at shape index', index, 'rectangleIndex', rectangleIndex)
-
-			try:
-				# before we delete, clear the plot
-				self.polygonMeanListPlot[rectangleIndex].setData([], [], connect='finite')
-				# remove the plot
-				self.polygonMeanListPlot.pop(rectangleIndex) # remove from self.polygonMeanListPlot
-
-				# clear the white selection
-				self.selectedPolygonMeanPlot.setData([], [])
-			except (IndexError) as e:
-				print('Exception in shape_delete() e:', str(e))
+		""" A shape is about to be deleted, plots are updated on next plotAllPolygon() """
+		# clear the white selection
+		self.selectedPolygonMeanPlot.setData([], [])
+		self.selectedPolygon = None
 
 	def updateShapeSelection(self, index):
 		"""
 		On user selecting a shape
+
+		Results loaded from a file can be ShapeFile.LazyArray, np.asarray() reads them from the file (once)
 		"""
 
 		#print('myQtGraphWidget.updateShapeSelection() index:', index)
 		if index is None:
 			return
 
-		type = self.shapeLayer.shape_types[index]
+		type = self.shapeList.shape_types[index]
 		if type == 'line':
 			# line profile
-
-			# diameter plot
-			lineDiameter = self.shapeLayer.metadata[index]['lineDiameter']
-			xPlot = np.asarray([slice for slice in range(len(lineDiameter))])
-			self.diameterPlot.setData(xPlot, lineDiameter, connect='finite')
-			# kymograph
-			lineKymograph = self.shapeLayer.metadata[index]['lineKymograph']
-			self.img.setImage(lineKymograph)
+			selectedLine = (self.shapeList.ids[index], self.shapeList.getVersion(index))
+			if selectedLine != self.selectedLine:
+				self.selectedLine = selectedLine
+
+				# diameter plot
+				lineDiameter = np.asarray(self.shapeList.metadata[index]['lineDiameter'])
+				self.diameterPyramid = MinMaxPyramid(lineDiameter)
+				self._updateDiameterPlot()
+				# kymograph, only read what is visible
+				self.kymograph = self.shapeList.metadata[index]['lineKymograph']
+				self.kymographTiles.clear()
+				self._setKymographOverview(self.shapeList.metadata[index])
+				self._inKymographUpdate = True
+				self.kymographWindow.setXRange(0, self.kymograph.shape[0], padding=0)
+				self.kymographWindow.setYRange(0, self.kymograph.shape[1], padding=0)
+				self._inKymographUpdate = False
+				self._updateKymographWindow()
 			# cancel any polygon selections
-			self.selectedPolygonMeanPlot.setData([], [])
-			#self.plotAllPolygon(index)
-		elif type == 'rectangle':
-			try:
-				polygonMean = self.shapeLayer.metadata[index]['polygonMean']
+			self._updateSelectedPolygon(None)
+		elif type in ['rectangle', 'polygon']:
+			self.plotAllPolygon(index)
+		else:
+			print('updateShapeSelection() unknown type:', type)
 
-				# normalize to first few points
-				tmpMean = np.nanmean(polygonMean[0:10])
-				polygonMean = polygonMean / tmpMean * 100
-				polygonMean += index * 20
+	def _visibleRange(self, plotWidget, numSlices):
+		"""
+		Return (xMin, xMax, numPixels) of a plot to get from a MinMaxPyramid
 
-				xPlot = np.asarray([slice for slice in range(len(polygonMean))])
+		If the plot is auto ranging we want all slices, otherwise what is visible
+		"""
+		viewBox = plotWidget.getViewBox()
+		numPixels = max(100, int(viewBox.width()))
+		if viewBox.autoRangeEnabled()[0]:
+			return 0, numSlices, numPixels
+		(xMin, xMax), (yMin, yMax) = viewBox.viewRange()
+		return xMin, xMax, numPixels
+
+	@timed('plot.diameter')
+	def _updateDiameterPlot(self, *args):
+		""" plot the visible part of the selected line diameter """
+		if self.diameterPyramid is None:
+			return
+		xMin, xMax, numPixels = self._visibleRange(self.diameterWindow, len(self.diameterPyramid))
+		xPlot, lineDiameter = self.diameterPyramid.get(xMin, xMax, numPixels)
+		self.diameterPlot.setData(xPlot, lineDiameter, connect='finite')
 
-				# the selection
-				self.selectedPolygonMeanPlot.setData(xPlot, polygonMean)
+	def _setKymographOverview(self, metadata):
+		"""
+		Show the overview of the selected kymograph, using display levels computed with the analysis
 
-				# all other polygons, will become slow when we have lots
-				self.plotAllPolygon(index)
-			except (IndexError) as e:
-				print('exception in updateShapeSelection() e:', str(e))
+		Analysis from before we had an overview, we stride through slices and auto level
+		"""
+		numImages, numPoints = self.kymograph.shape
+		overview = metadata.get('lineKymographOverview', None)
+		levels = metadata.get('lineKymographLevels', None)
+		if overview is None or np.size(overview) == 0:
+			blockSize = max(1, int(np.ceil(numImages / self.maxKymographColumns)))
+			overview = np.asarray(self.kymograph[0:numImages:blockSize])
+		else:
+			overview = np.asarray(overview)
+			blockSize = max(1, int(np.ceil(numImages / overview.shape[0])))
 
+		self._inKymographUpdate = True
+		if levels is None or np.size(levels) != 2:
+			self.img.setImage(overview)
+			self.kymographLevels = self.img.getLevels()
 		else:
-			print('updateShapeSelection() unknown type:', type)
+			self.kymographLevels = np.asarray(levels)
+			self.img.setImage(overview, autoLevels=False, levels=self.kymographLevels)
+		self.img.setRect(QtCore.QRectF(0, 0, overview.shape[0] * blockSize, numPoints))
+		self.kymographDetail.hide()
+		self._inKymographUpdate = False
+
+	def _getKymographTile(self, tile):
+		""" return one tile (block of self.kymographTileSlices slices) of the selected kymograph """
+		theTile = self.kymographTiles.get(tile, None)
+		if theTile is None:
+			start = tile * self.kymographTileSlices
+			theTile = np.asarray(self.kymograph[start:start+self.kymographTileSlices])
+			self.kymographTiles[tile] = theTile
+			while len(self.kymographTiles) > self.maxKymographTiles:
+				self.kymographTiles.popitem(last=False)
+		else:
+			self.kymographTiles.move_to_end(tile)
+		return theTile
+
+	@timed('plot.kymograph')
+	def _updateKymographWindow(self, *args):
+		"""
+		Show full resolution tiles of the selected kymograph when zoomed in
 
+		When more than self.maxKymographColumns slices are visible the overview is enough.
+		We only read the tiles that are visible, a disk backed kymograph is never read all at once
+		"""
+		if self.kymograph is None or self._inKymographUpdate:
+			return
+		numImages = self.kymograph.shape[0]
+		(xMin, xMax), (yMin, yMax) = self.kymographWindow.viewRange()
+		start = int(max(0, np.floor(xMin)))
+		stop = int(min(numImages, np.ceil(xMax) + 1))
+		if stop <= start or stop - start > self.maxKymographColumns:
+			self.kymographDetail.hide()
+			return
+
+		firstTile = start // self.kymographTileSlices
+		lastTile = (stop - 1) // self.kymographTileSlices
+		tiles = [self._getKymographTile(tile) for tile in range(firstTile, lastTile+1)]
+		detail = np.concatenate(tiles) if len(tiles) > 1 else tiles[0]
+
+		self._inKymographUpdate = True
+		self.kymographDetail.setImage(detail, autoLevels=False, levels=self.kymographLevels)
+		# place the tiles at their slices
+		self.kymographDetail.setRect(QtCore.QRectF(firstTile * self.kymographTileSlices, 0, detail.shape[0], detail.shape[1]))
+		self.kymographDetail.show()
+		self._inKymographUpdate = False
+
+	@timed('plot.line')
 	def updateLinePlot(self, x, oneProfile, fit=None, leftIdx=np.nan, rightIdx=np.nan):
 		"""
 		Update the line intensity profile plot (real time as user drags)
@@ -192,8 +306,6 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		"""
 		#print('myPyQtGraphWidget.updateLinePlot()')
 		if (oneProfile is not None):
-			print('   oneProfile.shape', oneProfile.shape)
-			print('   x.shape', x.shape)
 			self.lineIntensityPlot.setData(x,oneProfile)
 			self.lineIntensityPlot.update()
 
@@ -218,58 +330,120 @@ class myPyQtGraphWidget(QtWidgets.QWidget):
 		for line in self.sliceLinesList:
 			line.setValue(sliceNum)
 
+	def _polygonTrace(self, index):
+		"""
+		Return MinMaxPyramid to plot for one polygon shape, y is normalized
+
+		When plotting, y is offset by shape index (see _polygonOffset), the pyramid does not
+		depend on index so we keep it when the index changes on delete.
+
+		Returns None if there is no analysis
+		"""
+		metadata = self.shapeList.metadata[index]
+		polygonMeanNorm = metadata.get('polygonMeanNorm', None)
+		if polygonMeanNorm is None or len(polygonMeanNorm) < 1:
+			# analysis from before we stored normalized traces
+			polygonMean = metadata['polygonMean']
+			if len(polygonMean) < 1:
+				return None
+			polygonMeanNorm, deltaFF = normalizeTrace(polygonMean)
+		return MinMaxPyramid(np.asarray(polygonMeanNorm))
+
+	def _polygonOffset(self, index):
+		""" offset each polygon trace by its shape index so they do not overlap """
+		return index * 20
+
+	@timed('plot.polygons')
 	def plotAllPolygon(self, selectedIndex):
 		"""
 		Plot all analysis for all polygons
 
+		Only polygons whose results (or index) changed since last time are recomputed,
+		all polygons are drawn by one plot item (self.polygonMeanListPlot) which is only set when something changed
+
 		selectedIndex : the currently selected shape
 		"""
 
 		#print('myPyQtGraphWIdget.plotAllPolygon() selectedIndex:', selectedIndex)
 
-		# first clear all
-		for idx in range(len(self.polygonMeanListPlot)):
-			self.polygonMeanListPlot[idx].setData([], [], connect='finite')
-		# then replot
-		rectangleIdx = 0 # keep track of rectangle number 0, 1, 2, ... to index into self.polygonMeanListPlot
-		for idx, type in enumerate(self.shapeLayer.shape_types):
-			if type == 'rectangle':
-				polygonMean = self.shapeLayer.metadata[idx]['polygonMean']
-				xPlot = np.asarray([slice for slice in range(len(polygonMean))])
-				#print(idx, 'polygonMean.shape:', polygonMean.shape)
-				if len(polygonMean)<1:
-					# there is no analysis
-					xPlot = []
-					polygonMean = []
-				else:
-					# normalize to first few points
-					tmpMean = np.nanmean(polygonMean[0:10])
-					polygonMean = polygonMean / tmpMean * 100
-					polygonMean += idx * 20
-
-				if len(self.polygonMeanListPlot) < rectangleIdx+1:
-					# append a new polygon ...
-					self.polygonMeanListPlot.append(self.polygonPlotWidget.plot(pen=(255,0,0), name='polygonMeanListPlot'+str(idx)))
-					print('   plotAllPolygon() appended rectangle for shape idx:', idx, rectangleIdx, len(self.polygonMeanListPlot))
-				self.polygonMeanListPlot[rectangleIdx].setData(xPlot, polygonMean, connect='finite')
-
-				rectangleIdx += 1
-
-	def _getRectangleIndex(self, shapeIndex):
-		"""
-		Given the absolute index of a shape, return the index based on number of rectangles
-
-		Parameters:
-			shapeIndex: absolute shape index
-		"""
-		theRectangleIndex = None
-		rectangleIdx = 0
-		for idx, shapeType in enumerate(self.shapeLayer.shape_types):
-			#print('looking for rectangle at shapeIndex:', shapeIndex, 'idx:', idx, 'shapeType:', shapeType)
-			if shapeType == 'rectangle':
-				if idx == shapeIndex:
-					theRectangleIndex = rectangleIdx
-					break
-				rectangleIdx += 1
-		#print('_getRectangleIndex() returning theRectangleIndex:', theRectangleIndex)
-		return theRectangleIndex
+		changed = False
+		polygonIds = set()
+		for id in self.shapeList.shapeIds('rectangle') + self.shapeList.shapeIds('polygon'):
+			idx = self.shapeList.indexOf(id)
+			version = self.shapeList.getVersion(idx)
+			polygonIds.add(id)
+			plotted = self.polygonPlotModel.get(id, None)
+			if plotted is not None and plotted[0] == version:
+				if plotted[1] != idx:
+					# index changed on delete, same trace with a new offset
+					self.polygonPlotModel[id] = (version, idx, plotted[2])
+					changed = True
+				continue
+			self.polygonPlotModel[id] = (version, idx, self._polygonTrace(idx))
+			changed = True
+
+		# deleted shapes
+		for id in [id for id in self.polygonPlotModel.keys() if id not in polygonIds]:
+			del self.polygonPlotModel[id]
+			changed = True
+
+		if changed:
+			self._updatePolygonListPlot()
+
+		self._updateSelectedPolygon(selectedIndex)
+
+	def _onPolygonRangeChanged(self, *args):
+		""" user zoomed/panned the polygon plot, get the visible part at the new level of detail """
+		self._updatePolygonListPlot()
+		self._plotSelectedPolygon()
+
+	def _polygonRange(self):
+		""" (xMin, xMax, numPixels) of the polygon plot """
+		numSlices = 0
+		for version, idx, pyramid in self.polygonPlotModel.values():
+			if pyramid is not None:
+				numSlices = max(numSlices, len(pyramid))
+		return self._visibleRange(self.polygonPlotWidget, numSlices)
+
+	@timed('plot.polygonList')
+	def _updatePolygonListPlot(self):
+		""" set self.polygonMeanListPlot from self.polygonPlotModel, shapes are separated by nan """
+		xMin, xMax, numPixels = self._polygonRange()
+		xList = []
+		yList = []
+		for version, idx, pyramid in self.polygonPlotModel.values():
+			if pyramid is None:
+				continue
+			xPlot, polygonMean = pyramid.get(xMin, xMax, numPixels)
+			polygonMean = polygonMean + self._polygonOffset(idx)
+			xList += [xPlot, [np.nan]]
+			yList += [polygonMean, [np.nan]]
+		if len(xList) == 0:
+			self.polygonMeanListPlot.setData([], [])
+		else:
+			self.polygonMeanListPlot.setData(np.concatenate(xList), np.concatenate(yList), connect='finite')
+
+	def _updateSelectedPolygon(self, selectedIndex):
+		""" plot the selected polygon in white, None to clear """
+		selectedPolygon = None
+		if selectedIndex is not None and self.shapeList.shape_types[selectedIndex] in ['rectangle', 'polygon']:
+			id = self.shapeList.ids[selectedIndex]
+			selectedPolygon = (id, self.shapeList.getVersion(selectedIndex), selectedIndex)
+		if selectedPolygon == self.selectedPolygon:
+			return
+		self.selectedPolygon = selectedPolygon
+		plotted = None
+		if selectedPolygon is not None:
+			plotted = self.polygonPlotModel.get(selectedPolygon[0], None)
+		self.selectedPolygonPyramid = None if plotted is None else plotted[2]
+		self.selectedPolygonOffset = 0 if plotted is None else self._polygonOffset(plotted[1])
+		self._plotSelectedPolygon()
+
+	def _plotSelectedPolygon(self):
+		""" plot the visible part of the selected polygon """
+		if self.selectedPolygonPyramid is None:
+			self.selectedPolygonMeanPlot.setData([], [])
+		else:
+			xMin, xMax, numPixels = self._polygonRange()
+			xPlot, polygonMean = self.selectedPolygonPyramid.get(xMin, xMax, numPixels)
+			self.selectedPolygonMeanPlot.setData(xPlot, polygonMean + self.selectedPolygonOffset)
@@ -0,0 +1,213 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Compiled kernels (shapeanalysisplugin/Kernels.py) give the same results, bit for bit, as the NumPy path.
+
+Without numba the kernels run as plain python, this tests their arithmetic, not the compile.
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin import ShapeAnalysis, Kernels
+from shapeanalysisplugin.ShapeAnalysis import segmentStats, fitProfiles, FWHM
+
+# the module, the package exports the class of the same name
+ShapeAnalysisModule = sys.modules['shapeanalysisplugin.ShapeAnalysis']
+
+dtypes = [np.uint8, np.uint16, np.int32, np.float32, np.float64]
+
+@pytest.fixture
+def kernelsOn(monkeypatch):
+	""" use the kernels, compiled or plain python """
+	monkeypatch.setattr(Kernels, 'enabled', True)
+
+@pytest.fixture
+def kernelsOff(monkeypatch):
+	monkeypatch.setattr(Kernels, 'enabled', False)
+
+def sameBits(a, b):
+	""" same dtype, shape and bits (nan and the sign of zero included) """
+	a = np.ascontiguousarray(a)
+	b = np.ascontiguousarray(b)
+	return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a.view(np.uint8), b.view(np.uint8))
+
+def randomImages(dtype, shape, special, rng):
+	""" images of many magnitudes (sums are rounded), special adds nan, inf, -0 and 0 """
+	images = rng.standard_normal(shape) * 1000 + 3000
+	if np.dtype(dtype).kind == 'f':
+		images *= 10.0 ** rng.integers(-8, 8, shape)
+	images = images.astype(dtype)
+	if special:
+		flat = images.reshape(shape[0], -1)
+		flat[0, rng.integers(0, flat.shape[-1], 50)] = np.nan
+		flat[1, rng.integers(0, flat.shape[-1], 5)] = np.inf
+		# a min of zero, -0 and 0 tie
+		flat[2, :200] = rng.choice([0.0, -0.0], 200)
+	return images
+
+def randomSegments(numPixels, rng):
+	""" flatIdx, starts, lengths of segments of many lengths (pairwise sum blocks of 8 and 128) """
+	lengths = np.concatenate([np.arange(1, 20), [127, 128, 129, 130], rng.integers(200, 2000, 4)])
+	flatIdx = np.concatenate([rng.choice(numPixels, length) for length in lengths])
+	starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+	return flatIdx, starts, lengths
+
+def specialCases(dtypes):
+	return [(dtype, special) for dtype in dtypes for special in [False, True]
+			if not special or np.dtype(dtype).kind == 'f']
+
+@pytest.mark.parametrize('dtype, special', specialCases(dtypes))
+def test_gatherSegmentStats(kernelsOn, dtype, special):
+	rng = np.random.default_rng(0)
+	images = randomImages(dtype, (3, 4096), special, rng)
+	flatIdx, starts, lengths = randomSegments(images.shape[-1], rng)
+	if special:
+		# a segment of all nan, one of only zeros
+		nanIdx = np.nonzero(np.isnan(images[0]))[0][0]
+		flatIdx = np.concatenate([flatIdx, np.full(10, nanIdx), np.arange(10)])
+		starts = np.concatenate([starts, [starts[-1] + lengths[-1], starts[-1] + lengths[-1] + 10]])
+		lengths = np.concatenate([lengths, [10, 10]])
+	stats = ['sd', 'n', 'sum']
+	with np.errstate(invalid='ignore', divide='ignore'):
+		kernelStats = Kernels.gatherSegmentStats(images, flatIdx, starts, lengths, stats)
+		numpyStats = segmentStats(np.take(images, flatIdx, axis=-1), starts, lengths, stats)
+	assert sorted(kernelStats.keys()) == sorted(numpyStats.keys())
+	for name in numpyStats.keys():
+		assert sameBits(kernelStats[name], numpyStats[name]), name
+
+def test_gatherSegmentStatsChannels(kernelsOn):
+	""" (images, channels, pixels) """
+	rng = np.random.default_rng(1)
+	images = randomImages(np.float32, (2, 3, 1024), False, rng)
+	flatIdx, starts, lengths = randomSegments(images.shape[-1], rng)
+	kernelStats = Kernels.gatherSegmentStats(images, flatIdx, starts, lengths, ['sd'])
+	numpyStats = segmentStats(np.take(images, flatIdx, axis=-1), starts, lengths, ['sd'])
+	for name in numpyStats.keys():
+		assert sameBits(kernelStats[name], numpyStats[name]), name
+
+@pytest.mark.parametrize('dtype, special', specialCases(dtypes))
+def test_gatherFrameStats(monkeypatch, dtype, special):
+	""" ShapeAnalysis._gatherStats() with and without the kernel """
+	rng = np.random.default_rng(2)
+	data = randomImages(dtype, (4, 64, 64), special, rng)
+	analysis = ShapeAnalysis(data)
+	for flatIdx in [rng.choice(64 * 64, 1000), np.arange(5), np.arange(3000)]:
+		with np.errstate(invalid='ignore', divide='ignore'):
+			monkeypatch.setattr(Kernels, 'enabled', True)
+			kernelStats = analysis._gatherStats(flatIdx, frames=np.array([0, 1, 3]), maxBlockBytes=1024 * 8)
+			monkeypatch.setattr(Kernels, 'enabled', False)
+			numpyStats = analysis._gatherStats(flatIdx, frames=np.array([0, 1, 3]), maxBlockBytes=1024 * 8)
+		for name in numpyStats.keys():
+			assert sameBits(kernelStats[name], numpyStats[name]), name
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_profileFWHM(monkeypatch, dtype):
+	""" kernel, NumPy fallback and FWHM() of each profile """
+	rng = np.random.default_rng(3)
+	x = np.arange(41)
+	profiles = 100 * np.exp(-((x - rng.uniform(10, 30, (300, 1))) / rng.uniform(2, 8, (300, 1)))**2)
+	profiles = (profiles + rng.standard_normal(profiles.shape) * 10).astype(dtype)
+	profiles[:5] = 0 # not found
+	profiles[5, 3] = np.nan
+	monkeypatch.setattr(Kernels, 'enabled', True)
+	kernelResults = Kernels.profileFWHM(profiles)
+	monkeypatch.setattr(Kernels, 'enabled', False)
+	numpyResults = Kernels.profileFWHM(profiles)
+	for kernelResult, numpyResult in zip(kernelResults, numpyResults):
+		assert sameBits(kernelResult, numpyResult)
+	# profiles with nan are nan
+	assert all(np.isnan(result[5]) for result in kernelResults)
+	oneResults = np.array([FWHM(x, profile) for profile in profiles[6:]], dtype=float).T
+	for kernelResult, oneResult in zip(kernelResults, oneResults):
+		assert np.array_equal(kernelResult[6:], oneResult, equal_nan=True)
+
+def test_useKernels(monkeypatch):
+	monkeypatch.setattr(Kernels, 'enabled', False)
+	assert not Kernels.useKernels(np.float32)
+	monkeypatch.setattr(Kernels, 'enabled', True)
+	for dtype in [np.uint8, np.uint16, np.int32, np.float32, np.float64, bool]:
+		assert Kernels.useKernels(dtype), dtype
+	# float64 can not hold every 64 bit integer, float16 is not a numba type
+	for dtype in [np.int64, np.uint64, np.float16]:
+		assert not Kernels.useKernels(dtype), dtype
+	if Kernels.numba is None:
+		Kernels.enable(True)
+		assert not Kernels.enabled
+
+class Spy:
+	""" count calls of a function and call it """
+	def __init__(self, func):
+		self.func = func
+		self.numCalls = 0
+	def __call__(self, *args, **kwargs):
+		self.numCalls += 1
+		return self.func(*args, **kwargs)
+
+def analysisAndPolygons(dtype):
+	rng = np.random.default_rng(4)
+	data = randomImages(dtype, (6, 48, 48), False, rng)
+	polygons = [np.array([[2, 2], [2, 20], [15, 30]]), np.array([[20, 5], [40, 9], [30, 40], [22, 30]]),
+				np.array([[5, 30], [5, 40], [12, 40], [12, 30]])]
+	return ShapeAnalysis(data), polygons
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_stackPolygonStatsDispatch(monkeypatch, dtype):
+	""" stackPolygonStats() uses the kernel when it can, results are the same """
+	analysis, polygons = analysisAndPolygons(dtype)
+	spy = Spy(Kernels.gatherSegmentStats)
+	monkeypatch.setattr(ShapeAnalysisModule, 'gatherSegmentStats', spy)
+	stats = ['sd', 'n', 'sum']
+	monkeypatch.setattr(Kernels, 'enabled', False)
+	numpyResults = analysis.stackPolygonStats(polygons, stats=stats, minMaskPixels=10**9)
+	assert spy.numCalls == 0
+	monkeypatch.setattr(Kernels, 'enabled', True)
+	kernelResults = analysis.stackPolygonStats(polygons, stats=stats, minMaskPixels=10**9)
+	assert spy.numCalls > 0
+	for name in numpyResults.keys():
+		assert sameBits(kernelResults[name], numpyResults[name]), name
+	# order statistics need the gathered pixels, NumPy
+	spy.numCalls = 0
+	analysis.stackPolygonStats(polygons, stats=['median'], minMaskPixels=10**9)
+	assert spy.numCalls == 0
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_stackPolygonAnalysisDispatch(monkeypatch, dtype):
+	""" per frame cache of an edited polygon, stackPolygonAnalysis(key=) """
+	analysis, polygons = analysisAndPolygons(dtype)
+	spy = Spy(Kernels.gatherFrameStats)
+	monkeypatch.setattr(ShapeAnalysisModule, 'gatherFrameStats', spy)
+	results = {}
+	for on in [False, True]:
+		monkeypatch.setattr(Kernels, 'enabled', on)
+		# analyze, then edit (delta of added and removed pixels)
+		first = analysis.stackPolygonAnalysis(polygons[1], key=on)
+		edited = analysis.stackPolygonAnalysis(polygons[1] + [1, 0], key=on)
+		results[on] = first + edited + (analysis.polygonVariance(on),)
+		assert (spy.numCalls > 0) == on
+	for kernelResult, numpyResult in zip(results[True], results[False]):
+		assert sameBits(kernelResult, numpyResult)
+
+def test_fitProfilesDispatch(monkeypatch):
+	""" fitProfiles() gets FWHM from the kernel when it can """
+	rng = np.random.default_rng(5)
+	x = np.arange(31)
+	profiles = 100 * np.exp(-((x - rng.uniform(10, 20, (20, 1))) / 4)**2) + rng.standard_normal((20, 31))
+	spy = Spy(Kernels._fwhmKernel)
+	monkeypatch.setattr(Kernels, '_fwhmKernel', spy)
+	monkeypatch.setattr(Kernels, 'enabled', False)
+	numpyResults = fitProfiles(profiles)
+	assert spy.numCalls == 0
+	monkeypatch.setattr(Kernels, 'enabled', True)
+	kernelResults = fitProfiles(profiles)
+	assert spy.numCalls == 1
+	for kernelResult, numpyResult in zip(kernelResults, numpyResults):
+		assert sameBits(kernelResult, numpyResult)
@@ -0,0 +1,91 @@
+# Robert Cudmore
+# 20261019
+
+"""
+LineSampler gives the same profiles as skimage.measure.profile_line().
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+from skimage.measure import profile_line
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin.LineSampler import LineSampler, lineProfileCoordinates
+
+imageShape = (64, 80)
+
+# (src, dst) as (row, col)
+lineList = [
+	((10, 10), (10, 50)), # horizontal
+	((5, 30), (60, 30)), # vertical
+	((3.5, 4.2), (50.7, 61.3)), # diagonal, not on pixel centers
+	((60, 5), (20, 70)), # diagonal, up
+	((30, 70), (30, 10)), # right to left
+	((0, 0), (63, 79)), # corner to corner
+	((0, 20), (0, 60)), # along the top edge, width goes outside the image
+	((10, 79), (55, 79)), # along the right edge
+	((63, 40), (40, 79)), # touching bottom and right edges
+	((-2, 10), (20, 83)), # end points outside the image
+	((20, 20), (20, 20)), # one point
+	((40, 40), (41, 42)), # short
+]
+
+def makeImages(dtype, shape):
+	rng = np.random.default_rng(0)
+	images = rng.uniform(0, 4000, shape)
+	return images.astype(dtype)
+
+@pytest.mark.parametrize('linewidth', [1, 2, 3, 5, 8])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32, np.float64])
+def test_profileLine(dtype, linewidth):
+	""" same width, order and mode as profile_line() """
+	image = makeImages(dtype, imageShape)
+	profiles = LineSampler(lineList, imageShape, linewidth).sample(image)
+	for (src, dst), profile in zip(lineList, profiles):
+		expected = profile_line(image, src, dst, linewidth=linewidth, order=1, mode='reflect', reduce_func=np.mean)
+		assert profile.shape == expected.shape
+		assert np.array_equal(profile, expected), (src, dst)
+
+def test_profileLineWidths():
+	""" lines of different widths in one sampler, and a block of images """
+	images = makeImages(np.float32, (3, 2) + imageShape) # (images, channels, rows, cols)
+	linewidths = [1 + idx % 4 * 2 for idx in range(len(lineList))]
+	profiles = LineSampler(lineList, imageShape, linewidths).sample(images)
+	for (src, dst), linewidth, profile in zip(lineList, linewidths, profiles):
+		assert profile.shape[:2] == images.shape[:2]
+		for image in range(images.shape[0]):
+			for channel in range(images.shape[1]):
+				expected = profile_line(images[image, channel], src, dst, linewidth=linewidth, order=1, mode='reflect')
+				assert np.array_equal(profile[image, channel], expected), (src, dst, linewidth)
+
+@pytest.mark.parametrize('linewidth', [1, 4, 7])
+def test_lineProfileCoordinates(linewidth):
+	from skimage.measure.profile import _line_profile_coordinates
+	for src, dst in lineList:
+		expected = _line_profile_coordinates(src, dst, linewidth=linewidth)
+		assert np.array_equal(lineProfileCoordinates(src, dst, linewidth), expected), (src, dst)
+
+def test_analyzeAll():
+	""" lineKymograph of stack analysis, each line with its own width, in blocks of images """
+	from shapeanalysisplugin import ShapeAnalysis
+	data = makeImages(np.uint16, (7,) + imageShape)
+	analysis = ShapeAnalysis(data)
+	analysis.doSingleThread = True
+	# the gaussian fit needs 3 points
+	fitLines = [(src, dst) for src, dst in lineList if lineProfileCoordinates(src, dst).shape[1] >= 3]
+	linewidths = [1 + idx % 3 * 2 for idx in range(len(fitLines))]
+	lineResults, polygonResults = analysis.analyzeAll(fitLines, [], linewidth=linewidths, maxBlockBytes=64 * 1024)
+	for (src, dst), linewidth, (x, results) in zip(fitLines, linewidths, lineResults):
+		kymograph = results['lineKymograph']
+		# slices where the gaussian fit failed are nan
+		slices = [slice for slice in range(len(data)) if not np.isnan(kymograph[slice]).all()]
+		assert len(slices) > 0
+		for slice in slices:
+			expected = profile_line(data[slice], src, dst, linewidth=linewidth, order=1, mode='reflect')
+			assert np.array_equal(kymograph[slice], expected.astype(np.float32)), (src, dst, linewidth, slice)
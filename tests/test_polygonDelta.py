@@ -0,0 +1,122 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Per frame stats of an edited polygon, stackPolygonAnalysis(key=), equal a full stackPolygonAnalysis().
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin import ShapeAnalysis
+from shapeanalysisplugin import Instrumentation
+
+@pytest.fixture
+def counters(monkeypatch):
+	""" Instrumentation counters of the test, e.g. counters()['polygon.deltaFull'] """
+	monkeypatch.setattr(Instrumentation, 'enabled', True)
+	Instrumentation.reset()
+	yield lambda: Instrumentation.report()['counters']
+	Instrumentation.reset()
+
+square = np.array([[10, 10], [10, 30], [30, 30], [30, 10]])
+
+# a chain of edits of one polygon, each a small delta of the one before
+edits = [
+	square,
+	square + [1, 0], # removes row 10, the min/max pixel
+	square + [1, 1],
+	np.array([[11, 11], [11, 31], [31, 31], [25, 20], [31, 11]]), # a vertex moved in
+	np.array([[11, 11], [11, 31], [32, 32], [31, 11]]),
+	square, # back, adds the min/max pixel
+	square - [0, 1],
+]
+
+def makeData(dtype, numChannels=None):
+	"""
+	(frames, rows, cols), or (channels, frames, rows, cols)
+
+	pixel (10, 10) is the min of frames 0..2 and the max of frames 3..5
+	"""
+	rng = np.random.default_rng(0)
+	shape = (8, 48, 48) if numChannels is None else (numChannels, 8, 48, 48)
+	data = rng.integers(1000, 2000, shape).astype(dtype)
+	data[..., 0:3, 10, 10] = 0
+	data[..., 3:6, 10, 10] = 5000
+	if np.dtype(dtype).kind == 'f':
+		data[..., 6, 20, 20] = np.nan
+	return data
+
+def fullAnalysis(data, vertices):
+	""" min, max, mean of a new ShapeAnalysis, nothing cached """
+	analysis = ShapeAnalysis(data)
+	analysis.doSingleThread = True
+	return analysis.stackPolygonAnalysis(vertices)
+
+def assertSameResults(deltaResults, fullResults, exact):
+	theMin, theMax, theMean = deltaResults
+	fullMin, fullMax, fullMean = fullResults
+	assert np.array_equal(theMin, fullMin, equal_nan=True)
+	assert np.array_equal(theMax, fullMax, equal_nan=True)
+	if exact:
+		assert np.array_equal(theMean, fullMean, equal_nan=True)
+	else:
+		assert np.allclose(theMean, fullMean, rtol=1e-6, equal_nan=True)
+
+@pytest.mark.parametrize('dtype, numChannels', [(np.uint16, None), (np.float32, None), (np.uint16, 2)])
+def test_deltaChain(counters, dtype, numChannels):
+	""" a chain of edits, each only gathers the pixels that changed """
+	data = makeData(dtype, numChannels)
+	analysis = ShapeAnalysis(data)
+	# sums of integers are exact
+	exact = np.dtype(dtype).kind != 'f'
+	for vertices in edits:
+		deltaResults = analysis.stackPolygonAnalysis(vertices, key='roi')
+		assertSameResults(deltaResults, fullAnalysis(data, vertices), exact)
+	# only the first analysis gathered all pixels
+	assert counters()['polygon.deltaFull'] == 1
+	assert counters()['polygon.deltaRedoSlices'] > 0
+
+def test_deltaRemovesMinMax():
+	""" frames whose min/max pixel is removed are recomputed, other frames are not """
+	data = makeData(np.uint16)
+	analysis = ShapeAnalysis(data)
+	analysis.stackPolygonAnalysis(square, key='roi')
+	theMin, theMax, theMean = analysis.stackPolygonAnalysis(square + [1, 0], key='roi')
+	assert np.all(theMin[0:3] >= 1000)
+	assert np.all(theMax[3:6] < 2000)
+	assertSameResults((theMin, theMax, theMean), fullAnalysis(data, square + [1, 0]), True)
+
+def test_dataReplaced(counters):
+	""" stats cached from the old data are not used with the new data """
+	data = makeData(np.uint16)
+	analysis = ShapeAnalysis(data)
+	analysis.stackPolygonAnalysis(square, key='roi')
+	newData = data * 2
+	analysis.data = newData
+	assert analysis.polygonVariance('roi') is None
+	deltaResults = analysis.stackPolygonAnalysis(square + [1, 0], key='roi')
+	assertSameResults(deltaResults, fullAnalysis(newData, square + [1, 0]), True)
+	assert counters()['polygon.cacheStale'] == 1
+	assert counters()['polygon.deltaFull'] == 2
+
+def test_dataEditedInPlace():
+	data = makeData(np.uint16)
+	analysis = ShapeAnalysis(data)
+	analysis.stackPolygonAnalysis(square, key='roi')
+	data[:, 15:25, 15:25] += 100
+	analysis.dataChanged()
+	deltaResults = analysis.stackPolygonAnalysis(square + [1, 0], key='roi')
+	assertSameResults(deltaResults, fullAnalysis(data, square + [1, 0]), True)
+	# extra stats are from the new data too
+	analysis.data = data + 1
+	extraStats = analysis.stackPolygonExtraStats(square, 'roi', stats=['sum'])
+	fullStats = ShapeAnalysis(data + 1).stackPolygonStats([square], stats=['sum'])
+	assert np.array_equal(extraStats['sum'], fullStats['sum'][0])
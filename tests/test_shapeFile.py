@@ -0,0 +1,323 @@
+# Robert Cudmore
+# 20261019
+
+"""
+ShapeList and ShapeFile, what we save loads back the same.
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys, json
+import numpy as np
+import h5py
+import pytest
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin import ShapeList, saveShapeFile, saveShapeFileInBackground, loadShapeFile
+from shapeanalysisplugin import ShapeFile
+
+def makeShapeList(numFrames=50):
+	""" lines, rectangles and polygons with (small) analysis results """
+	rng = np.random.default_rng(0)
+	shapeList = ShapeList()
+	for idx in range(6):
+		if idx % 3 == 0:
+			shapeList.add(rng.uniform(0, 100, (2, 2)), 'line', edge_width=idx+1, edge_color='coral')
+			shapeList.setResults(len(shapeList)-1, {
+				'lineDiameter': rng.uniform(0, 10, numFrames),
+				'lineKymograph': rng.uniform(0, 1000, (numFrames, 30)),
+				'lineFitParams': rng.uniform(0, 10, (numFrames, 3)),
+			})
+		else:
+			vertices = rng.uniform(0, 100, (4 if idx % 3 == 1 else 7, 2))
+			shapeList.add(vertices, 'rectangle' if idx % 3 == 1 else 'polygon',
+				edge_color=[1.0, 0.5, 0.0, 1.0], face_color='royalblue', opacity=0.3)
+			shapeList.setResults(len(shapeList)-1, {
+				'polygonMean': rng.uniform(0, 1000, numFrames),
+				'polygonN': rng.integers(0, 100, numFrames),
+				'polygonSum': rng.uniform(0, 1e6, numFrames),
+			})
+	return shapeList
+
+def assertSameShapes(shapeList, loaded):
+	""" same shapes, ids, vertices, drawing parameters and results (values and dtype) """
+	assert loaded.ids == shapeList.ids
+	assert loaded.shape_types == shapeList.shape_types
+	for idx in range(len(shapeList)):
+		assert np.array_equal(loaded.data[idx], shapeList.data[idx])
+		assert loaded.edge_widths[idx] == shapeList.edge_widths[idx]
+		assert loaded.opacities[idx] == shapeList.opacities[idx]
+		for name in ['edge_colors', 'face_colors']:
+			assert np.array_equal(np.asarray(getattr(loaded, name)[idx]), np.asarray(getattr(shapeList, name)[idx]))
+		assert sorted(loaded.metadata[idx].keys()) == sorted(shapeList.metadata[idx].keys())
+		for name, value in shapeList.metadata[idx].items():
+			loadedValue = np.asarray(loaded.metadata[idx][name])
+			value = np.asarray(value)
+			assert loadedValue.dtype == value.dtype, name
+			assert np.array_equal(loadedValue, value, equal_nan=True), name
+
+def test_roundTrip(tmp_path):
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFile(path, shapeList)
+	assert not shapeList.isDirty
+	assert ShapeFile.getFileVersion(path) == ShapeFile.fileVersion
+	# full save writes a temporary file and replaces path
+	assert not os.path.isfile(path + '.tmp')
+	loaded = loadShapeFile(path)
+	assertSameShapes(shapeList, loaded)
+	assert not loaded.isDirty
+	assert loaded.path == path
+
+def test_backgroundSave(tmp_path):
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFileInBackground(path, shapeList).result()
+	assertSameShapes(shapeList, loadShapeFile(path))
+
+def test_backgroundSaveError(tmp_path):
+	""" a failed save gives back the dirty state, nothing is lost """
+	path = str(tmp_path / 'noFolder' / 'shapes.h5')
+	shapeList = makeShapeList()
+	future = saveShapeFileInBackground(path, shapeList)
+	with pytest.raises(Exception):
+		future.result()
+	assert shapeList.isDirty
+	assert shapeList.path is None
+	# the next save writes everything
+	path = str(tmp_path / 'shapes.h5')
+	saveShapeFile(path, shapeList)
+	assertSameShapes(shapeList, loadShapeFile(path))
+
+def test_fullSaveError(tmp_path, monkeypatch):
+	""" a full save that fails leaves the file we had """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFile(path, shapeList)
+	def _writeChanges(f, changes):
+		raise IOError('disk full')
+	monkeypatch.setattr(ShapeFile, '_writeChanges', _writeChanges)
+	otherList = makeShapeList(numFrames=10)
+	with pytest.raises(IOError):
+		saveShapeFile(path, otherList)
+	monkeypatch.undo()
+	assertSameShapes(shapeList, loadShapeFile(path))
+
+def test_dirtySave(tmp_path):
+	""" a save after edits only writes rows of shapes that changed """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFile(path, shapeList)
+
+	# mark every row in the file, a row we do not write keeps its mark
+	with h5py.File(path, 'a') as f:
+		f['shapes/opacities'][:] = -1
+		f['results/polygonMean'][:, 0] = -1
+
+	shapeList.setData(1, shapeList.data[1] + 1) # geometry, not results
+	shapeList.setResults(2, {'polygonMean': np.arange(50)})
+	shapeList.setStyle(3, edge_width=10)
+	saveShapeFile(path, shapeList)
+
+	with h5py.File(path, 'r') as f:
+		ids = list(f['shapes/ids'][()])
+		opacities = f['shapes/opacities'][()]
+		polygonMean = f['results/polygonMean'][:, 0]
+	for row, id in enumerate(ids):
+		index = shapeList.indexOf(id)
+		if index in [1, 3]:
+			assert opacities[row] == shapeList.opacities[index]
+		else:
+			assert opacities[row] == -1
+		if index == 2:
+			assert polygonMean[row] == 0
+		else:
+			assert np.isnan(polygonMean[row]) or polygonMean[row] == -1
+
+	# what changed loads back
+	loaded = loadShapeFile(path)
+	assert np.array_equal(loaded.data[1], shapeList.data[1])
+	assert np.array_equal(loaded.metadata[2]['polygonMean'], shapeList.metadata[2]['polygonMean'])
+	assert loaded.edge_widths[3] == shapeList.edge_widths[3]
+
+def test_deleteAndAdd(tmp_path):
+	""" deleted shapes free their row, a new shape reuses it """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFile(path, shapeList)
+	deletedId = shapeList.ids[1]
+	shapeList.pop(1)
+	saveShapeFile(path, shapeList)
+	loaded = loadShapeFile(path)
+	assertSameShapes(shapeList, loaded)
+	assert deletedId not in loaded.ids
+
+	shapeList.add([[1, 1], [1, 5], [5, 5], [5, 1]], 'rectangle')
+	shapeList.setResults(len(shapeList)-1, {'polygonMean': np.ones(50)})
+	saveShapeFile(path, shapeList)
+	with h5py.File(path, 'r') as f:
+		assert len(f['shapes/ids']) == len(shapeList)
+	assertSameShapes(shapeList, loadShapeFile(path))
+
+def test_saveAs(tmp_path):
+	""" saving to another file writes everything, not just what is dirty """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeShapeList()
+	saveShapeFile(path, shapeList)
+	shapeList.setResults(0, {'lineDiameter': np.zeros(50)})
+	otherPath = str(tmp_path / 'other.h5')
+	saveShapeFile(otherPath, shapeList)
+	assertSameShapes(shapeList, loadShapeFile(otherPath))
+
+def saveVersion1(path, shapeList):
+	""" write the original layout, one group per shape, like ShapeAnalysisPlugin.save() did """
+	with h5py.File(path, "w") as f:
+		for idx in range(len(shapeList)):
+			shapeDict = ShapeFile._jsonValue(shapeList.getShapeDict(idx))
+			shapeGroup = f.create_group('shape' + str(idx))
+			shapeGroup.attrs['shapeDict'] = json.dumps(shapeDict)
+			shapeGroup.create_dataset("data", data=shapeList.data[idx])
+			for k, v in shapeList.metadata[idx].items():
+				shapeGroup.create_dataset('metadata/' + k, data=v)
+
+def fileContents(path):
+	""" dict of dataset name: value, of every dataset in a h5f file """
+	contents = {}
+	with h5py.File(path, 'r') as f:
+		contents['version'] = f.attrs['version']
+		def visit(name, item):
+			if isinstance(item, h5py.Dataset):
+				contents[name] = item[()]
+		f.visititems(visit)
+	return contents
+
+def test_migrate(tmp_path):
+	""" a version 1 file migrates to the same file as a direct version 2 save """
+	shapeList = makeShapeList()
+	# more than 10 shapes, 'shape10' sorts after 'shape9'
+	shapeList.extend(makeShapeList(numFrames=50))
+	v1Path = str(tmp_path / 'v1.h5')
+	saveVersion1(v1Path, shapeList)
+	assert ShapeFile.getFileVersion(v1Path) == 1
+	loaded = loadShapeFile(v1Path)
+	assertSameShapes(shapeList, loaded)
+	# we do not save into a version 1 file, it is migrated
+	assert loaded.path is None
+
+	v2Path = str(tmp_path / 'v2.h5')
+	saveShapeFile(v2Path, shapeList)
+	migratedPath = str(tmp_path / 'migrated.h5')
+	ShapeFile.migrateShapeFile(v1Path, migratedPath)
+	v2Contents = fileContents(v2Path)
+	migratedContents = fileContents(migratedPath)
+	assert sorted(migratedContents.keys()) == sorted(v2Contents.keys())
+	for name, value in v2Contents.items():
+		if isinstance(value, np.ndarray) and value.dtype == object:
+			# str and variable length vertices
+			assert len(migratedContents[name]) == len(value), name
+			for migratedItem, item in zip(migratedContents[name], value):
+				assert np.array_equal(migratedItem, item), name
+		else:
+			assert np.array_equal(migratedContents[name], value, equal_nan=True), name
+	assertSameShapes(shapeList, loadShapeFile(migratedPath))
+
+	# in place
+	ShapeFile.migrateShapeFile(v1Path)
+	assert ShapeFile.getFileVersion(v1Path) == 2
+	assertSameShapes(shapeList, loadShapeFile(v1Path))
+
+def makeLargeShapeList():
+	""" results big enough to load as LazyArray, a long trace (/results) and a kymograph (/arrays) """
+	rng = np.random.default_rng(1)
+	numFrames = 20000
+	shapeList = makeShapeList()
+	shapeList.setResults(0, {'lineDiameter': rng.uniform(0, 10, numFrames),
+							'lineKymograph': rng.uniform(0, 1000, (numFrames, 30))})
+	shapeList.setResults(1, {'polygonMean': rng.uniform(0, 1000, numFrames)})
+	return shapeList
+
+def test_lazyArray(tmp_path):
+	""" LazyArray reads the same values as the eager array we saved """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeLargeShapeList()
+	saveShapeFile(path, shapeList)
+	ShapeFile.resultCache.discardFile(os.path.abspath(path))
+	loaded = loadShapeFile(path)
+	for index, name in [(0, 'lineDiameter'), (0, 'lineKymograph'), (1, 'polygonMean')]:
+		lazy = loaded.metadata[index][name]
+		eager = shapeList.metadata[index][name]
+		assert isinstance(lazy, ShapeFile.LazyArray), name
+		assert lazy.shape == eager.shape and lazy.dtype == eager.dtype and len(lazy) == len(eager)
+		# slices are read from the file, not the cache
+		for key in [slice(100, 200), slice(None, 50), slice(19990, None), slice(5, 5000, 7), slice(-10, None)]:
+			assert np.array_equal(lazy[key], eager[key]), (name, key)
+		if eager.ndim == 2:
+			assert np.array_equal(lazy[100:200, 3], eager[100:200, 3])
+			assert np.array_equal(lazy[10:20, 5:9], eager[10:20, 5:9])
+		assert ShapeFile.resultCache.get((os.path.abspath(path), name, loaded.ids[index])) is None
+		# all of it, then from the cache
+		assert np.array_equal(np.asarray(lazy), eager)
+		assert np.array_equal(lazy[100:200], eager[100:200])
+		assert np.array_equal(lazy[7], eager[7])
+	# a short row of a long /results table, rows are padded with nan
+	assert np.array_equal(np.asarray(loaded.metadata[2]['polygonMean']), shapeList.metadata[2]['polygonMean'])
+	# small results are read on load
+	assert isinstance(loaded.metadata[3]['lineFitParams'], np.ndarray)
+
+def test_lazyArraySave(tmp_path):
+	""" LazyArray finds its shape by id, it stays valid after deletes and saves, saving it copies the file values """
+	path = str(tmp_path / 'shapes.h5')
+	shapeList = makeLargeShapeList()
+	saveShapeFile(path, shapeList)
+	loaded = loadShapeFile(path)
+	# rows change, ids do not
+	loaded.pop(0)
+	loaded.setResults(0, {'lineDiameter': np.zeros(10)})
+	saveShapeFile(path, loaded)
+	lazy = loaded.metadata[0]['polygonMean']
+	assert isinstance(lazy, ShapeFile.LazyArray)
+	assert np.array_equal(lazy[0:100], shapeList.metadata[1]['polygonMean'][0:100])
+	# a changed result is not read from a stale cache
+	np.asarray(lazy)
+	loaded.setResults(0, {'polygonMean': np.ones(20000)})
+	saveShapeFile(path, loaded)
+	assert np.array_equal(np.asarray(loadShapeFile(path).metadata[0]['polygonMean']), np.ones(20000))
+	# save as writes the values of LazyArray
+	otherPath = str(tmp_path / 'other.h5')
+	reloaded = loadShapeFile(path)
+	saveShapeFile(otherPath, reloaded)
+	assertSameShapes(loaded, loadShapeFile(otherPath))
+
+def test_resultCache():
+	""" least recently used results are evicted first, bounded by bytes """
+	cache = ShapeFile.ResultCache(maxBytes=3 * 800)
+	values = {key: np.full(100, idx, dtype=np.float64) for idx, key in enumerate('abcd')}
+	for key in 'abc':
+		cache.put(key, values[key])
+	assert cache.get('a') is values['a'] # a is now most recently used
+	cache.put('d', values['d'])
+	assert cache.get('b') is None
+	for key in 'acd':
+		assert cache.get(key) is values[key]
+	assert cache._numBytes == 3 * 800
+	# bigger than the cache, not kept and nothing evicted
+	cache.put('e', np.zeros(1000))
+	assert cache.get('e') is None
+	assert cache._numBytes == 3 * 800
+	# replacing a key does not count its bytes twice
+	cache.put('a', np.zeros(50))
+	assert cache._numBytes == 2 * 800 + 400
+	cache.discard('c')
+	assert cache.get('c') is None
+	assert cache._numBytes == 800 + 400
+
+def test_resultCacheDiscardFile():
+	cache = ShapeFile.ResultCache()
+	cache.put(('a.h5', 'lineDiameter', 0), np.zeros(10))
+	cache.put(('b.h5', 'lineDiameter', 0), np.zeros(10))
+	cache.discardFile('a.h5')
+	assert cache.get(('a.h5', 'lineDiameter', 0)) is None
+	assert cache.get(('b.h5', 'lineDiameter', 0)) is not None
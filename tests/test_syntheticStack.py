@@ -0,0 +1,45 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Synthetic stacks have the answers they say they have.
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+from skimage.draw import polygon
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin.SyntheticStack import syntheticStack
+
+@pytest.mark.parametrize('imageShape, numCells', [((128, 128), 8), ((128, 128), 40), ((64, 256), 20)])
+def test_cellTraces(imageShape, numCells):
+	""" without noise, the pixels in each cell polygon are its true trace, cells do not overlap """
+	stack = syntheticStack(numImages=30, imageShape=imageShape, numCells=numCells, noise=0)
+	data = stack['data']
+	masks = []
+	for vertices, trace in zip(stack['polygons'], stack['traces']):
+		rr, cc = polygon(vertices[:,0], vertices[:,1], shape=imageShape)
+		assert len(rr) > 0
+		pixels = data[:, rr, cc]
+		assert np.array_equal(pixels, np.repeat(trace.astype(np.float32)[:, None], len(rr), axis=1))
+		mask = np.zeros(imageShape, dtype=bool)
+		mask[rr, cc] = True
+		masks.append(mask)
+	assert np.sum(masks, axis=0).max() <= 1
+
+def test_tooManyCells():
+	with pytest.raises(ValueError):
+		syntheticStack(numImages=2, imageShape=(64, 64), numCells=200)
+
+def test_deterministic():
+	first = syntheticStack(numImages=5, seed=3)
+	second = syntheticStack(numImages=5, seed=3)
+	assert np.array_equal(first['data'], second['data'])
+	assert np.array_equal(first['traces'], second['traces'])
@@ -0,0 +1,141 @@
+# Robert Cudmore
+# 20261019
+
+"""
+Rolling percentile baseline, ΔF/F and channel ratio of polygon traces (TraceAnalysis).
+
+Usage:
+	python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+
+# run from a clone, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapeanalysisplugin import ShapeList, rollingPercentile, rollingDeltaFF, channelRatio, updateRollingTraces
+
+def slowRollingPercentile(trace, window, percentile):
+	""" one window at a time, the finite values of each window (edges like mode='nearest') """
+	trace = np.asarray(trace, dtype=np.float32)
+	numSlices = len(trace)
+	half = min(window, 2 * numSlices - 1) // 2
+	baseline = np.full(numSlices, np.nan, dtype=np.float32)
+	for slice in range(numSlices):
+		if not np.isfinite(trace[slice]):
+			continue
+		idx = np.clip(np.arange(slice - half, slice + half + 1), 0, numSlices - 1)
+		values = np.sort(trace[idx][np.isfinite(trace[idx])])
+		if len(values) == 0:
+			continue
+		rank = len(values) - 1 if percentile == 100 else int(float(len(values)) * percentile / 100.0)
+		baseline[slice] = values[rank]
+	return baseline
+
+def makeTraces(numRows=6, numSlices=400):
+	""" bleaching traces with transients """
+	rng = np.random.default_rng(0)
+	t = np.arange(numSlices)
+	traces = 100 * np.exp(-t / 300) + rng.normal(0, 2, (numRows, numSlices))
+	traces[:, 100:110] += 50
+	return traces.astype(np.float32)
+
+def addGaps(traces):
+	""" nan and inf, single values, runs, at the edges, and one row of all nan """
+	traces = traces.copy()
+	traces[0, 50] = np.nan
+	traces[1, 200:260] = np.nan # a gap longer than the window
+	traces[2, 0:5] = np.nan # at the edges
+	traces[2, -3:] = np.nan
+	traces[3, 120] = np.inf
+	traces[3, 121] = -np.inf
+	traces[4] = np.nan
+	return traces
+
+@pytest.mark.parametrize('percentile', [0, 8, 50, 100])
+@pytest.mark.parametrize('window', [1, 31, 301, 2001])
+def test_rollingPercentile(window, percentile):
+	traces = makeTraces()
+	baseline = rollingPercentile(traces, window, percentile)
+	assert baseline.dtype == np.float32 and baseline.shape == traces.shape
+	for row in range(len(traces)):
+		assert np.array_equal(baseline[row], slowRollingPercentile(traces[row], window, percentile))
+
+@pytest.mark.parametrize('percentile', [0, 8, 50, 100])
+@pytest.mark.parametrize('window', [1, 31, 301])
+def test_rollingPercentileGaps(window, percentile):
+	""" nan and inf are left out of each window, they are not filled in """
+	traces = addGaps(makeTraces())
+	# small blocks, of rows and of windows with a gap
+	baseline = rollingPercentile(traces, window, percentile, maxBlockBytes=window * 4 * 2 * 7)
+	for row in range(len(traces)):
+		assert np.array_equal(baseline[row], slowRollingPercentile(traces[row], window, percentile), equal_nan=True), row
+	assert np.isnan(baseline[~np.isfinite(traces)]).all()
+	assert np.isnan(baseline[4]).all()
+	# rows without gaps are not changed by gaps in other rows
+	assert np.array_equal(baseline[5], rollingPercentile(traces[5], window, percentile))
+
+def test_rollingPercentileGapBaseline():
+	""" next to a gap the baseline is from the trace, not pulled to the median of the whole trace """
+	trace = np.concatenate([np.full(200, 10, dtype=np.float32), np.full(200, 1000, dtype=np.float32)])
+	trace[190:200] = np.nan
+	baseline = rollingPercentile(trace, 21, 8)
+	assert np.all(baseline[170:190] == 10)
+
+def test_rollingDeltaFF():
+	traces = addGaps(makeTraces())
+	traces[5, 0:20] = 0 # F0 is 0
+	deltaFF, baseline = rollingDeltaFF(traces, 31, 8)
+	assert np.array_equal(baseline, rollingPercentile(traces, 31, 8), equal_nan=True)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		expected = (traces - baseline) / baseline
+	expected[baseline == 0] = np.nan
+	assert deltaFF.dtype == np.float32
+	assert np.array_equal(deltaFF, expected, equal_nan=True)
+	assert np.isnan(deltaFF[5, 0:10]).all()
+
+def test_channelRatio():
+	rng = np.random.default_rng(1)
+	channelTraces = rng.uniform(1, 10, (3, 2, 50)).astype(np.float32) # (roi, channels, slice)
+	channelTraces[0, 1, 5] = 0
+	ratio = channelRatio(channelTraces, (0, 1))
+	assert ratio.shape == (3, 50) and ratio.dtype == np.float32
+	with np.errstate(divide='ignore'):
+		expected = channelTraces[:, 0] / channelTraces[:, 1]
+	expected[0, 5] = np.nan
+	assert np.array_equal(ratio, expected, equal_nan=True)
+	# one roi, other order
+	assert np.array_equal(channelRatio(channelTraces[1], (1, 0)), channelTraces[1, 1] / channelTraces[1, 0])
+
+def test_updateRollingTraces():
+	""" many polygons at once, in blocks, equal each polygon on its own """
+	traces = addGaps(makeTraces(numRows=6, numSlices=400))
+	shapeList = ShapeList()
+	shapeList.add([[0, 0], [0, 10]], 'line')
+	for row, trace in enumerate(traces):
+		shapeList.add([[0, 0], [0, 10], [10, 10], [10, 0]], 'rectangle' if row % 2 else 'polygon')
+		shapeList.setResults(len(shapeList)-1, {'polygonMean': trace})
+	# another number of slices
+	shapeList.add([[0, 0], [0, 10], [10, 10]], 'polygon')
+	shapeList.setResults(len(shapeList)-1, {'polygonMean': traces[0, 0:150]})
+	# 4d data, two channels
+	channelTraces = np.stack([traces[5], traces[5] / 2 + 1])
+	shapeList.setResults(len(shapeList)-1, {'polygonMean': traces[0, 0:150], 'polygonMeanChannels': channelTraces[:, 0:150]})
+	# an empty polygon, not analyzed
+	shapeList.add([[0, 0], [0, 10], [10, 10]], 'polygon')
+
+	updateRollingTraces(shapeList, window=31, percentile=8, maxBlockBytes=400 * 4 * 4 * 2)
+	assert len(shapeList.metadata[0]['polygonRollingBaseline']) == 0
+	assert len(shapeList.metadata[-1]['polygonRollingBaseline']) == 0
+	for index in range(1, len(shapeList) - 1):
+		metadata = shapeList.metadata[index]
+		deltaFF, baseline = rollingDeltaFF(metadata['polygonMean'], 31, 8)
+		assert np.array_equal(metadata['polygonRollingBaseline'], baseline, equal_nan=True)
+		assert np.array_equal(metadata['polygonRollingDeltaFF'], deltaFF, equal_nan=True)
+		assert np.array_equal(metadata['polygonRollingWindow'], [31, 8])
+	metadata = shapeList.metadata[-2]
+	assert np.array_equal(metadata['polygonRatio'], channelRatio(channelTraces[:, 0:150]), equal_nan=True)
+	assert np.array_equal(metadata['polygonRatioPair'], [0, 1])
+	assert 'polygonRatio' not in shapeList.metadata[1]